@@ -10,7 +10,7 @@ from flask import g, request_started
 # Ensure the application package on the src/ path is importable
 sys.path.insert(0, str(Path(__file__).resolve().parent / "src"))
 from inventorius import app as inventorius_flask_app
-from inventorius.db import get_mongo_client
+from inventorius.db import ensure_indexes, get_mongo_client
 
 
 # give tests longer to complete on ci server
@@ -39,9 +39,11 @@ def clientContext():
     inventorius_flask_app.testing = True
     inventorius_flask_app.secret_key = "1234"
     test_db = get_mongo_client().testing
+    ensure_indexes(test_db)
     test_db.admin.delete_many({})
     test_db.batch.delete_many({})
     test_db.bin.delete_many({})
     test_db.sku.delete_many({})
+    test_db.totals.delete_many({})
     test_db.user.delete_many({})
     yield inventorius_flask_app.test_client()
@@ -19,12 +19,13 @@ from inventorius.bin import bin
 from inventorius.batch import batch
 from inventorius.inventorius import inventorius
 from inventorius.sku import sku
-from inventorius.files import files
+from inventorius.files import files, requeue_stale_uploads
 # from inventorius.data_models import Bin, MyEncoder, Uniq, Batch, Sku
 from inventorius.user import user
 from inventorius.schema.routes import bp as schema_bp
 from inventorius.util import login_manager, no_cache, principals
 from inventorius.resource_models import StatusEndpoint
+from inventorius.migrations import ensure_indexes_command, migrate_command, migrate_contents_keys_command, migrate_file_blobs_command, migrate_ids_command, process_pending_files_command, rebuild_totals_command
 
 import platform
 import os
@@ -64,6 +65,17 @@ app.register_blueprint(files)
 app.register_blueprint(user)
 app.register_blueprint(schema_bp)
 
+app.cli.add_command(migrate_command)
+app.cli.add_command(ensure_indexes_command)
+app.cli.add_command(migrate_ids_command)
+app.cli.add_command(migrate_contents_keys_command)
+app.cli.add_command(rebuild_totals_command)
+app.cli.add_command(migrate_file_blobs_command)
+app.cli.add_command(process_pending_files_command)
+
+# let a front-end server that supports X-Sendfile send file bodies
+app.config["USE_X_SENDFILE"] = os.getenv("INVENTORIUS_USE_X_SENDFILE", "0") == "1"
+
 if app.debug:
     print("!!! ENVIROMENT SETTING SECRET KEY FOR SESSIONS !!!")
     app.secret_key = os.getenv("FLASK_SECRET_KEY")
@@ -83,6 +95,18 @@ def cors_allow_all(response):
 
 
 app.after_request(cors_allow_all)
+
+
+@app.before_request
+def requeue_lost_uploads():
+    from pymongo.errors import PyMongoError
+    from inventorius.db import db
+    try:
+        requeue_stale_uploads(db._get_current_object())
+    except PyMongoError:
+        pass
+
+
 login_manager.init_app(app)
 principals.init_app(app)
 
@@ -106,32 +130,17 @@ def get_version():
 
 
 @app.route("/api/stats", methods=["GET"])
-@no_cache
 def get_stats():
-    from flask import Response, jsonify
+    from flask import jsonify, request
     from inventorius.db import db
+    from inventorius.stats import STATS_TTL, get_stats as cached_stats
 
     try:
-        bin_count = db.bin.estimated_document_count()
-        sku_count = db.sku.estimated_document_count()
-        batch_count = db.batch.estimated_document_count()
-
-        # Get 5 most recent bins (by _id which has timestamp)
-        recent_bins = list(db.bin.find({}, {"_id": 1, "props": 1}).sort("_id", -1).limit(5))
-        recent_bins_list = [{"id": doc["_id"], "props": doc.get("props", {})} for doc in recent_bins]
-
-        # Get 5 most recent SKUs
-        recent_skus = list(db.sku.find({}, {"_id": 1, "name": 1}).sort("_id", -1).limit(5))
-        recent_skus_list = [{"id": doc["_id"], "name": doc.get("name", "")} for doc in recent_skus]
-
-        return jsonify({
-            "counts": {
-                "bins": bin_count,
-                "skus": sku_count,
-                "batches": batch_count,
-            },
-            "recent_bins": recent_bins_list,
-            "recent_skus": recent_skus_list,
-        })
+        stats, etag = cached_stats(db)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+
+    resp = jsonify(stats)
+    resp.set_etag(etag)
+    resp.cache_control.max_age = int(STATS_TTL)
+    return resp.make_conditional(request)
@@ -4,13 +4,12 @@ from inventorius.data_models import Batch, Bin, Sku, DataModelJSONEncoder as Enc
 from inventorius.db import db
 from inventorius.resource_models import BatchBinsEndpoint, BatchEndpoint
 import inventorius.resource_operations as operation
-from inventorius.util import admin_increment_code, check_code_list, no_cache
+from inventorius.util import admin_increment_code, check_code_list, item_totals, no_cache
 from inventorius.validation import new_batch_schema, batch_patch_schema, prefixed_id, forced_schema, validate_url_id
 from voluptuous import All, Required
 import inventorius.util_error_responses as problem
 import inventorius.util_success_responses as success
 
-from pymongo import TEXT
 from bson.decimal128 import Decimal128
 
 import json
@@ -40,11 +39,6 @@ def batches_post():
     admin_increment_code("BAT", batch.id)
     db.batch.insert_one(batch.to_mongodb_doc())
 
-    # Add text index if not yet created
-    # TODO: This should probably be turned into a global flag
-    if "name_text" not in db.batch.index_information().keys():
-        db.sku.create_index([("name", TEXT)])
-
     return BatchEndpoint.from_batch(batch).created_success_response()
 
 
@@ -56,7 +50,7 @@ def batch_get(id):
     if not existing:
         return problem.missing_batch_response(id)
     else:
-        return BatchEndpoint.from_batch(existing).get_response()
+        return BatchEndpoint.from_batch(existing, totals=item_totals(id)).get_response()
 
 
 @batch.route("/api/batch/<id>", methods=["PATCH"])
@@ -3,13 +3,15 @@ from voluptuous.error import MultipleInvalid
 from inventorius.data_models import Bin, DataModelJSONEncoder as Encoder
 from inventorius.db import db
 from inventorius.resource_models import BinEndpoint
-from inventorius.util import get_body_type, admin_increment_code, no_cache
+from inventorius.util import get_body_type, admin_increment_code, no_cache, totals_inc
 import inventorius.util_error_responses as problem
 import inventorius.util_success_responses as success
 from inventorius.validation import bin_patch_schema, new_bin_schema, validate_url_id
 
 import json
 
+from pymongo import UpdateOne
+
 bin = Blueprint("bin", __name__)
 
 
@@ -27,7 +29,7 @@ def bins_post():
 
     bin = Bin.from_json(json)
     admin_increment_code("BIN", bin.id)
-    db.bin.insert_one(bin.to_mongodb_doc())
+    db.bin.insert_one({**bin.to_mongodb_doc(), "contents_keys": list(bin.contents)})
     return BinEndpoint.from_bin(bin).created_success_response()
 
 
@@ -70,7 +72,11 @@ def bin_delete(id):
         return problem.missing_bin_response(id)
         
     if request.args.get('force', 'false') == 'true' or len(existing.contents.keys()) == 0:
-        db.bin.delete_one({"_id": id})
+        deleted = db.bin.find_one_and_delete({"_id": id}, {"contents": 1})
+        if deleted and deleted.get("contents"):
+            db.totals.bulk_write([
+                UpdateOne({"_id": item_id}, totals_inc(-quantity, -1), upsert=True)
+                for item_id, quantity in deleted["contents"].items()], ordered=False)
         return success.bin_deleted_response(id)
     else:
         return problem.dangerous_operation_unforced_response("id", "bin must be empty")
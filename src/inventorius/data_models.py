@@ -32,6 +32,8 @@ def get_fields(cls):
 
 class DataModelJSONEncoder(json.JSONEncoder):
     def default(self, o):
+        if isinstance(o, DataModelColumns):
+            return list(o)
         return {k: v for k, v in o.__dict__.items() if k != None}
 
 
@@ -80,6 +82,70 @@ class Subdoc():
             self.default = default
 
 
+class DerivedField():
+    """A db-only field computed from other fields and kept up to date by the
+    update queries that change them (e.g. an indexable copy of dict keys).
+
+    It is skipped when loading a mongodb doc, so it never reaches the model,
+    `to_dict` or `to_mongodb_doc`.
+    """
+
+    def __init__(self, db_key):
+        self.db_key = db_key
+
+    def __repr__(self):
+        return f"DerivedField(db_key={self.db_key})"
+
+
+class FieldPlan():
+    """Per-class conversion plan, compiled once from the `DataField` and `Subdoc`
+    class variables of a `DataModel` subclass.
+
+    Holds everything the conversion methods used to recover through `dir(cls)` on
+    every call: the ordered field list, db_key <-> model_key lookups and the
+    bson converters.
+    """
+
+    def __init__(self, cls):
+        self.class_variables = get_class_variables(cls)
+        self.has_additional_fields = issubclass(cls, HasAdditionalFields)
+
+        # [(model_key, DataField | Subdoc)] in the same (dir) order as get_fields
+        self.fields = [(attr, getattr(cls, attr)) for attr in get_fields(cls)]
+        self.by_model_key = dict(self.fields)
+
+        # db_key -> (model_key, bson_to_value). First field wins on duplicate db_keys,
+        # matching the old linear scan over model keys.
+        self.from_bson = {}
+        # [(model_key, db_key, value_to_bson, is_subdoc)]
+        self.to_bson = []
+        for model_key, attribute in self.fields:
+            if isinstance(attribute, Subdoc):
+                converter = attribute.data_model_type.from_mongodb_doc
+                self.to_bson.append((model_key, attribute.db_key, None, True))
+            else:
+                converter = attribute.bson_to_value
+                self.to_bson.append(
+                    (model_key, attribute.db_key, attribute.value_to_bson, False))
+            if attribute.db_key is not None:
+                self.from_bson.setdefault(attribute.db_key, (model_key, converter))
+
+        # db_keys of DerivedField class variables, dropped on load
+        self.derived_db_keys = {getattr(cls, attr).db_key for attr in self.class_variables
+                                if isinstance(getattr(cls, attr), DerivedField)}
+
+
+_field_plans = {}
+
+
+def get_field_plan(cls):
+    """Returns the cached `FieldPlan` for a DataModel subclass, compiling it on first use."""
+    plan = _field_plans.get(cls)
+    if plan is None:
+        plan = _field_plans[cls] = FieldPlan(cls)
+    return plan
+
+
 class DataModel():
     """Abstract base class for managing conversion between app data structures and
        mongodb bson documents.
@@ -88,12 +154,11 @@ class DataModel():
     """
 
     def __init__(self, **kwargs):
+        plan = get_field_plan(type(self))
         # Track which kwargs are consumed by defined fields
         consumed_keys = set()
 
-        for field in get_class_variables(type(self)):
-            class_variable = getattr(self.__class__, field)
-
+        for field, class_variable in plan.fields:
             if isinstance(class_variable, DataField):
                 # if field in kwargs:
                 # then called like ChildModel(field=value) so then simulate dataclass
@@ -122,7 +187,7 @@ class DataModel():
                 else:
                     setattr(self, field, None)
 
-            elif isinstance(class_variable, Subdoc):
+            else:
                 if field in kwargs:
                     consumed_keys.add(field)
                     if type(kwargs[field]) is dict:
@@ -137,7 +202,7 @@ class DataModel():
                         setattr(self, field, class_variable.default)
 
         # If this class allows additional fields, store remaining kwargs
-        if issubclass(type(self), HasAdditionalFields):
+        if plan.has_additional_fields:
             for key, value in kwargs.items():
                 if key not in consumed_keys:
                     setattr(self, key, value)
@@ -145,11 +210,18 @@ class DataModel():
     def __eq__(self, other):
         if type(self) != type(other):
             return False
-        for field in get_class_variables(self):
+        plan = get_field_plan(type(self))
+        for field in plan.class_variables:
             if getattr(self, field) != getattr(other, field):
                 return False
+        if plan.has_additional_fields:
+            return self._additional_fields() == other._additional_fields()
         return True
 
+    def _additional_fields(self):
+        by_model_key = get_field_plan(type(self)).by_model_key
+        return {k: v for k, v in self.__dict__.items() if k not in by_model_key}
+
     def to_json(self, mask_default=True):
         return json.dumps(self.to_dict(mask_default), cls=DataModelJSONEncoder)
 
@@ -165,95 +237,75 @@ class DataModel():
 
     @classmethod
     def from_mongodb_doc(cls, mongo_dict):
-        model_keys = get_fields(cls)
-
-        def db_key_to_model_key(db_key):
-            # search model_keys
-            for model_key in model_keys:
-                if getattr(cls, model_key).db_key == db_key:
-                    return model_key
-            if issubclass(cls, HasAdditionalFields):
-                return db_key
-            else:
-                raise Exception(
-                    "db_key not in DataModel schema, and class does not inherit HasAdditionalFields")
-
-        def db_value_to_model_value(model_key, db_value):
-            if not hasattr(cls, model_key):
-                # Additional field - return value as-is
-                if issubclass(cls, HasAdditionalFields):
-                    return db_value
-                else:
-                    raise Exception(
-                        "db_key not in DataModel schema, and class does not inherit HasAdditionalFields")
-            attribute = getattr(cls, model_key)
-            if isinstance(attribute, DataField):
-                return attribute.bson_to_value(db_value)
-            if isinstance(attribute, Subdoc):
-                return attribute.data_model_type.from_mongodb_doc(db_value)
-            return db_value
-
         if mongo_dict is None:
             return None
+        plan = get_field_plan(cls)
+        from_bson = plan.from_bson
+
         data_model_dict = {}
         for db_key, db_value in mongo_dict.items():
-            model_key = db_key_to_model_key(db_key)
-            model_value = db_value_to_model_value(
-                model_key=model_key, db_value=db_value)
-            # Include both defined fields and additional fields
-            if model_key in model_keys or issubclass(cls, HasAdditionalFields):
-                data_model_dict[model_key] = model_value
+            entry = from_bson.get(db_key)
+            if entry is not None:
+                model_key, converter = entry
+                data_model_dict[model_key] = converter(db_value)
+            elif db_key in plan.derived_db_keys:
+                continue
+            elif plan.has_additional_fields:
+                # Additional field - keep value as-is
+                data_model_dict[db_key] = db_value
+            else:
+                raise Exception(
+                    "db_key not in DataModel schema, and class does not inherit HasAdditionalFields")
         return cls(**data_model_dict)
 
-    def to_mongodb_doc(self):
-        model_keys = get_fields(type(self))
-
-        def model_key_to_db_key(model_key):
-            return getattr(self.__class__, model_key).db_key
+    @classmethod
+    def from_mongodb_docs(cls, mongo_dicts):
+        """Bulk version of `from_mongodb_doc` that returns a compact `DataModelColumns`
+        instead of a list of instances. `mongo_dicts` may be a cursor."""
+        columns = DataModelColumns(cls)
+        for mongo_dict in mongo_dicts:
+            columns.append_mongodb_doc(mongo_dict)
+        return columns
 
-        def model_value_to_db_value(model_key, model_value):
-            attribute = getattr(self.__class__, model_key)
-            if isinstance(attribute, DataField):
-                return attribute.value_to_bson(model_value)
-            if isinstance(attribute, Subdoc) \
-                    and type(model_value) is not Subdoc:  # guard against undefined instance variables.
-                return model_value.to_mongodb_doc()
+    def to_mongodb_doc(self):
+        plan = get_field_plan(type(self))
 
         # transform self.__dict__ like {k: v} => {f(k): v}
         transformed_dict = {}
-        for model_key in model_keys:
+        for model_key, db_key, value_to_bson, is_subdoc in plan.to_bson:
+            if db_key is None:
+                continue
 
             # If a model_key is not an instance variable,
             # then getattr should return the value model_key in the subclass.
             model_value = getattr(self, model_key)
 
-            # don't break the db schema
-            assert getattr(type(self), model_key) != None
-
-            db_key = model_key_to_db_key(model_key)
-            db_value = model_value_to_db_value(model_key, model_value)
+            if is_subdoc:
+                # guard against undefined instance variables.
+                db_value = None if type(model_value) is Subdoc else model_value.to_mongodb_doc()
+            else:
+                db_value = value_to_bson(model_value)
 
-            if db_key is not None and type(db_value) != DataField:
+            if type(db_value) != DataField:
                 transformed_dict[db_key] = db_value
 
         # Include additional fields for classes that allow them
-        if issubclass(type(self), HasAdditionalFields):
-            for key, value in self.__dict__.items():
-                if key not in model_keys:
-                    # Store additional fields directly (no transformation)
-                    transformed_dict[key] = value
+        if plan.has_additional_fields:
+            # Store additional fields directly (no transformation)
+            transformed_dict.update(self._additional_fields())
 
         return transformed_dict
 
     def to_dict(self, mask_default=False):
+        plan = get_field_plan(type(self))
         prepared_dict = {}
         for key, value in self.__dict__.items():
-            class_variable = getattr(type(self), key, None)
+            class_variable = plan.by_model_key.get(key)
 
             if class_variable is None:
                 # Additional field (not defined as DataField/Subdoc)
                 # Only include if this class allows additional fields
-                if issubclass(type(self), HasAdditionalFields):
+                if plan.has_additional_fields:
                     prepared_dict[key] = value
                 continue
 
@@ -275,6 +327,106 @@ class DataModel():
                     prepared_dict[key] = value
         return prepared_dict
 
+_MISSING = object()
+
+
+class DataModelColumns():
+    """Column-oriented storage for many documents of one DataModel class.
+
+    Keeps one list per field instead of one instance (and instance dict) per
+    document. Rows are materialized as ordinary model instances on access, so
+    `to_dict`/`to_mongodb_doc`/`__eq__` behave exactly as they do for models
+    built with `from_mongodb_doc`. Iterate it to handle one row at a time.
+    """
+
+    def __init__(self, model_type):
+        self.model_type = model_type
+        self._plan = get_field_plan(model_type)
+        self._columns = {model_key: [] for model_key, _ in self._plan.fields}
+        # one dict (or None) per row, only for classes that allow additional fields
+        self._additional = [] if self._plan.has_additional_fields else None
+        self._length = 0
+
+    def append_mongodb_doc(self, mongo_dict):
+        if mongo_dict is None:
+            return
+        plan = self._plan
+        row = {}
+        additional = None
+        for db_key, db_value in mongo_dict.items():
+            entry = plan.from_bson.get(db_key)
+            if entry is not None:
+                model_key, converter = entry
+                row[model_key] = converter(db_value)
+            elif db_key in plan.derived_db_keys:
+                continue
+            elif self._additional is not None:
+                if additional is None:
+                    additional = {}
+                additional[db_key] = db_value
+            else:
+                raise Exception(
+                    "db_key not in DataModel schema, and class does not inherit HasAdditionalFields")
+
+        for model_key, column in self._columns.items():
+            column.append(row.get(model_key, _MISSING))
+        if self._additional is not None:
+            self._additional.append(additional)
+        self._length += 1
+
+    def pop(self):
+        """Remove and return the last row."""
+        row = self[-1]
+        for column in self._columns.values():
+            column.pop()
+        if self._additional is not None:
+            self._additional.pop()
+        self._length -= 1
+        return row
+
+    def reverse(self):
+        for column in self._columns.values():
+            column.reverse()
+        if self._additional is not None:
+            self._additional.reverse()
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._length))]
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("DataModelColumns index out of range")
+
+        kwargs = {}
+        for model_key, column in self._columns.items():
+            value = column[index]
+            if value is not _MISSING:
+                kwargs[model_key] = value
+        if self._additional is not None and self._additional[index]:
+            kwargs.update(self._additional[index])
+        return self.model_type(**kwargs)
+
+    def __iter__(self):
+        for index in range(self._length):
+            yield self[index]
+
+    def __eq__(self, other):
+        if not isinstance(other, DataModelColumns):
+            return NotImplemented
+        return (self.model_type == other.model_type
+                and len(self) == len(other)
+                and all(a == b for a, b in zip(self, other)))
+
+    def to_mongodb_docs(self):
+        return [model.to_mongodb_doc() for model in self]
+
+    def to_dicts(self, mask_default=False):
+        return [model.to_dict(mask_default) for model in self]
+
 # -------- Data model flags
 
 
@@ -321,6 +473,8 @@ class Bin(DataModel):
     props = DataField("props")
     # _contents = [{id: label, quantity: n}]
     contents = DataField("contents", default={})
+    # indexed copy of contents.keys() for "which bins hold this item" queries
+    contents_keys = DerivedField("contents_keys")
     # unit_count = DataField()
     # sku_count = DataField()
 
@@ -2,7 +2,7 @@ import os
 
 from flask import g
 from gridfs import GridFS
-from pymongo import TEXT, MongoClient
+from pymongo import ASCENDING, DESCENDING, TEXT, MongoClient
 from werkzeug.local import LocalProxy
 
 # memoize mongo_client
@@ -15,16 +15,55 @@ def get_mongo_client():
         db_host = os.getenv("INVENTORIUS_MONGO_HOST", "localhost")
         db_port = int(os.getenv("INVENTORIUS_MONGO_PORT", "27017"))
         _mongo_client = MongoClient(db_host, db_port)
-        _mongo_client.inventoriusdb.sku.create_index([("name", TEXT)])
-        _mongo_client.inventoriusdb.batch.create_index([("name", TEXT)])
-        _mongo_client.inventoriusdb.user.create_index([("name", TEXT)])
 
     return _mongo_client
 
 
+# Every index the app relies on, as (collection, keys). Search puts $text in an
+# $or with the code fields, which requires them to be indexed too.
+INDEXES = [
+    ("sku", [("name", TEXT)]),
+    ("sku", [("owned_codes", ASCENDING)]),
+    ("sku", [("associated_codes", ASCENDING)]),
+    ("batch", [("name", TEXT)]),
+    ("batch", [("owned_codes", ASCENDING)]),
+    ("batch", [("associated_codes", ASCENDING)]),
+    ("batch", [("sku_id", ASCENDING)]),
+    ("bin", [("contents_keys", ASCENDING)]),
+    ("files", [("uploaded_at", DESCENDING)]),
+    ("blobs", [("processing", ASCENDING)]),
+    ("renditions", [("last_used", ASCENDING)]),
+    ("renditions", [("blob", ASCENDING)]),
+    ("user", [("name", TEXT)]),
+    ("user", [("shadow_id", ASCENDING)]),
+]
+
+# names of the databases INDEXES has been applied to by this process
+_indexed_databases = set()
+
+
+def ensure_indexes(database):
+    """Create the indexes in INDEXES on `database`, once per process.
+
+    create_index is a no-op for indexes that already exist, so this is safe to
+    run from every worker and from `flask ensure-indexes`.
+    """
+    if database.name in _indexed_databases:
+        return
+    for collection, keys in INDEXES:
+        database[collection].create_index(keys)
+    _indexed_databases.add(database.name)
+
+
+def has_indexes(database):
+    """True if this process has applied INDEXES to `database`."""
+    return database.name in _indexed_databases
+
+
 def get_db():
     if "db" not in g:
         g.db = get_mongo_client().inventoriusdb
+        ensure_indexes(g.db)
     return g.db
 
 
@@ -34,5 +73,48 @@ def get_gridfs_db():
     return g.fs
 
 
+class AbortTransaction(Exception):
+    """Raise from a `run_in_transaction` callback to roll back and return `result`."""
+
+    def __init__(self, result):
+        super().__init__(result)
+        self.result = result
+
+
+# transactions_supported result of each client this process has used
+_transactions_supported = {}
+
+
+def transactions_supported(client):
+    """Multi-document transactions need a replica set or a sharded cluster.
+
+    A new client reports an Unknown topology until it has selected a server,
+    so ping the deployment before looking, once per client.
+    """
+    if client not in _transactions_supported:
+        client.admin.command("ping")
+        _transactions_supported[client] = client.topology_description.topology_type_name in (
+            "ReplicaSetWithPrimary", "Sharded")
+    return _transactions_supported[client]
+
+
+def run_in_transaction(callback):
+    """Call `callback(session)` inside a multi-document transaction when the
+    deployment supports one, otherwise call `callback(None)`.
+
+    Without a transaction nothing is rolled back for the callback, so it must
+    only write through guarded updates and undo its own writes before raising
+    `AbortTransaction`.
+    """
+    client = get_db().client
+    try:
+        if not transactions_supported(client):
+            return callback(None)
+        with client.start_session() as session:
+            return session.with_transaction(callback)
+    except AbortTransaction as e:
+        return e.result
+
+
 db = LocalProxy(get_db)
 fs = LocalProxy(get_gridfs_db)
@@ -4,15 +4,35 @@ File upload and serving for Inventorius.
 Handles image uploads with automatic resizing and thumbnail generation.
 Files are stored on disk in INVENTORIUS_UPLOADS_PATH volume.
 Metadata is stored in MongoDB 'files' collection.
+
+Uploads are stored as received, named by the SHA-256 of their content, and
+answered right away. Identical uploads share one blob, counted in the
+'blobs' collection and removed with its last file. New images are resized
+afterwards by a background thread pool, with the blob marked `processing`
+until that is done.
+
+Thumbnails and other renditions are generated when first requested and kept
+in an on-disk cache, tracked in the 'renditions' collection, that evicts the
+least recently used ones beyond RENDITION_CACHE_SIZE bytes.
 """
 
-from flask import Blueprint, request, Response, send_file, url_for, current_app
+from flask import Blueprint, request, Response, redirect, send_file, url_for, current_app
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
 from werkzeug.utils import secure_filename
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
+import hashlib
+import io
 import os
+import threading
+import time
 import uuid
 import mimetypes
 
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
 from inventorius.db import db
 from inventorius.util import no_cache
 import inventorius.util_error_responses as problem
@@ -20,7 +40,6 @@ import inventorius.util_error_responses as problem
 # Optional: image processing with Wand (ImageMagick)
 try:
     from wand.image import Image
-    from wand.exceptions import WandException
     WAND_AVAILABLE = True
 except ImportError:
     WAND_AVAILABLE = False
@@ -33,6 +52,43 @@ MAX_UPLOAD_SIZE = int(os.getenv("INVENTORIUS_MAX_UPLOAD_SIZE", 10 * 1024 * 1024)
 UPLOADS_PATH = os.getenv("INVENTORIUS_UPLOADS_PATH", "/var/lib/inventorius/uploads")
 MAX_IMAGE_DIMENSION = 2000  # Resize images larger than this
 THUMBNAIL_SIZE = 256
+# Sizes /api/files/<id>/thumb?size= may ask for
+THUMBNAIL_SIZES = sorted({THUMBNAIL_SIZE} | {
+    int(size) for size in os.getenv("INVENTORIUS_THUMBNAIL_SIZES", "64,128,256,512").split(",") if size})
+# Smaller copies of image uploads, as "name:max dimension:format", served by
+# /api/files/<id>/renditions/<name>. "thumb" is also /api/files/<id>/thumb.
+RENDITIONS = [
+    (name, int(size), image_format)
+    for name, size, image_format in (
+        spec.split(":") for spec in os.getenv(
+            "INVENTORIUS_RENDITIONS", f"thumb:{THUMBNAIL_SIZE}:png,preview:800:webp,thumb_webp:{THUMBNAIL_SIZE}:webp"
+        ).split(",") if spec)
+]
+# Bytes of generated renditions kept on disk
+RENDITION_CACHE_SIZE = int(os.getenv("INVENTORIUS_RENDITION_CACHE_SIZE", 1024 * 1024 * 1024))  # 1GB
+RENDITION_TOUCH_INTERVAL = 60  # seconds between last_used updates of a cached rendition
+RENDITION_TIMEOUT = 60  # seconds after which an unfinished rendition is generated again
+RENDITION_WAIT = 5  # seconds a request waits for another one to generate a rendition
+RENDITION_POLL_DELAY = 0.05  # doubled up to RENDITION_MAX_POLL_DELAY while waiting
+RENDITION_MAX_POLL_DELAY = 0.5
+RENDITION_RETRY_FAILED = 24 * 3600  # seconds before a failed rendition is tried again
+RENDITION_EVICT_BATCH = 100
+# Stored files never change under an ETag, so clients may cache them for a year
+IMMUTABLE_MAX_AGE = 31536000
+# With a front-end server location mapping this prefix to UPLOADS_PATH, file
+# bodies are sent by it through X-Accel-Redirect instead of by a worker.
+ACCEL_REDIRECT_PREFIX = os.getenv("INVENTORIUS_ACCEL_REDIRECT_PREFIX")
+UPLOAD_CHUNK_SIZE = 64 * 1024
+MIME_SNIFF_SIZE = 16  # bytes detect_mime_type looks at
+MAX_FORM_OVERHEAD = 64 * 1024  # multipart headers and other form fields
+MAX_META_BATCH = 500
+BLOB_RETRIES = 100
+BLOB_RETRY_DELAY = 0.05
+# Background threads resizing uploaded images. 0 processes them inside the request.
+IMAGE_WORKERS = int(os.getenv("INVENTORIUS_IMAGE_WORKERS", "2"))
+# seconds after which an upload still processing is taken as lost with the
+# worker that queued it, and queued again
+UPLOAD_PROCESSING_TIMEOUT = 600
 
 # Allowed MIME types
 ALLOWED_TYPES = {
@@ -51,17 +107,44 @@ IMAGE_TYPES = {
     "image/webp",
 }
 
+RENDITION_TYPES = {
+    "png": "image/png",
+    "jpeg": "image/jpeg",
+    "webp": "image/webp",
+    "gif": "image/gif",
+}
+
+
+def thumbnail_rendition(size: int) -> str:
+    """Name of the rendition served by /api/files/<id>/thumb?size=<size>."""
+    return "thumb" if size == THUMBNAIL_SIZE else f"thumb_{size}"
+
+
+# rendition name -> (max dimension, format), RENDITIONS taking precedence
+RENDITION_SPECS = {
+    **{thumbnail_rendition(size): (size, "png") for size in THUMBNAIL_SIZES},
+    **{name: (size, image_format) for name, size, image_format in RENDITIONS},
+}
+
 
-def get_file_path(file_id: str) -> str:
-    """Get the filesystem path for a file."""
-    shard = file_id[:2]
-    return os.path.join(UPLOADS_PATH, "files", shard, file_id)
+def get_file_path(blob_id: str) -> str:
+    """Get the filesystem path for a blob (or a file stored by its ID)."""
+    shard = blob_id[:2]
+    return os.path.join(UPLOADS_PATH, "files", shard, blob_id)
 
 
-def get_thumb_path(file_id: str) -> str:
+def get_thumb_path(blob_id: str) -> str:
     """Get the filesystem path for a thumbnail."""
-    shard = file_id[:2]
-    return os.path.join(UPLOADS_PATH, "thumbs", shard, file_id)
+    shard = blob_id[:2]
+    return os.path.join(UPLOADS_PATH, "thumbs", shard, blob_id)
+
+
+def get_rendition_path(blob_id: str, name: str) -> str:
+    """Get the filesystem path for a rendition of an image."""
+    if name == "thumb":
+        return get_thumb_path(blob_id)
+    shard = blob_id[:2]
+    return os.path.join(UPLOADS_PATH, "renditions", name, shard, blob_id)
 
 
 def ensure_dir(path: str) -> None:
@@ -69,6 +152,47 @@ def ensure_dir(path: str) -> None:
     os.makedirs(os.path.dirname(path), exist_ok=True)
 
 
+def file_sha256(path: str) -> str:
+    """Hex SHA-256 of a file's content, used as its ETag."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def send_stored_file(path: str, mimetype: str, etag: str | None, cacheable: bool = True):
+    """
+    Respond with a stored file, or None if it is missing from disk.
+
+    Requests revalidating a known `etag` get a 304 without touching the disk.
+    Otherwise the body is sent by the front-end server (X-Accel-Redirect) if
+    configured, or by send_file, which also answers If-Modified-Since and
+    Range requests.
+    """
+    if etag and request.if_none_match.contains(etag):
+        response = Response(status=304)
+    elif ACCEL_REDIRECT_PREFIX:
+        if not os.path.exists(path):
+            return None
+        response = Response(mimetype=mimetype)
+        response.headers["X-Accel-Redirect"] = (
+            ACCEL_REDIRECT_PREFIX.rstrip("/") + "/" + os.path.relpath(path, UPLOADS_PATH))
+    else:
+        try:
+            response = send_file(path, mimetype=mimetype, conditional=True, etag=etag or True)
+        except FileNotFoundError:
+            return None
+
+    if etag:
+        response.set_etag(etag)
+    if cacheable:
+        response.headers["Cache-Control"] = f"public, max-age={IMMUTABLE_MAX_AGE}, immutable"
+    else:
+        response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
 def detect_mime_type(file_stream) -> str:
     """Detect MIME type from file magic bytes."""
     # Read first few bytes for magic number detection
@@ -94,154 +218,575 @@ def detect_mime_type(file_stream) -> str:
     return "application/octet-stream"
 
 
-def process_image(input_path: str, output_path: str, max_dim: int) -> tuple[int, int]:
+def fit_within(width: int, height: int, max_dim: int) -> tuple[int, int]:
+    """Dimensions scaled down to fit within max_dim, preserving aspect ratio."""
+    if width <= max_dim and height <= max_dim:
+        return (width, height)
+    if width > height:
+        return (max_dim, max(1, int(height * (max_dim / width))))
+    return (max(1, int(width * (max_dim / height))), max_dim)
+
+
+def render_image(input_path: str, output_path: str, max_dim: int,
+                 image_format: str | None = None) -> tuple[int, int]:
     """
-    Resize image if larger than max_dim, preserving aspect ratio.
-    Returns (width, height) of the output image.
+    Write the image at input_path to output_path, scaled down to fit max_dim
+    and converted to image_format if given. Returns the written (width, height).
     """
-    if not WAND_AVAILABLE:
-        # Just copy if Wand not available
-        import shutil
-        shutil.copy(input_path, output_path)
-        return (0, 0)
-
     with Image(filename=input_path) as img:
         # Auto-orient based on EXIF
         img.auto_orient()
 
-        width, height = img.width, img.height
-
-        # Resize if too large
-        if width > max_dim or height > max_dim:
-            if width > height:
-                new_width = max_dim
-                new_height = int(height * (max_dim / width))
-            else:
-                new_height = max_dim
-                new_width = int(width * (max_dim / height))
-            img.resize(new_width, new_height)
-            width, height = new_width, new_height
-
+        width, height = fit_within(img.width, img.height, max_dim)
+        if (width, height) != (img.width, img.height):
+            img.resize(width, height)
+        if image_format:
+            img.format = image_format
         img.save(filename=output_path)
         return (width, height)
 
 
-def generate_thumbnail(input_path: str, output_path: str, size: int = THUMBNAIL_SIZE) -> bool:
-    """Generate a thumbnail. Returns True if successful."""
-    if not WAND_AVAILABLE:
-        return False
+_image_pool = None
+_image_pool_lock = threading.Lock()
 
-    try:
-        with Image(filename=input_path) as img:
-            img.auto_orient()
-
-            # Calculate thumbnail dimensions (fit within size x size)
-            width, height = img.width, img.height
-            if width > height:
-                new_width = size
-                new_height = int(height * (size / width))
-            else:
-                new_height = size
-                new_width = int(width * (size / height))
 
-            img.resize(new_width, new_height)
+def get_image_pool() -> ThreadPoolExecutor:
+    """The process' image worker pool, started on first use (after forking)."""
+    global _image_pool
+    with _image_pool_lock:
+        if _image_pool is None:
+            _image_pool = ThreadPoolExecutor(IMAGE_WORKERS, thread_name_prefix="inventorius-images")
+        return _image_pool
 
-            # Convert to PNG for consistent thumbnail format
-            img.format = 'png'
-            ensure_dir(output_path)
-            img.save(filename=output_path)
-            return True
-    except WandException as e:
-        print(f"Thumbnail generation failed: {e}")
-        return False
 
+def process_upload(database, blob_id: str) -> None:
+    """
+    Resize a stored image blob in place, then clear its `processing` flag.
+    If the blob lost its last reference in the meantime, it is removed again.
+    Renditions are generated later, when requested (see find_rendition).
 
-@files.route('/api/files', methods=['POST'])
-@no_cache
-def files_post():
+    The blob is claimed first, so of several jobs queued for it (by requeue or
+    `flask process-pending-files`) only one resizes it, and none once it is
+    done. A claim older than UPLOAD_PROCESSING_TIMEOUT is taken over.
     """
-    Upload a file.
+    claim = uuid.uuid4().hex
+    now = time.time()
+    claimed = database.blobs.update_one(
+        {"_id": blob_id, "processing": True, "$or": [
+            {"processing_claim": {"$exists": False}},
+            {"processing_since": {"$lt": now - UPLOAD_PROCESSING_TIMEOUT}},
+        ]},
+        {"$set": {"processing_claim": claim, "processing_since": now}})
+    if not claimed.modified_count:
+        return
+
+    file_path = get_file_path(blob_id)
+    temp_path = f"{file_path}.{claim}.tmp"
+    width, height = None, None
 
-    Expects multipart/form-data with 'file' field.
-    Returns file metadata including ID for future reference.
+    try:
+        width, height = render_image(file_path, temp_path, MAX_IMAGE_DIMENSION)
+        if database.blobs.find_one({"_id": blob_id, "processing_claim": claim}, {"_id": 1}):
+            os.replace(temp_path, file_path)
+    except Exception as e:
+        # If processing fails, just keep the original
+        print(f"Image processing failed: {e}")
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+
+    result = database.blobs.update_one(
+        {"_id": blob_id, "processing": True, "processing_claim": claim},
+        {"$set": {
+            "processing": False,
+            "size": os.path.getsize(file_path) if os.path.exists(file_path) else 0,
+            "sha256": file_sha256(file_path) if os.path.exists(file_path) else None,
+            "width": width,
+            "height": height,
+        },
+         "$unset": {"processing_since": "", "processing_claim": ""}})
+    if result.matched_count == 0 and database.blobs.find_one({"_id": blob_id}) is None:
+        remove_file_data(blob_id)
+
+
+def remove_file_data(blob_id: str) -> None:
+    """Remove a blob and all its renditions from disk."""
+    paths = [get_file_path(blob_id), get_thumb_path(blob_id)]
+    paths += [get_rendition_path(blob_id, name) for name in RENDITION_SPECS]
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+# admin doc holding the total size of the cached renditions
+RENDITION_CACHE_TOTAL = "rendition_cache"
+
+# rendition key -> Event set when this process has finished generating it
+_renditions_generating = {}
+_renditions_generating_lock = threading.Lock()
+
+
+class RenditionPending(Exception):
+    """A rendition another request is still generating after RENDITION_WAIT."""
+
+
+def add_rendition_bytes(database, size: int) -> int:
+    """Add to the total size of the cached renditions, returning the new total."""
+    doc = database.admin.find_one_and_update(
+        {"_id": RENDITION_CACHE_TOTAL}, {"$inc": {"size": size}},
+        upsert=True, return_document=ReturnDocument.AFTER)
+    return doc["size"]
+
+
+def drop_rendition_entries(database, query: dict) -> list[dict]:
+    """Delete the rendition cache entries matching `query`, taking their size
+    off the cache total. Returns the deleted entries."""
+    dropped = []
+    for entry in database.renditions.find(query, {"_id": 1}):
+        entry = database.renditions.find_one_and_delete({**query, "_id": entry["_id"]})
+        if entry:
+            dropped.append(entry)
+            if entry["size"]:
+                add_rendition_bytes(database, -entry["size"])
+    return dropped
+
+
+def find_rendition(database, blob_id: str, name: str) -> dict | None:
+    """
+    The cache entry of a rendition of an image blob, generating the rendition
+    if it isn't cached. Returns None if it can't be generated.
 
-    TODO: Add @login_required for authentication
+    Concurrent requests for a missing rendition, in any worker, are coalesced:
+    the first one claims its entry and renders it, the others wait for that,
+    for at most RENDITION_WAIT seconds before raising RenditionPending.
+    """
+    key = f"{blob_id}/{name}"
+    deadline = time.monotonic() + RENDITION_WAIT
+    delay = RENDITION_POLL_DELAY
+    while True:
+        entry = database.renditions.find_one({"_id": key})
+        now = time.time()
+        if entry is None:
+            try:
+                database.renditions.insert_one({
+                    "_id": key, "blob": blob_id, "name": name,
+                    "generating": True, "size": 0, "last_used": now,
+                })
+            except DuplicateKeyError:
+                continue
+            done = threading.Event()
+            with _renditions_generating_lock:
+                _renditions_generating[key] = done
+            try:
+                return generate_rendition(database, key, blob_id, name)
+            finally:
+                with _renditions_generating_lock:
+                    del _renditions_generating[key]
+                done.set()
+
+        if entry["generating"]:
+            if now - entry["last_used"] > RENDITION_TIMEOUT:
+                # whoever claimed it died
+                drop_rendition_entries(
+                    database, {"_id": key, "generating": True, "last_used": entry["last_used"]})
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise RenditionPending(key)
+            done = _renditions_generating.get(key)
+            if done:
+                done.wait(remaining)
+            else:
+                time.sleep(min(delay, remaining))
+                delay = min(delay * 2, RENDITION_MAX_POLL_DELAY)
+        elif entry.get("failed"):
+            if now - entry["last_used"] <= RENDITION_RETRY_FAILED:
+                return None
+            drop_rendition_entries(database, {"_id": key, "failed": True, "last_used": entry["last_used"]})
+        elif not os.path.exists(get_rendition_path(blob_id, name)):
+            drop_rendition_entries(
+                database, {"_id": key, "generating": False, "last_used": entry["last_used"]})
+        else:
+            if now - entry["last_used"] > RENDITION_TOUCH_INTERVAL:
+                database.renditions.update_one(
+                    {"_id": key, "generating": False}, {"$set": {"last_used": now}})
+            return entry
+
+
+def generate_rendition(database, key: str, blob_id: str, name: str) -> dict | None:
     """
-    if 'file' not in request.files:
-        return problem.invalid_params_response_simple("file", "No file provided")
+    Render a rendition claimed by find_rendition and record it as cached.
 
-    file = request.files['file']
+    A rendition that can't be rendered (e.g. a format Wand can't write) is
+    recorded as failed, on its entry and in the `failed_renditions` of the
+    blob, so it is neither rendered again nor listed in the file metadata.
+    """
+    size, image_format = RENDITION_SPECS[name]
+    path = get_rendition_path(blob_id, name)
+    temp_path = path + ".tmp"
+    try:
+        # one left by a version that generated renditions on upload is kept
+        if not os.path.exists(path):
+            ensure_dir(path)
+            render_image(get_file_path(blob_id), temp_path, size, image_format)
+            os.replace(temp_path, path)
+        entry = {
+            "generating": False,
+            "size": os.path.getsize(path),
+            "sha256": file_sha256(path),
+            "content_type": RENDITION_TYPES.get(image_format, "application/octet-stream"),
+            "last_used": time.time(),
+        }
+    except Exception as e:
+        print(f"Rendition '{name}' of {blob_id} failed: {e}")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        database.renditions.update_one(
+            {"_id": key}, {"$set": {"generating": False, "failed": True, "last_used": time.time()}})
+        update_failed_renditions(database, blob_id, {}, {"$addToSet": {"failed_renditions": name}})
+        return None
+
+    database.renditions.update_one({"_id": key}, {"$set": entry})
+    update_failed_renditions(database, blob_id, {"failed_renditions": name},
+                             {"$pull": {"failed_renditions": name}})
+    total = add_rendition_bytes(database, entry["size"])
+    if total > RENDITION_CACHE_SIZE:
+        evict_renditions(database, total - RENDITION_CACHE_SIZE)
+    return entry
+
+
+def update_failed_renditions(database, blob_id: str, query: dict, update: dict) -> None:
+    """Update the `failed_renditions` list in the metadata of a blob."""
+    database.blobs.update_one({"_id": blob_id, **query}, update)
+    # stored under its file ID, before migrate-file-blobs
+    database.files.update_one({"_id": blob_id, "blob": {"$exists": False}, **query}, update)
+
+
+def evict_renditions(database, excess: int) -> None:
+    """Remove at least `excess` bytes of the least recently used renditions."""
+    while excess > 0:
+        entries = list(database.renditions.find({"generating": False, "failed": {"$ne": True}})
+                       .sort("last_used", ASCENDING).limit(RENDITION_EVICT_BATCH))
+        if not entries:
+            return
+        for entry in entries:
+            # claimed like a rendition being generated, so readers wait rather
+            # than find it half removed
+            claimed = database.renditions.update_one(
+                {"_id": entry["_id"], "generating": False, "last_used": entry["last_used"]},
+                {"$set": {"generating": True, "last_used": time.time()}})
+            if not claimed.modified_count:
+                continue
+            path = get_rendition_path(entry["blob"], entry["name"])
+            if os.path.exists(path):
+                os.remove(path)
+            drop_rendition_entries(database, {"_id": entry["_id"], "generating": True})
+            excess -= entry["size"]
+            if excess <= 0:
+                return
+
+
+def remove_renditions(database, blob_id: str) -> None:
+    """Remove the cached renditions of a blob."""
+    for entry in drop_rendition_entries(database, {"blob": blob_id}):
+        path = get_rendition_path(blob_id, entry["name"])
+        if os.path.exists(path):
+            os.remove(path)
+
+
+# blobs queued in this process' image pool and not processed yet
+_queued_uploads = set()
+_queued_uploads_lock = threading.Lock()
+
+
+def submit_upload_processing(database, blob_id: str) -> None:
+    """Queue an image blob for process_upload."""
+    if IMAGE_WORKERS > 0:
+        with _queued_uploads_lock:
+            _queued_uploads.add(blob_id)
+        get_image_pool().submit(process_queued_upload, database, blob_id)
+    else:
+        process_upload(database, blob_id)
 
-    if file.filename == '':
-        return problem.invalid_params_response_simple("file", "No file selected")
 
-    # Check file size
-    file.seek(0, 2)  # Seek to end
-    size = file.tell()
-    file.seek(0)  # Seek back to start
+def process_queued_upload(database, blob_id: str) -> None:
+    try:
+        process_upload(database, blob_id)
+    finally:
+        with _queued_uploads_lock:
+            _queued_uploads.discard(blob_id)
 
-    if size > MAX_UPLOAD_SIZE:
-        return problem.invalid_params_response_simple(
-            "file",
-            f"File too large. Maximum size is {MAX_UPLOAD_SIZE // (1024*1024)}MB"
-        )
 
-    # Detect and validate MIME type
-    content_type = detect_mime_type(file.stream)
-    if content_type not in ALLOWED_TYPES:
-        return problem.invalid_params_response_simple(
-            "file",
-            f"File type not allowed. Allowed types: {', '.join(ALLOWED_TYPES)}"
-        )
+def process_pending_uploads(database, echo=print) -> None:
+    """Process blobs left `processing`, e.g. queued when a worker exited."""
+    for blob in database.blobs.find({"processing": True}, {"_id": 1}):
+        echo(f"processing {blob['_id']}")
+        process_upload(database, blob["_id"])
 
-    # Generate file ID
-    file_id = str(uuid.uuid4())
 
-    # Determine paths
-    file_path = get_file_path(file_id)
-    thumb_path = get_thumb_path(file_id)
+# when this process last looked for lost uploads, by database name
+_stale_uploads_checked = {}
 
-    # Save file
-    ensure_dir(file_path)
 
-    is_image = content_type in IMAGE_TYPES
-    width, height = None, None
-    has_thumbnail = False
+def requeue_stale_uploads(database) -> None:
+    """
+    Queue again the blobs still `processing` UPLOAD_PROCESSING_TIMEOUT seconds
+    after they were queued or started, e.g. by a worker that exited since.
+    Called before every request, it looks at most every half timeout. Blobs
+    still waiting in this process' pool are left there. Each blob is taken by
+    moving its `processing_since` and dropping the old claim, so one worker
+    queues it.
+    """
+    now = time.time()
+    if now - _stale_uploads_checked.get(database.name, 0) < UPLOAD_PROCESSING_TIMEOUT / 2:
+        return
+    _stale_uploads_checked[database.name] = now
+    stale = {"processing": True, "$or": [
+        {"processing_since": {"$exists": False}},
+        {"processing_since": {"$lt": now - UPLOAD_PROCESSING_TIMEOUT}},
+    ]}
+    for blob in database.blobs.find(stale, {"_id": 1}):
+        with _queued_uploads_lock:
+            if blob["_id"] in _queued_uploads:
+                continue
+        claimed = database.blobs.update_one({"_id": blob["_id"], **stale},
+                                            {"$set": {"processing_since": now},
+                                             "$unset": {"processing_claim": ""}})
+        if claimed.modified_count:
+            submit_upload_processing(database, blob["_id"])
+
+
+class UploadRejected(Exception):
+    """An upload refused while it was being received."""
+
+
+class UploadWriter:
+    """
+    Writes an upload to a temporary file as it arrives, hashing it, enforcing
+    MAX_UPLOAD_SIZE and checking its type from the first bytes.
+    """
 
-    if is_image and WAND_AVAILABLE:
-        # Save to temp, process, then move
-        temp_path = file_path + ".tmp"
-        file.save(temp_path)
+    def __init__(self):
+        self.temp_path = os.path.join(UPLOADS_PATH, "tmp", str(uuid.uuid4()))
+        ensure_dir(self.temp_path)
+        self.file = open(self.temp_path, "wb")
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.head = b""
+        self.content_type = None
+
+    def write(self, data: bytes) -> None:
+        self.size += len(data)
+        if self.size > MAX_UPLOAD_SIZE:
+            raise UploadRejected(f"File too large. Maximum size is {MAX_UPLOAD_SIZE // (1024*1024)}MB")
+        if self.content_type is None:
+            self.head += data[:MIME_SNIFF_SIZE - len(self.head)]
+            if len(self.head) == MIME_SNIFF_SIZE:
+                self.sniff()
+        self.digest.update(data)
+        self.file.write(data)
+
+    def sniff(self) -> None:
+        self.content_type = detect_mime_type(io.BytesIO(self.head))
+        if self.content_type not in ALLOWED_TYPES:
+            raise UploadRejected(f"File type not allowed. Allowed types: {', '.join(ALLOWED_TYPES)}")
+
+    def finish(self) -> None:
+        self.file.close()
+        if self.content_type is None:
+            self.sniff()
+
+    @property
+    def sha256(self) -> str:
+        return self.digest.hexdigest()
+
+    def discard(self) -> None:
+        self.file.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+def receive_upload(field_name: str) -> tuple[str, UploadWriter]:
+    """
+    Stream the `field_name` file of a multipart/form-data request to disk,
+    one chunk at a time. Werkzeug's form parsing (request.files) would spool
+    the whole body first. Returns (client filename, finished UploadWriter).
+    """
+    mimetype, options = parse_options_header(request.headers.get("Content-Type", ""))
+    if mimetype != "multipart/form-data" or "boundary" not in options:
+        raise UploadRejected("No file provided")
+    if (request.content_length or 0) > MAX_UPLOAD_SIZE + MAX_FORM_OVERHEAD:
+        raise UploadRejected(f"File too large. Maximum size is {MAX_UPLOAD_SIZE // (1024*1024)}MB")
+
+    decoder = MultipartDecoder(options["boundary"].encode())
+    filename, upload, receiving = None, None, False
+    try:
+        while True:
+            chunk = request.stream.read(UPLOAD_CHUNK_SIZE)
+            decoder.receive_data(chunk or None)
+            event = decoder.next_event()
+            while not isinstance(event, (NeedData, Epilogue)):
+                if isinstance(event, File):
+                    receiving = event.name == field_name and upload is None
+                    if receiving:
+                        filename = event.filename
+                        if not filename:
+                            raise UploadRejected("No file selected")
+                        upload = UploadWriter()
+                elif isinstance(event, Field):
+                    receiving = False
+                elif isinstance(event, Data) and receiving:
+                    upload.write(event.data)
+                event = decoder.next_event()
+            if isinstance(event, Epilogue) or not chunk:
+                break
+        if upload is None:
+            raise UploadRejected("No file provided")
+        upload.finish()
+    except ValueError as e:
+        # malformed multipart body
+        if upload:
+            upload.discard()
+        raise UploadRejected(f"Malformed upload: {e}")
+    except BaseException:
+        if upload:
+            upload.discard()
+        raise
+    return filename, upload
+
+
+def add_blob_reference(database, blob_id: str, temp_path: str, size: int, is_image: bool) -> bool:
+    """
+    Count a reference to the blob with the content saved at temp_path,
+    storing it if it is new. Returns True if it was new.
 
+    A blob whose last reference is being released is marked `deleting` until
+    its files are gone; a new reference waits for that and stores it again.
+    """
+    processing = is_image and WAND_AVAILABLE
+    for _ in range(BLOB_RETRIES):
         try:
-            width, height = process_image(temp_path, file_path, MAX_IMAGE_DIMENSION)
-            os.remove(temp_path)
-
-            # Generate thumbnail
-            has_thumbnail = generate_thumbnail(file_path, thumb_path)
-        except Exception as e:
-            # If processing fails, just save the original
-            os.rename(temp_path, file_path)
-            print(f"Image processing failed: {e}")
+            previous = database.blobs.find_one_and_update(
+                {"_id": blob_id, "deleting": {"$ne": True}},
+                {"$inc": {"refcount": 1},
+                 "$setOnInsert": {
+                     "processing": processing,
+                     **({"processing_since": time.time()} if processing else {}),
+                     "size": size,
+                     "sha256": blob_id,
+                     "width": None,
+                     "height": None,
+                 }},
+                upsert=True, return_document=ReturnDocument.BEFORE)
+            break
+        except DuplicateKeyError:
+            time.sleep(BLOB_RETRY_DELAY)
     else:
-        # Non-image or no Wand: save directly
-        file.save(file_path)
+        os.remove(temp_path)
+        raise RuntimeError(f"blob {blob_id} stayed marked for deletion")
+
+    if previous is None:
+        file_path = get_file_path(blob_id)
+        ensure_dir(file_path)
+        os.replace(temp_path, file_path)
+        return True
+    os.remove(temp_path)
+    return False
+
+
+def release_blob(database, blob_id: str) -> None:
+    """Drop a reference to a blob, removing it with its last reference."""
+    blob = database.blobs.find_one_and_update(
+        {"_id": blob_id}, {"$inc": {"refcount": -1}}, return_document=ReturnDocument.AFTER)
+    if blob is None or blob["refcount"] > 0:
+        return
+    claimed = database.blobs.update_one(
+        {"_id": blob_id, "refcount": {"$lte": 0}, "deleting": {"$ne": True}},
+        {"$set": {"deleting": True}})
+    if claimed.modified_count:
+        remove_file_data(blob_id)
+        remove_renditions(database, blob_id)
+        database.blobs.delete_one({"_id": blob_id})
+
+
+def merge_blob(metadata: dict, blob: dict | None) -> dict | None:
+    """
+    File metadata with the content metadata of its blob added.
+
+    A file stored under its own ID, before migrate-file-blobs, keeps its
+    content metadata itself and is served as the blob named by its ID.
+    """
+    if "blob" not in metadata:
+        return {**metadata, "blob": metadata["_id"]}
+    if blob is None:
+        return None
+    blob = {k: v for k, v in blob.items() if k not in ("_id", "refcount", "deleting")}
+    return {**metadata, **blob}
+
+
+def find_files(ids: list[str]) -> dict[str, dict]:
+    """Merged metadata of the files in `ids` that exist, by ID, in one query."""
+    found = {}
+    for metadata in db.files.aggregate([
+        {"$match": {"_id": {"$in": ids}}},
+        {"$lookup": {"from": "blobs", "localField": "blob", "foreignField": "_id", "as": "blobs"}},
+    ]):
+        blobs = metadata.pop("blobs")
+        merged = merge_blob(metadata, blobs[0] if blobs else None)
+        if merged:
+            found[merged["_id"]] = merged
+    return found
+
+
+def find_file(id: str) -> dict | None:
+    """File metadata merged with the metadata of its blob."""
+    metadata = db.files.find_one({"_id": id})
+    if metadata is None:
+        return None
+    blob = db.blobs.find_one({"_id": metadata["blob"]}) if "blob" in metadata else None
+    return merge_blob(metadata, blob)
+
+
+@files.route('/api/files', methods=['POST'])
+@no_cache
+def files_post():
+    """
+    Upload a file.
+
+    Expects multipart/form-data with 'file' field.
+    Returns file metadata including ID for future reference.
+
+    TODO: Add @login_required for authentication
+    """
+    try:
+        filename, upload = receive_upload("file")
+    except UploadRejected as e:
+        return problem.invalid_params_response_simple("file", str(e))
+    content_type = upload.content_type
+
+    # Generate file ID
+    file_id = str(uuid.uuid4())
 
-    # Get final file size
-    final_size = os.path.getsize(file_path)
+    # Store the upload under its content hash. Identical uploads share one
+    # blob; new images are processed after the response.
+    blob_id = upload.sha256
+    is_image = content_type in IMAGE_TYPES
+    database = db._get_current_object()
+    if add_blob_reference(database, blob_id, upload.temp_path, upload.size, is_image):
+        if is_image and WAND_AVAILABLE:
+            submit_upload_processing(database, blob_id)
+    blob = db.blobs.find_one({"_id": blob_id}, {"processing": 1, "size": 1})
+    processing = blob["processing"]
+    final_size = blob["size"]
 
     # Store metadata in MongoDB
     metadata = {
         "_id": file_id,
-        "original_filename": secure_filename(file.filename),
+        "blob": blob_id,
+        "original_filename": secure_filename(filename),
         "content_type": content_type,
-        "size": final_size,
         "uploaded_at": datetime.now(timezone.utc),
         "uploaded_by": None,  # TODO: get from current_user when auth added
         "is_image": is_image,
-        "has_thumbnail": has_thumbnail,
-        "width": width,
-        "height": height,
     }
 
     db.files.insert_one(metadata)
@@ -253,9 +798,10 @@ def files_post():
         "content_type": content_type,
         "size": final_size,
         "is_image": is_image,
+        "processing": processing,
     }
 
-    if has_thumbnail:
+    if is_image and WAND_AVAILABLE:
         state["thumbnail_url"] = url_for("files.file_thumb_get", id=file_id)
 
     response = Response()
@@ -284,15 +830,10 @@ def file_get(id):
         return problem.missing_resource_response("file", id)
 
     # Check if file exists in DB
-    metadata = db.files.find_one({"_id": id})
+    metadata = find_file(id)
     if not metadata:
         return problem.missing_resource_response("file", id)
 
-    # Check if file exists on disk
-    file_path = get_file_path(id)
-    if not os.path.exists(file_path):
-        return problem.missing_resource_response("file", id)
-
     # Determine Content-Disposition
     is_image = metadata.get("is_image", False)
     filename = metadata.get("original_filename", "file")
@@ -302,16 +843,87 @@ def file_get(id):
     else:
         disposition = f"attachment; filename=\"{filename}\""
 
-    response = send_file(
-        file_path,
-        mimetype=metadata.get("content_type", "application/octet-stream"),
+    # While processing, the file is replaced by the resized image once done
+    response = send_stored_file(
+        get_file_path(metadata["blob"]),
+        metadata.get("content_type", "application/octet-stream"),
+        metadata.get("sha256"),
+        cacheable=not metadata.get("processing"),
     )
+    if response is None:
+        return problem.missing_resource_response("file", id)
     response.headers["Content-Disposition"] = disposition
-    response.headers["Cache-Control"] = "public, max-age=31536000"  # 1 year (immutable content)
 
     return response
 
 
+def has_renditions(metadata: dict) -> bool:
+    """Whether renditions of a file can be served (they are generated on request)."""
+    return WAND_AVAILABLE and metadata.get("is_image", False) and not metadata.get("processing")
+
+
+def file_meta_state(metadata: dict) -> dict:
+    """The /meta representation of merged file metadata (see find_file)."""
+    id = metadata["_id"]
+    width, height = metadata.get("width"), metadata.get("height")
+    renditions = {}
+    failed = metadata.get("failed_renditions", [])
+    if has_renditions(metadata):
+        for name, (size, image_format) in RENDITION_SPECS.items():
+            if name in failed:
+                continue
+            rendition_width, rendition_height = fit_within(width, height, size) if width else (None, None)
+            renditions[name] = {
+                "width": rendition_width,
+                "height": rendition_height,
+                "content_type": RENDITION_TYPES.get(image_format, "application/octet-stream"),
+                "url": url_for("files.file_rendition_get", id=id, name=name),
+            }
+    state = {
+        "id": id,
+        "original_filename": metadata.get("original_filename", "file"),
+        "content_type": metadata.get("content_type", "application/octet-stream"),
+        "size": metadata.get("size", 0),
+        "sha256": metadata.get("sha256"),
+        "is_image": metadata.get("is_image", False),
+        "processing": metadata.get("processing", False),
+        "has_thumbnail": has_renditions(metadata) and "thumb" not in failed,
+        "width": width,
+        "height": height,
+        "renditions": renditions,
+    }
+    if state["processing"] or state["has_thumbnail"]:
+        state["thumbnail_url"] = url_for("files.file_thumb_get", id=id)
+    return state
+
+
+@files.route('/api/files/meta', methods=['POST'])
+@no_cache
+def files_meta_post():
+    """
+    Get the metadata of many files at once.
+
+    Expects {"ids": [file IDs]}, at most MAX_META_BATCH of them.
+    Returns {"files": {id: metadata}}, with null for unknown files.
+    """
+    ids = (request.get_json(silent=True) or {}).get("ids")
+    if not isinstance(ids, list) or not all(isinstance(id, str) for id in ids):
+        return problem.invalid_params_response_simple("ids", "must be a list of file IDs")
+    if len(ids) > MAX_META_BATCH:
+        return problem.invalid_params_response_simple(
+            "ids", f"at most {MAX_META_BATCH} files per request")
+
+    found = find_files(ids)
+    import json
+    response = Response()
+    response.status_code = 200
+    response.mimetype = "application/json"
+    response.data = json.dumps({"files": {
+        id: file_meta_state(found[id]) if id in found else None for id in ids
+    }})
+    return response
+
+
 @files.route('/api/files/<id>/meta', methods=['GET'])
 def file_meta_get(id):
     """Get file metadata as JSON."""
@@ -322,7 +934,7 @@ def file_meta_get(id):
         return problem.missing_resource_response("file", id)
 
     # Check if file exists in DB
-    metadata = db.files.find_one({"_id": id})
+    metadata = find_file(id)
     if not metadata:
         return problem.missing_resource_response("file", id)
 
@@ -330,40 +942,80 @@ def file_meta_get(id):
     response = Response()
     response.status_code = 200
     response.mimetype = "application/json"
-    response.data = json.dumps({
-        "id": metadata["_id"],
-        "original_filename": metadata.get("original_filename", "file"),
-        "content_type": metadata.get("content_type", "application/octet-stream"),
-        "size": metadata.get("size", 0),
-        "is_image": metadata.get("is_image", False),
-        "has_thumbnail": metadata.get("has_thumbnail", False),
-        "width": metadata.get("width"),
-        "height": metadata.get("height"),
-    })
-    response.headers["Cache-Control"] = "public, max-age=3600"  # 1 hour
+    response.data = json.dumps(file_meta_state(metadata))
+    if metadata.get("processing"):
+        response.headers["Cache-Control"] = "no-cache"
+    else:
+        response.headers["Cache-Control"] = "public, max-age=3600"  # 1 hour
     return response
 
 
+def redirect_to_original(metadata: dict):
+    """Stand in for a rendition that isn't ready yet with the original image."""
+    response = redirect(url_for("files.file_get", id=metadata["_id"]))
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+def send_rendition(metadata: dict, name: str):
+    """Serve a rendition of a file, generating it if it isn't cached."""
+    if metadata.get("processing"):
+        # Not resized yet
+        return redirect_to_original(metadata)
+    if not has_renditions(metadata):
+        return None
+
+    try:
+        entry = find_rendition(db._get_current_object(), metadata["blob"], name)
+    except RenditionPending:
+        return redirect_to_original(metadata)
+    if entry is None:
+        return None
+    return send_stored_file(get_rendition_path(metadata["blob"], name), entry["content_type"],
+                            entry["sha256"])
+
+
 @files.route('/api/files/<id>/thumb', methods=['GET'])
 def file_thumb_get(id):
-    """Serve a thumbnail by file ID."""
+    """
+    Serve a thumbnail by file ID.
+
+    Optional ?size= picks the maximum dimension, one of THUMBNAIL_SIZES
+    (default THUMBNAIL_SIZE).
+    """
     # Validate ID format
     try:
         uuid.UUID(id)
     except ValueError:
         return problem.missing_resource_response("thumbnail", id)
 
-    # Check if file has thumbnail
-    metadata = db.files.find_one({"_id": id})
-    if not metadata or not metadata.get("has_thumbnail"):
-        return problem.missing_resource_response("thumbnail", id)
+    size = request.args.get("size", str(THUMBNAIL_SIZE))
+    if not size.isdigit() or int(size) not in THUMBNAIL_SIZES:
+        return problem.invalid_params_response_simple(
+            "size", f"must be one of {', '.join(map(str, THUMBNAIL_SIZES))}")
 
-    thumb_path = get_thumb_path(id)
-    if not os.path.exists(thumb_path):
+    metadata = find_file(id)
+    response = send_rendition(metadata, thumbnail_rendition(int(size))) if metadata else None
+    if response is None:
         return problem.missing_resource_response("thumbnail", id)
 
-    response = send_file(thumb_path, mimetype="image/png")
-    response.headers["Cache-Control"] = "public, max-age=31536000"
+    return response
+
+
+@files.route('/api/files/<id>/renditions/<name>', methods=['GET'])
+def file_rendition_get(id, name):
+    """Serve a scaled copy of an image, as listed in its metadata."""
+    try:
+        uuid.UUID(id)
+    except ValueError:
+        return problem.missing_resource_response("rendition", id)
+
+    metadata = find_file(id)
+    response = None
+    if metadata and name in RENDITION_SPECS:
+        response = send_rendition(metadata, name)
+    if response is None:
+        return problem.missing_resource_response("rendition", f"{id}/{name}")
 
     return response
 
@@ -382,22 +1034,17 @@ def file_delete(id):
     except ValueError:
         return problem.missing_resource_response("file", id)
 
-    # Check if file exists
-    metadata = db.files.find_one({"_id": id})
+    # Delete from MongoDB, and the blob from the filesystem if this was its
+    # last reference
+    metadata = db.files.find_one_and_delete({"_id": id})
     if not metadata:
         return problem.missing_resource_response("file", id)
-
-    # Delete from filesystem
-    file_path = get_file_path(id)
-    thumb_path = get_thumb_path(id)
-
-    if os.path.exists(file_path):
-        os.remove(file_path)
-    if os.path.exists(thumb_path):
-        os.remove(thumb_path)
-
-    # Delete from MongoDB
-    db.files.delete_one({"_id": id})
+    if "blob" in metadata:
+        release_blob(db._get_current_object(), metadata["blob"])
+    else:
+        # stored by file ID, before migrate-file-blobs
+        remove_file_data(id)
+        remove_renditions(db._get_current_object(), id)
 
     response = Response()
     response.status_code = 200
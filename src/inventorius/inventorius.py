@@ -1,15 +1,19 @@
-from inventorius.util import getIntArgs, admin_get_next
+from inventorius.util import getIntArgs, admin_get_next, admin_reserve_codes, contents_inc, contents_unset, totals_inc
 from flask import Blueprint, request, Response, url_for
 from voluptuous.error import MultipleInvalid
 from inventorius.data_models import Bin, Sku, Batch, DataModelJSONEncoder as Encoder
-from inventorius.db import db
-from inventorius.validation import item_move_schema, item_release_receive_schema, validate_url_id
+from inventorius.db import AbortTransaction, db, has_indexes, run_in_transaction
+from inventorius.validation import bulk_release_receive_schema, item_move_schema, item_release_receive_schema, validate_url_id
 import inventorius.util_error_responses as problem
 import inventorius.util_success_responses as success
 from inventorius.util import no_cache
+import inventorius.resource_operations as operations
 
+import base64
 import json
 
+from pymongo import ReturnDocument, UpdateOne
+
 inventorius = Blueprint("inventorius", __name__)
 
 
@@ -68,86 +72,106 @@ def move_bin_contents_put(id):
     destination = json['destination']
     quantity = json['quantity']
 
-    if not db.bin.find_one({"_id": id}):
+    def move(session):
+        # Only take the items if the source bin holds enough of them
+        source = db.bin.find_one_and_update(
+            {"_id": id, f"contents.{item_id}": {"$gte": quantity}},
+            contents_inc(item_id, -quantity),
+            projection={f"contents.{item_id}": 1},
+            return_document=ReturnDocument.AFTER,
+            session=session)
+        if source is None:
+            raise AbortTransaction(move_failed_response(id, item_id, quantity, session))
+
+        destination_before = db.bin.find_one_and_update(
+            {"_id": destination},
+            contents_inc(item_id, quantity),
+            projection={f"contents.{item_id}": 1},
+            session=session)
+        if destination_before is None:
+            if session is None:
+                # no transaction to roll back, put the items back
+                db.bin.update_one({"_id": id}, contents_inc(item_id, quantity))
+            raise AbortTransaction(problem.missing_bin_response(destination))
+
+        # units held don't change, but the number of bins holding them may
+        bins = 0 if item_id in destination_before.get("contents", {}) else 1
+        if source["contents"][item_id] == 0:
+            bins -= db.bin.update_one({"_id": id, f"contents.{item_id}": 0},
+                                      contents_unset(item_id),
+                                      session=session).modified_count
+        if bins:
+            db.totals.update_one({"_id": item_id}, totals_inc(0, bins),
+                                 upsert=True, session=session)
+        return success.moved_response()
+
+    return run_in_transaction(move)
+
+
+def move_failed_response(id, item_id, quantity, session=None):
+    """Work out why the guarded update in a move did not match the source bin."""
+    source = db.bin.find_one({"_id": id}, {f"contents.{item_id}": 1}, session=session)
+    if not source:
         return problem.missing_bin_response(id)
-    if not db.bin.find_one({"_id": destination}):
-        return problem.missing_bin_response(destination)
 
     if item_id.startswith("SKU"):
-        if not db.sku.find_one({"_id": item_id}):
+        if not db.sku.find_one({"_id": item_id}, {"_id": 1}, session=session):
             return problem.missing_sku_response(item_id)
     elif item_id.startswith("BAT"):
-        if not db.batch.find_one({"_id": item_id}):
+        if not db.batch.find_one({"_id": item_id}, {"_id": 1}, session=session):
             return problem.missing_batch_response(item_id)
 
-    availible_quantity = Bin.from_mongodb_doc(
-        db.bin.find_one({"_id": id})).contents.get(item_id, 0)
-    if availible_quantity < quantity:
-        return problem.move_insufficient_quantity(
-            name="quantity", availible=availible_quantity, requested=quantity)
+    availible_quantity = source.get("contents", {}).get(item_id, 0)
+    return problem.move_insufficient_quantity(
+        name="quantity", availible=availible_quantity, requested=quantity)
 
-    db.bin.update_one({"_id": id},
-                      {"$inc": {f"contents.{item_id}": - quantity}})
-    db.bin.update_one({"_id": destination},
-                      {"$inc": {f"contents.{item_id}": quantity}})
-    db.bin.update_one({"_id": id, f"contents.{item_id}": 0},
-                      {"$unset": {f"contents.{item_id}": ""}})
 
-    return success.moved_response()
+MAX_RESERVE_COUNT = 10000
 
 
-@inventorius.route('/api/next/sku', methods=['GET'])
-def next_sku():
+def next_id_response(prefix, endpoint, create_endpoint, expects):
+    """Peek at the next unused ID, or reserve a block of them with ?count=N."""
+    if "count" in request.args:
+        count = getIntArgs(request.args, "count", 0)
+        if not 1 <= count <= MAX_RESERVE_COUNT:
+            return problem.invalid_params_response_simple(
+                "count", f"must be an integer between 1 and {MAX_RESERVE_COUNT}")
+        state = admin_reserve_codes(prefix, count)
+    else:
+        state = admin_get_next(prefix)
+
     resp = Response()
-    resp.status_code == 200
+    resp.status_code = 200
     resp.mimetype = "application/json"
     resp.data = json.dumps({
-        "Id": url_for("inventorius.next_sku"),
-        "state": admin_get_next("SKU"),
+        "Id": url_for(endpoint),
+        "state": state,
         "operations": [{
             "rel": "create",
             "method": "POST",
-            "href": url_for("sku.skus_post"),
-            "Expects-a": "Sku patch",
+            "href": url_for(create_endpoint),
+            "Expects-a": expects,
         }]
     })
     return resp
 
 
+@inventorius.route('/api/next/sku', methods=['GET'])
+@no_cache
+def next_sku():
+    return next_id_response("SKU", "inventorius.next_sku", "sku.skus_post", "Sku patch")
+
+
 @inventorius.route('/api/next/batch', methods=['GET'])
+@no_cache
 def next_batch():
-    resp = Response()
-    resp.status_code == 200
-    resp.mimetype = "application/json"
-    resp.data = json.dumps({
-        "Id": url_for("inventorius.next_batch"),
-        "state": admin_get_next("BAT"),
-        "operations": [{
-            "rel": "create",
-            "method": "POST",
-            "href": url_for("batch.batches_post"),
-            "Expects-a": "Batch patch",
-        }]
-    })
-    return resp
+    return next_id_response("BAT", "inventorius.next_batch", "batch.batches_post", "Batch patch")
 
 
 @inventorius.route('/api/next/bin', methods=['GET'])
+@no_cache
 def next_bin():
-    resp = Response()
-    resp.status_code == 200
-    resp.mimetype = "application/json"
-    resp.data = json.dumps({
-        "Id": url_for("inventorius.next_bin"),
-        "state": admin_get_next("BIN"),
-        "operations": [{
-            "rel": "create",
-            "method": "POST",
-            "href": url_for("bin.bins_post"),
-            "Expects-a": "Bin patch",
-        }]
-    })
-    return resp
+    return next_id_response("BIN", "inventorius.next_bin", "bin.bins_post", "Bin patch")
 
 
 # @inventorius.route('/api/receive', methods=['POST'])
@@ -197,98 +221,306 @@ def bin_contents_post(bin_id):
     if quantity + old_quantity < 0:
         return problem.release_insufficient_quantity()
 
-    db.bin.update_one({"_id": bin_id},
-                        {"$inc": {f"contents.{item_id}": quantity}})
+    before = db.bin.find_one_and_update({"_id": bin_id},
+                                        contents_inc(item_id, quantity),
+                                        projection={f"contents.{item_id}": 1})
+    if before is None:
+        return problem.missing_bin_response(bin_id)
+    bins = 0 if item_id in before.get("contents", {}) else 1
 
-    db.bin.update_one({"_id": bin_id, f"contents.{item_id}": 0},
-                        {"$unset": {f"contents.{item_id}": ""}})
+    bins -= db.bin.update_one({"_id": bin_id, f"contents.{item_id}": 0},
+                              contents_unset(item_id)).modified_count
+    db.totals.update_one({"_id": item_id}, totals_inc(quantity, bins), upsert=True)
     return success.bin_contents_post_response(quantity)
 
 
 
+@inventorius.route('/api/bins/contents', methods=["POST"])
+@no_cache
+def bins_contents_post():
+    """Receive or release many items in one or more bins.
+
+    Each delta is checked like a single POST /api/bin/<bin_id>/contents, and
+    deltas that fail are reported without stopping the rest. Bins, skus and
+    batches are each looked up with one $in query.
+    """
+    try:
+        json = bulk_release_receive_schema(request.json)
+    except MultipleInvalid as e:
+        return problem.invalid_params_response(e)
+
+    deltas = json["deltas"]
+    bin_ids = list({delta["bin_id"] for delta in deltas})
+    item_ids = list({delta["id"] for delta in deltas})
+
+    def apply(session):
+        contents_projection = {f"contents.{item_id}": 1 for item_id in item_ids}
+        bins = {doc["_id"]: doc.get("contents", {}) for doc in db.bin.find(
+            {"_id": {"$in": bin_ids}}, contents_projection, session=session)}
+        items = {doc["_id"] for doc in db.sku.find(
+            {"_id": {"$in": [i for i in item_ids if i.startswith("SKU")]}}, {"_id": 1}, session=session)}
+        items.update(doc["_id"] for doc in db.batch.find(
+            {"_id": {"$in": [i for i in item_ids if i.startswith("BAT")]}}, {"_id": 1}, session=session))
+
+        results = []
+        net_deltas = {}  # (bin_id, item_id) -> accepted change
+        for delta in deltas:
+            bin_id, item_id, quantity = delta["bin_id"], delta["id"], delta["quantity"]
+            result = {"bin_id": bin_id, "id": item_id, "quantity": quantity}
+            results.append(result)
+
+            if bin_id not in bins:
+                result["type"] = "missing-resource"
+                result["invalid-params"] = [{"name": "bin_id", "reason": "must be an existing bin id"}]
+                continue
+            if item_id not in items:
+                result["type"] = "missing-resource"
+                result["invalid-params"] = [{"name": "id", "reason": "must be an existing sku or batch id"}]
+                continue
+            old_quantity = bins[bin_id].get(item_id, 0) + net_deltas.get((bin_id, item_id), 0)
+            if quantity + old_quantity < 0:
+                result["type"] = "insufficient-quantity"
+                result["invalid-params"] = [{
+                    "name": "quantity",
+                    "reason": f"requested {-quantity}, but only {old_quantity} is availible"}]
+                continue
+
+            net_deltas[(bin_id, item_id)] = net_deltas.get((bin_id, item_id), 0) + quantity
+            result["status"] = success.contents_change_status(quantity)
+
+        increments = []
+        for (bin_id, item_id), quantity in net_deltas.items():
+            # releases only apply if the bin still holds what was read above
+            guard = {f"contents.{item_id}": {"$gte": -quantity}} if quantity < 0 else {}
+            increments.append(UpdateOne({"_id": bin_id, **guard},
+                                        contents_inc(item_id, quantity)))
+        remove_empty = [UpdateOne({"_id": bin_id, f"contents.{item_id}": 0},
+                                  contents_unset(item_id))
+                        for (bin_id, item_id), quantity in net_deltas.items() if quantity <= 0]
+        applied = dict(net_deltas)
+
+        if session is not None:
+            if increments and db.bin.bulk_write(
+                    increments, session=session).matched_count < len(increments):
+                raise AbortTransaction(problem.concurrent_modification_response())
+        else:
+            # No transaction: apply each guarded release on its own so a
+            # release that loses a race is reported against its own delta.
+            receives = [op for op, quantity in zip(increments, net_deltas.values()) if quantity >= 0]
+            if receives:
+                db.bin.bulk_write(receives, ordered=False)
+            for (bin_id, item_id), quantity in net_deltas.items():
+                if quantity < 0 and db.bin.update_one(
+                        {"_id": bin_id, f"contents.{item_id}": {"$gte": -quantity}},
+                        contents_inc(item_id, quantity)).matched_count == 0:
+                    del applied[(bin_id, item_id)]
+                    for result in results:
+                        if (result["bin_id"], result["id"]) == (bin_id, item_id) and "status" in result:
+                            del result["status"]
+                            result["type"] = "concurrent-modification"
+
+        if remove_empty:
+            db.bin.bulk_write(remove_empty, ordered=False, session=session)
+
+        # whether a bin starts or stops holding an item is judged from the
+        # contents read above
+        totals = {}
+        for (bin_id, item_id), quantity in applied.items():
+            held_before = item_id in bins[bin_id]
+            held_after = bins[bin_id].get(item_id, 0) + quantity > 0
+            change = totals.setdefault(item_id, [0, 0])
+            change[0] += quantity
+            change[1] += held_after - held_before
+        totals_updates = [UpdateOne({"_id": item_id}, totals_inc(quantity, bin_count), upsert=True)
+                          for item_id, (quantity, bin_count) in totals.items()
+                          if quantity or bin_count]
+        if totals_updates:
+            db.totals.bulk_write(totals_updates, ordered=False, session=session)
+        return success.bins_contents_post_response(results)
+
+    return run_in_transaction(apply)
+
+
+def search_plan(query):
+    """Return [(collection, data model, mongo filter)] in result order.
+
+    Every collection gets at most one filter, so a document matching several
+    clauses (e.g. an owned code and its name) is only returned once.
+    """
+    debug_collections = {
+        "!ALL": ("sku", "batch", "bin"),
+        "!SKUS": ("sku",),
+        "!BATCHES": ("batch",),
+        "!BINS": ("bin",),
+    }
+    if query in debug_collections:
+        models = {"sku": Sku, "batch": Batch, "bin": Bin}
+        return [(db[name], models[name], {})
+                for name in debug_collections[query]]
+
+    plan = []
+    for collection, model, prefix in ((db.sku, Sku, "SKU"), (db.batch, Batch, "BAT")):
+        clauses = [{"owned_codes": query}, {"associated_codes": query}]
+        if query.startswith(prefix):
+            clauses.insert(0, {"_id": query})
+        # $text needs the name text index, and every other $or clause indexed
+        if query and has_indexes(collection.database):
+            clauses.append({"$text": {"$search": query}})
+        plan.append((collection, model, {"$or": clauses}))
+    if query.startswith("BIN"):
+        plan.append((db.bin, Bin, {"_id": query}))
+    return plan
+
+
+def search_page(plan, counts, starting_from, limit):
+    """Fetch only the requested page of the results of `plan`.
+
+    `counts` holds the number of matches of each filter in `plan`. Results are
+    ordered by collection (in plan order) then by _id, so a page is a skip/limit
+    over at most a couple of collections. Returns a list of (collection name,
+    DataModelColumns) pairs, so deep listings stay compact.
+    """
+    total = 0
+    page = []
+    for (collection, model, mongo_filter), count in zip(plan, counts):
+        skip = starting_from - total
+        total += count
+        if page_length(page) >= limit or skip >= count:
+            continue
+        cursor = collection.find(mongo_filter).sort("_id", 1) \
+            .skip(max(skip, 0)).limit(limit - page_length(page))
+        rows = model.from_mongodb_docs(cursor)
+        if len(rows):
+            page.append((collection.name, rows))
+    return page
+
+
+def page_length(page):
+    return sum(len(rows) for _, rows in page)
+
+
+def search_keyset_page(plan, key, limit, forward=True):
+    """Fetch the `limit` results after (or before, if not `forward`) `key`.
+
+    `key` is the (collection name, _id) of the last result the client has seen.
+    Each collection is read with an _id range on its _id index, so the cost is
+    O(limit) no matter how deep the page is. Returns the page, as search_page
+    does, and whether there are more results beyond it.
+    """
+    if not forward:
+        plan = plan[::-1]
+    operator, direction = ("$gt", 1) if forward else ("$lt", -1)
+
+    page = []
+    started = False
+    for collection, model, mongo_filter in plan:
+        if not started:
+            if collection.name != key[0]:
+                continue
+            started = True
+            mongo_filter = {"$and": [mongo_filter, {"_id": {operator: key[1]}}]}
+        if page_length(page) > limit:
+            break
+        cursor = collection.find(mongo_filter).sort("_id", direction) \
+            .limit(limit + 1 - page_length(page))
+        page.append((collection.name, model.from_mongodb_docs(cursor)))
+
+    page = [(name, rows) for name, rows in page if len(rows)]
+    has_more = page_length(page) > limit
+    if has_more:
+        page[-1][1].pop()
+        page = [(name, rows) for name, rows in page if len(rows)]
+    if not forward:
+        page.reverse()
+        for _, rows in page:
+            rows.reverse()
+    return page, has_more
+
+
+def count_matches(collection, mongo_filter):
+    if not mongo_filter:
+        # debug modes list whole collections, use collection metadata
+        return collection.estimated_document_count()
+    return collection.count_documents(mongo_filter)
+
+
+def encode_search_cursor(forward, collection_name, id):
+    return base64.urlsafe_b64encode(
+        json.dumps(["next" if forward else "prev", collection_name, id]).encode("utf-8")).decode("ascii")
+
+
+def decode_search_cursor(cursor, plan):
+    """Returns (forward, (collection name, _id)) or raises ValueError."""
+    try:
+        direction, collection_name, id = json.loads(
+            base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (ValueError, TypeError, UnicodeError):
+        raise ValueError("invalid cursor")
+    if direction not in ("next", "prev") or not isinstance(id, str) \
+            or collection_name not in [collection.name for collection, _, _ in plan]:
+        raise ValueError("invalid cursor")
+    return direction == "next", (collection_name, id)
+
+
 @inventorius.route('/api/search', methods=['GET'])
 def search():
     query = request.args['query']
-    limit = getIntArgs(request.args, "limit", 20)
-    startingFrom = getIntArgs(request.args, "startingFrom", 0)
-    resp = Response()
-
-    results = []
-
-    # debug flags
-    if query == '!ALL':
-        results.extend([Sku.from_mongodb_doc(e) for e in db.sku.find()])
-        results.extend([Batch.from_mongodb_doc(e) for e in db.batch.find()])
-        results.extend([Bin.from_mongodb_doc(e) for e in db.bin.find()])
-    if query == '!BINS':
-        results.extend([Bin.from_mongodb_doc(e) for e in db.bin.find()])
-    if query == '!SKUS':
-        results.extend([Sku.from_mongodb_doc(e) for e in db.sku.find()])
-    if query == '!BATCHES':
-        results.extend([Batch.from_mongodb_doc(e) for e in db.batch.find()])
-
-    # search by label
-    if query.startswith('SKU'):
-        results.append(Sku.from_mongodb_doc(db.sku.find_one({'_id': query})))
-    if query.startswith('BIN'):
-        results.append(Bin.from_mongodb_doc(db.bin.find_one({'_id': query})))
-    if query.startswith('BAT'):
-        results.append(Batch.from_mongodb_doc(
-            db.batch.find_one({'_id': query})))
-    results = [result for result in results if result != None]
-
-    # search for skus with owned_codes
-    cursor = db.sku.find({"owned_codes": query})
-    for sku_doc in cursor:
-        results.append(Sku.from_mongodb_doc(sku_doc))
-
-    # search for skus with associated codes
-    cursor = db.sku.find({"associated_codes": query})
-    for sku_doc in cursor:
-        results.append(Sku.from_mongodb_doc(sku_doc))
-
-    # search for skus with owned_codes
-    cursor = db.batch.find({"owned_codes": query})
-    for batch_doc in cursor:
-        results.append(Batch.from_mongodb_doc(batch_doc))
-
-    # search for batchs with associated codes
-    cursor = db.batch.find({"associated_codes": query})
-    for batch_doc in cursor:
-        results.append(Batch.from_mongodb_doc(batch_doc))
-
-    # if not DEV_ENV: # maybe use global flag + env variable instead. Shouldn't need to check this every time in production/
-    if "name_text" in db.sku.index_information().keys():
-        cursor = db.sku.find({"$text": {"$search": query}})
-        for sku_doc in cursor:
-            results.append(Sku.from_mongodb_doc(sku_doc))
-    if "name_text" in db.batch.index_information().keys():
-        cursor = db.batch.find({"$text": {"$search": query}})
-        for batch_doc in cursor:
-            results.append(Batch.from_mongodb_doc(batch_doc))
-
-    if results != []:
-        paged = results[startingFrom:(startingFrom + limit)]
-        resp.status_code = 200
-        resp.mimetype = "application/json"
-        # TODO: Add next page / prev page operations
-        resp.data = json.dumps({'state': {
-            "total_num_results": len(results),
-            "starting_from": startingFrom,
-            "limit": limit,
-            "returned_num_results": len(paged),
-            "results": paged
-        },
-            "operations": []}, cls=Encoder)
-        return resp
-
-    resp.status_code = 200
-    resp.mimetype = "application/json"
-    resp.data = json.dumps({'state': {
-        "total_num_results": len(results),
+    limit = max(getIntArgs(request.args, "limit", 20), 0)
+    startingFrom = max(getIntArgs(request.args, "startingFrom", 0), 0)
+    cursor = request.args.get("cursor")
+
+    plan = search_plan(query)
+    # cursor pages only count all matches if asked to, the client already got
+    # the total with the first page
+    if cursor and request.args.get("count", "false") != "true":
+        total_num_results = None
+    else:
+        counts = [count_matches(collection, mongo_filter)
+                  for collection, _, mongo_filter in plan]
+        total_num_results = sum(counts)
+
+    if cursor:
+        try:
+            forward, key = decode_search_cursor(cursor, plan)
+        except ValueError as e:
+            return problem.invalid_params_response_simple("cursor", str(e))
+        page, has_more = search_keyset_page(plan, key, limit, forward)
+        has_next, has_prev = (has_more, True) if forward else (True, has_more)
+        startingFrom = None
+    else:
+        page = search_page(plan, counts, startingFrom, limit)
+        has_next = startingFrom + page_length(page) < total_num_results
+        has_prev = startingFrom > 0
+
+    page_operations = []
+    if page and has_next:
+        collection_name, rows = page[-1]
+        page_operations.append(operations.search_page(
+            "next", query, limit, encode_search_cursor(True, collection_name, rows[-1].id)))
+    if page and has_prev:
+        collection_name, rows = page[0]
+        page_operations.append(operations.search_page(
+            "prev", query, limit, encode_search_cursor(False, collection_name, rows[0].id)))
+
+    state = {
+        "total_num_results": total_num_results,
         "starting_from": startingFrom,
         "limit": limit,
-        "returned_num_results": 0,
-        "results": []
-    }, "operations": []}, cls=Encoder)
-    return resp
+        "returned_num_results": page_length(page),
+    }
+    return Response(search_response_body(state, [rows for _, rows in page], page_operations),
+                    status=200, mimetype="application/json")
+
+
+def search_response_body(state, pages, page_operations):
+    """Yield the search response JSON with one result encoded at a time, so a
+    large page is never held as a list of models (or their dicts)."""
+    state_json = json.dumps(state)
+    yield '{"operations": ' + json.dumps(page_operations) + ', "state": '
+    yield state_json[:-1] + ', "results": ['
+    separator = ""
+    for rows in pages:
+        for model in rows:
+            yield separator + json.dumps(model, cls=Encoder)
+            separator = ", "
+    yield "]}}"
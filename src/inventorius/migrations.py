@@ -0,0 +1,300 @@
+"""Maintenance steps that are too slow to run inside a request.
+
+Run them from the command line before starting (or after upgrading) the
+server, e.g.
+
+    flask --app inventorius migrate
+    flask --app inventorius ensure-indexes
+    flask --app inventorius migrate-ids
+    flask --app inventorius migrate-contents-keys
+    flask --app inventorius rebuild-totals
+    flask --app inventorius migrate-file-blobs
+    flask --app inventorius process-pending-files
+"""
+
+import os
+import time
+
+import click
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from inventorius.db import INDEXES, ensure_indexes, get_mongo_client
+from inventorius.files import (RENDITION_SPECS, drop_rendition_entries, ensure_dir, file_sha256,
+                               get_file_path, get_rendition_path, process_pending_uploads)
+from inventorius.util import ID_COLLECTIONS, code_number
+
+
+def max_code_pipeline(prefix):
+    """Aggregation computing the largest ID number in a collection.
+
+    Compares the numbers rather than the strings, which put BIN999 after
+    BIN1000. It only reads _id, so it scans the _id index, not the documents.
+    """
+    return [
+        {"$match": {"_id": {"$regex": f"^{prefix}[0-9]+$"}}},
+        {"$group": {
+            "_id": None,
+            "max": {"$max": {"$toLong": {"$arrayElemAt": [
+                {"$split": ["$_id", prefix]}, 1]}}},
+        }},
+    ]
+
+
+def highest_existing_code(collection, prefix):
+    """Largest ID number in `collection`, 0 if it has none."""
+    maxima = list(collection.aggregate(max_code_pipeline(prefix)))
+    return (maxima[0]["max"] or 0) if maxima else 0
+
+
+# admin doc recording that migrate_ids has run on a database
+IDS_DONE = "ids"
+
+
+def migrate_ids(database, echo=print):
+    """Bring the ID allocator of every prefix up to date with `database`.
+
+    Moves each high-water mark past the largest existing ID and folds in the
+    `next` and `used` fields of old format admin docs, and the used-ID
+    bitmaps some versions kept.
+    """
+    for prefix, collection_name in ID_COLLECTIONS.items():
+        collection = database[collection_name]
+
+        echo(f"{prefix}: finding the largest of ~{collection.estimated_document_count()} ids")
+        high_water = highest_existing_code(collection, prefix)
+
+        admin_doc = database.admin.find_one({"_id": prefix}) or {}
+        if "next" in admin_doc:
+            high_water = max(high_water, code_number(admin_doc["next"]) - 1)
+        high_water = max([high_water] + admin_doc.get("used", []))
+        database.admin.delete_many({"_id": {"$regex": f"^{prefix}\\.used\\."}})
+
+        admin_doc = database.admin.find_one_and_update(
+            {"_id": prefix},
+            {"$max": {"high_water": high_water},
+             "$unset": {"used": "", "next": ""}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER)
+        echo(f"{prefix}: next id {prefix}{admin_doc['high_water'] + 1:06}")
+    database.admin.update_one({"_id": IDS_DONE}, {"$set": {"done": True}}, upsert=True)
+
+
+def migrate_contents_keys(database, echo=print):
+    """Recompute `contents_keys` of every bin from its `contents`.
+
+    Fixes bins written before it was maintained as well as stale or partial
+    arrays. Runs as one server-side pipeline update, so no bin leaves the
+    database, and records its completion for run_startup_migrations.
+    """
+    echo(f"bin: indexing contents of ~{database.bin.estimated_document_count()} bins")
+    result = database.bin.update_many(
+        {},
+        [{"$set": {"contents_keys": {"$map": {
+            "input": {"$objectToArray": {"$ifNull": ["$contents", {}]}},
+            "in": "$$this.k",
+        }}}}])
+    database.admin.update_one({"_id": CONTENTS_KEYS_DONE}, {"$set": {"done": True}}, upsert=True)
+    echo(f"bin: updated contents_keys of {result.modified_count} bins")
+
+
+# admin doc recording that migrate_contents_keys has run on a database
+CONTENTS_KEYS_DONE = "contents_keys"
+
+# seconds a process may hold a migration before another one takes over,
+# assuming it exited. The migrations may run twice, but not at once.
+MIGRATION_CLAIM_TIMEOUT = 600
+MIGRATION_POLL_INTERVAL = 5
+
+
+def run_once(database, name, migrate, echo=print):
+    """Run `migrate(database, echo)` unless it has completed on `database`.
+
+    `migrate` records its completion in the admin doc `name`. Processes
+    starting together claim that doc, so one of them runs the migration while
+    the others wait for it to be done.
+    """
+    while True:
+        now = time.time()
+        try:
+            database.admin.update_one(
+                {"_id": name, "done": {"$ne": True}, "$or": [
+                    {"claimed_at": {"$exists": False}},
+                    {"claimed_at": {"$lt": now - MIGRATION_CLAIM_TIMEOUT}},
+                ]},
+                {"$set": {"claimed_at": now}},
+                upsert=True)
+        except DuplicateKeyError:
+            # done, or claimed by another process
+            if database.admin.find_one({"_id": name, "done": True}):
+                return
+            echo(f"{name}: waiting for another process to migrate")
+            time.sleep(MIGRATION_POLL_INTERVAL)
+            continue
+        migrate(database, echo=echo)
+        return
+
+
+def run_startup_migrations(database, echo=print):
+    """Bring `database` up to date for this version before serving from it.
+
+    Each migration runs once per database, however many processes start.
+    """
+    ensure_indexes(database)
+    run_once(database, IDS_DONE, migrate_ids, echo)
+    run_once(database, CONTENTS_KEYS_DONE, migrate_contents_keys, echo)
+    run_once(database, TOTALS_DONE, rebuild_totals, echo)
+
+
+# admin doc recording that rebuild_totals has run on a database
+TOTALS_DONE = "totals"
+
+
+def totals_pipeline():
+    """Aggregation over bins that replaces the `totals` collection."""
+    return [
+        {"$project": {"contents": {"$objectToArray": {"$ifNull": ["$contents", {}]}}}},
+        {"$unwind": "$contents"},
+        {"$match": {"contents.v": {"$ne": 0}}},
+        {"$group": {
+            "_id": "$contents.k",
+            "quantity": {"$sum": "$contents.v"},
+            "bins": {"$sum": 1},
+        }},
+        {"$out": "totals"},
+    ]
+
+
+def rebuild_totals(database, echo=print):
+    """Recompute the per-item totals from bin contents.
+
+    Seeds the totals of existing stock and corrects any drift of the
+    incrementally maintained totals. Changes made to bins while the pipeline
+    runs may be lost, so run it when the inventory is quiet, e.g. before the
+    server starts.
+    """
+    echo(f"totals: summing contents of ~{database.bin.estimated_document_count()} bins")
+    database.bin.aggregate(totals_pipeline())
+    database.admin.update_one({"_id": TOTALS_DONE}, {"$set": {"done": True}}, upsert=True)
+    echo(f"totals: {database.totals.estimated_document_count()} items held")
+
+
+# file metadata that belongs to the content, kept on its blob
+BLOB_FIELDS = ("processing", "size", "sha256", "has_thumbnail", "width", "height", "renditions",
+               "failed_renditions")
+
+
+def migrate_file_blobs(database, echo=print):
+    """Move files stored under their file ID into content-addressed blobs.
+
+    Files with identical content end up sharing one blob, the duplicates are
+    removed from disk. Files are pointed at their blob and marked `migrating`
+    before anything is moved, and moving and counting references can be
+    repeated, so an interrupted run is finished by running it again.
+    """
+    for metadata in database.files.find({"blob": {"$exists": False}}):
+        file_id = metadata["_id"]
+        file_path = get_file_path(file_id)
+        if not os.path.exists(file_path):
+            echo(f"{file_id}: missing from disk, skipped")
+            continue
+
+        blob_id = file_sha256(file_path)
+        database.blobs.update_one(
+            {"_id": blob_id},
+            {"$setOnInsert": {"refcount": 0, **{field: metadata.get(field) for field in BLOB_FIELDS
+                                                if field in metadata}}},
+            upsert=True)
+        database.files.update_one(
+            {"_id": file_id},
+            {"$set": {"blob": blob_id, "migrating": True},
+             "$unset": {field: "" for field in BLOB_FIELDS}})
+
+    migrated = shared = 0
+    migrated_ids, blob_ids = [], set()
+    rendition_names = {"thumb"} | set(RENDITION_SPECS)
+    for metadata in database.files.find({"migrating": True}, {"blob": 1}):
+        file_id, blob_id = metadata["_id"], metadata["blob"]
+        # renditions cached while it was served under its own ID
+        drop_rendition_entries(database, {"blob": file_id})
+        if os.path.exists(get_file_path(file_id)) and os.path.exists(get_file_path(blob_id)):
+            shared += 1
+        moves = [(get_file_path(file_id), get_file_path(blob_id))]
+        moves += [(get_rendition_path(file_id, name), get_rendition_path(blob_id, name))
+                  for name in rendition_names]
+        for source, target in moves:
+            if not os.path.exists(source):
+                continue
+            if os.path.exists(target):
+                # same content, stored by a file migrated before
+                os.remove(source)
+            else:
+                ensure_dir(target)
+                os.replace(source, target)
+        migrated_ids.append(file_id)
+        blob_ids.add(blob_id)
+        migrated += 1
+
+    for blob_id in blob_ids:
+        database.blobs.update_one(
+            {"_id": blob_id}, {"$set": {"refcount": database.files.count_documents({"blob": blob_id})}})
+    database.files.update_many({"_id": {"$in": migrated_ids}}, {"$unset": {"migrating": ""}})
+    echo(f"files: {migrated} moved to blobs, {shared} of them duplicates")
+
+
+@click.command("migrate")
+@click.option("--database", default="inventoriusdb", show_default=True,
+              help="Name of the mongodb database to migrate.")
+def migrate_command(database):
+    """Run the migrations this version needs that have not run yet."""
+    run_startup_migrations(get_mongo_client()[database], echo=click.echo)
+
+
+@click.command("migrate-ids")
+@click.option("--database", default="inventoriusdb", show_default=True,
+              help="Name of the mongodb database to migrate.")
+def migrate_ids_command(database):
+    """Update the ID allocators from the existing SKUs, batches and bins."""
+    migrate_ids(get_mongo_client()[database], echo=click.echo)
+
+
+@click.command("ensure-indexes")
+@click.option("--database", default="inventoriusdb", show_default=True,
+              help="Name of the mongodb database to index.")
+def ensure_indexes_command(database):
+    """Create the indexes in the index registry (inventorius.db.INDEXES)."""
+    ensure_indexes(get_mongo_client()[database])
+    for collection, keys in INDEXES:
+        click.echo(f"{collection}: {keys}")
+
+
+@click.command("migrate-contents-keys")
+@click.option("--database", default="inventoriusdb", show_default=True,
+              help="Name of the mongodb database to migrate.")
+def migrate_contents_keys_command(database):
+    """Recompute the contents_keys index array of every bin."""
+    migrate_contents_keys(get_mongo_client()[database], echo=click.echo)
+
+
+@click.command("rebuild-totals")
+@click.option("--database", default="inventoriusdb", show_default=True,
+              help="Name of the mongodb database to rebuild.")
+def rebuild_totals_command(database):
+    """Recompute the per sku and batch stock totals from bin contents."""
+    rebuild_totals(get_mongo_client()[database], echo=click.echo)
+
+
+@click.command("process-pending-files")
+@click.option("--database", default="inventoriusdb", show_default=True,
+              help="Name of the mongodb database with the file metadata.")
+def process_pending_files_command(database):
+    """Resize image uploads whose processing never finished."""
+    process_pending_uploads(get_mongo_client()[database], echo=click.echo)
+
+
+@click.command("migrate-file-blobs")
+@click.option("--database", default="inventoriusdb", show_default=True,
+              help="Name of the mongodb database with the file metadata.")
+def migrate_file_blobs_command(database):
+    """Move uploads stored under their file ID into content-addressed blobs."""
+    migrate_file_blobs(get_mongo_client()[database], echo=click.echo)
@@ -6,6 +6,7 @@ from flask_login.utils import encode_cookie
 from inventorius.db import db
 from inventorius.data_models import DataModel, DataModelJSONEncoder, UserData, Batch, Bin
 import inventorius.resource_operations as operations
+from inventorius.util import item_locations
 
 # operation = {
 #   "rel": operation name (resource method),
@@ -133,10 +134,13 @@ class PrivateProfile(Profile):
 
 class BatchEndpoint(HypermediaEndpoint):
     @classmethod
-    def from_batch(cls, data_batch: Batch):
+    def from_batch(cls, data_batch: Batch, totals=None):
+        state = data_batch.to_dict(mask_default=True)
+        if totals is not None:
+            state["totals"] = totals
         endpoint = BatchEndpoint(
             resource_uri=url_for("batch.batch_get", id=data_batch.id),
-            state=data_batch.to_dict(mask_default=True),
+            state=state,
             operations=[
                 operations.batch_update(data_batch.id),
                 operations.batch_delete(data_batch.id),
@@ -177,13 +181,7 @@ class BatchBinsEndpoint(HypermediaEndpoint):
         if not retrieve:
             raise NotImplementedError()
 
-        contained_by_bins = [
-            Bin.from_mongodb_doc(bson)
-            for bson in db.bin.find({
-                f"contents.{batch_id}": {"$exists": True}
-            })]
-        locations = {bin.id: {batch_id: bin.contents[batch_id]}
-                     for bin in contained_by_bins}
+        locations = item_locations(batch_id)
 
         endpoint = BatchBinsEndpoint(
             resource_uri=url_for("batch.batch_bins_get", id=batch_id),
@@ -217,10 +215,13 @@ class BinEndpoint(HypermediaEndpoint):
 
 class SkuEndpoint(HypermediaEndpoint):
     @classmethod
-    def from_sku(cls, sku):
+    def from_sku(cls, sku, totals=None):
+        state = sku.to_dict()
+        if totals is not None:
+            state["totals"] = totals
         endpoint = SkuEndpoint(
             resource_uri=url_for("sku.sku_get", id=sku.id),
-            state=sku.to_dict(),
+            state=state,
             operations=[
                 operations.sku_update(sku.id),
                 operations.sku_delete(sku.id),
@@ -66,4 +66,8 @@ def sku_bins(id):
     return operation("bins", GET, url_for("sku.sku_bins_get", id=id))
 
 def sku_batches(id):
-    return operation("batches", GET, url_for("sku.sku_batches_get", id=id))
\ No newline at end of file
+    return operation("batches", GET, url_for("sku.sku_batches_get", id=id))
+
+
+def search_page(rel, query, limit, cursor):
+    return operation(rel, GET, url_for("inventorius.search", query=query, limit=limit, cursor=cursor))
@@ -0,0 +1,146 @@
+"""
+Bundle search index for /api/schema/<name>/search.
+
+A bundle is a child mixin offered for a trigger field. The index is built once
+per parsed schema so a search only touches the bundles it returns.
+"""
+
+from bisect import bisect_left
+import json
+
+from .trigger_engine import Schema, schema_field_to_dict
+
+
+class FieldBundles:
+    """The bundles triggered by one field.
+
+    Bundles are kept in schema order (first reference wins), with lookups by
+    exact trigger value and by lowercase name prefix.
+    """
+
+    def __init__(self):
+        self.bundles: list[dict] = []
+        self.positions: dict[str, int] = {}
+        # trigger value -> bundles whose "eq"/"in" trigger accepts it
+        self.by_value: dict[str, list[dict]] = {}
+        self.value_ids: dict[str, set[str]] = {}
+        # sorted (lowercase name, position) for prefix queries
+        self.names: list[tuple[str, int]] = []
+
+    def add(self, bundle: dict, trigger_values: list) -> None:
+        if bundle["id"] not in self.positions:
+            self.positions[bundle["id"]] = len(self.bundles)
+            self.bundles.append(bundle)
+        for value in trigger_values:
+            ids = self.value_ids.setdefault(value, set())
+            if bundle["id"] not in ids:
+                ids.add(bundle["id"])
+                self.by_value.setdefault(value, []).append(bundle)
+
+    def finish(self) -> None:
+        self.names = sorted((bundle["name"].lower(), position)
+                            for position, bundle in enumerate(self.bundles))
+
+    def with_value(self, value: str) -> list[dict]:
+        return self.by_value.get(value, [])
+
+    def with_prefix(self, prefix: str) -> list[dict]:
+        positions = []
+        for index in range(bisect_left(self.names, (prefix,)), len(self.names)):
+            name, position = self.names[index]
+            if not name.startswith(prefix):
+                break
+            positions.append(position)
+        return [self.bundles[position] for position in sorted(positions)]
+
+
+def _string_trigger_values(trigger) -> list:
+    """Values an "eq" or "in" trigger accepts that a query string can equal."""
+    if trigger.operator == "eq":
+        values = [trigger.value]
+    elif trigger.operator == "in":
+        values = trigger.value if isinstance(trigger.value, list) else [trigger.value]
+    else:
+        return []
+    return [value for value in values if isinstance(value, str)]
+
+
+class BundleIndex:
+    """Precomputed bundle lookups for a schema. Shared, must not be mutated."""
+
+    def __init__(self, schema: Schema):
+        self.fields: dict[str, FieldBundles] = {}
+        bundle_dicts = {}
+        for mixin in schema.mixins.values():
+            for child in mixin.children:
+                child_mixin = schema.mixins.get(child.mixin_name)
+                if not child_mixin:
+                    continue
+                bundle = bundle_dicts.get(child_mixin.name)
+                if bundle is None:
+                    bundle = bundle_dicts[child_mixin.name] = {
+                        "id": child_mixin.name,
+                        "name": child_mixin.name,
+                        "fields": [schema_field_to_dict(f) for f in child_mixin.fields],
+                    }
+                field_bundles = self.fields.setdefault(child.trigger.field_name, FieldBundles())
+                field_bundles.add(bundle, _string_trigger_values(child.trigger))
+        for field_bundles in self.fields.values():
+            field_bundles.finish()
+
+        # Intersection rules as (required mixins, fields with a dedup key)
+        self.rules = [
+            (set(rule.when),
+             [(json.dumps(d, sort_keys=True), d) for d in map(schema_field_to_dict, rule.adds)])
+            for rule in schema.intersections
+        ]
+        # mixin name -> indices of the rules requiring it
+        self.rule_index: dict[str, list[int]] = {}
+        for rule_index, (when, _) in enumerate(self.rules):
+            for mixin_name in when:
+                self.rule_index.setdefault(mixin_name, []).append(rule_index)
+        self.unconditional_rules = [rule_index for rule_index, (when, _) in enumerate(self.rules)
+                                    if not when]
+
+    def search(self, field_name: str, query: str = "", exact_value: str = "") -> list[dict]:
+        """Bundles triggered by `field_name`, in schema order.
+
+        With `exact_value`, only bundles whose "eq"/"in" trigger accepts it;
+        otherwise with `query`, bundles whose lowercase name starts with it.
+        """
+        field_bundles = self.fields.get(field_name)
+        if field_bundles is None:
+            return []
+        if exact_value:
+            return field_bundles.with_value(exact_value)
+        if query:
+            return field_bundles.with_prefix(query)
+        return field_bundles.bundles
+
+    def intersection_fields(self, active_mixins: list[str], bundles: list[dict]) -> list[dict]:
+        """Fields of the intersection rules satisfied by the active mixins plus
+        any single one of `bundles`, in rule order and without duplicates."""
+        active_set = set(active_mixins)
+        active_counts = {}
+        for mixin_name in active_set:
+            for rule_index in self.rule_index.get(mixin_name, ()):
+                active_counts[rule_index] = active_counts.get(rule_index, 0) + 1
+
+        satisfied = set(self.unconditional_rules)
+        satisfied.update(rule_index for rule_index, count in active_counts.items()
+                         if count == len(self.rules[rule_index][0]))
+        for bundle in bundles:
+            if bundle["id"] in active_set:
+                continue
+            for rule_index in self.rule_index.get(bundle["id"], ()):
+                if active_counts.get(rule_index, 0) + 1 == len(self.rules[rule_index][0]):
+                    satisfied.add(rule_index)
+
+        fields = []
+        seen = set()
+        for rule_index in sorted(satisfied):
+            for key, field_dict in self.rules[rule_index][1]:
+                if key not in seen:
+                    seen.add(key)
+                    fields.append(field_dict)
+        return fields
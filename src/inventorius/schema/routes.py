@@ -1,38 +1,128 @@
 """API routes for schema management."""
 
-from flask import Blueprint, jsonify, request
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from functools import cached_property, partial
+import io
+import json
+import multiprocessing
+import os
+import threading
+import time
+
+from bson import ObjectId
+from flask import Blueprint, Response, jsonify, request, stream_with_context
 
 from ..db import db
+from .bundles import BundleIndex
 from .trigger_engine import (
     Schema,
     TriggerEngine,
+    schema_field_to_dict,
     schema_to_dict,
     schema_from_dict,
 )
 
 bp = Blueprint("schema", __name__, url_prefix="/api/schema")
 
+# Seconds a cached schema is trusted before its version is checked against
+# MongoDB again. Saves from this process invalidate it immediately; saves from
+# other workers are noticed within this interval.
+SCHEMA_CHECK_INTERVAL = float(os.getenv("INVENTORIUS_SCHEMA_CHECK_INTERVAL", "1"))
 
-def _get_schema(name: str) -> Schema | None:
-    """Get a schema by name from MongoDB."""
+# Batch evaluations of at least EVALUATE_POOL_THRESHOLD inputs are split across
+# a pool of EVALUATE_PROCESSES worker processes, started once per server
+# process. 0 evaluates every batch in-process.
+EVALUATE_PROCESSES = int(os.getenv("INVENTORIUS_EVALUATE_PROCESSES", "0"))
+EVALUATE_POOL_THRESHOLD = int(os.getenv("INVENTORIUS_EVALUATE_POOL_THRESHOLD", "20000"))
+EVALUATE_CHUNK_SIZE = 5000
+
+
+@dataclass
+class CachedSchema:
+    """A parsed schema and its indexes, valid while the stored version matches."""
+    version: ObjectId | None
+    checked_at: float
+    schema: Schema
+    engine: TriggerEngine
+    bundles: BundleIndex
+
+    @cached_property
+    def schema_json(self) -> str:
+        """The schema as sent to evaluation worker processes."""
+        return json.dumps(schema_to_dict(self.schema))
+
+
+# (database name, schema name) -> CachedSchema. Cached objects are shared
+# between requests and must not be mutated.
+_schema_cache: dict[tuple[str, str], CachedSchema] = {}
+_schema_cache_lock = threading.Lock()
+
+
+def _load_schema(name: str) -> tuple[ObjectId | None, Schema] | None:
+    """Get the stored version and a freshly parsed schema from MongoDB."""
     doc = db.schema.find_one({"_id": name})
     if doc:
-        # Remove MongoDB _id before converting
-        schema_dict = {k: v for k, v in doc.items() if k != "_id"}
-        return schema_from_dict(schema_dict)
+        # Remove MongoDB _id and version before converting
+        schema_dict = {k: v for k, v in doc.items() if k not in ("_id", "version")}
+        return doc.get("version"), schema_from_dict(schema_dict)
     return None
 
 
+def _get_schema(name: str) -> Schema | None:
+    """Get a private copy of a schema by name from MongoDB, safe to modify."""
+    loaded = _load_schema(name)
+    return loaded[1] if loaded else None
+
+
+def _get_cached_schema(name: str) -> CachedSchema | None:
+    """Get a schema and its TriggerEngine for read-only use.
+
+    Served from the in-process cache, re-checking the stored version at most
+    every SCHEMA_CHECK_INTERVAL seconds and re-parsing only when it changed.
+    """
+    key = (db.name, name)
+    cached = _schema_cache.get(key)
+    now = time.monotonic()
+    if cached and now - cached.checked_at < SCHEMA_CHECK_INTERVAL:
+        return cached
+
+    # unversioned docs, written by older code, are parsed again every time
+    if cached and cached.version is not None:
+        version_doc = db.schema.find_one({"_id": name}, {"version": 1})
+        if version_doc and version_doc.get("version") == cached.version:
+            cached.checked_at = now
+            return cached
+
+    loaded = _load_schema(name)
+    with _schema_cache_lock:
+        if not loaded:
+            _schema_cache.pop(key, None)
+            return None
+        version, schema = loaded
+        cached = _schema_cache[key] = CachedSchema(
+            version, now, schema, TriggerEngine(schema), BundleIndex(schema))
+    return cached
+
+
 def _save_schema(name: str, schema: Schema) -> None:
-    """Save a schema to MongoDB."""
+    """Save a schema to MongoDB under a new version.
+
+    The version is unique per save rather than a counter, so a schema deleted
+    and created again never repeats a version another worker has cached.
+    """
     doc = schema_to_dict(schema)
-    doc["_id"] = name
-    db.schema.replace_one({"_id": name}, doc, upsert=True)
+    db.schema.update_one({"_id": name}, {"$set": {**doc, "version": ObjectId()}}, upsert=True)
+    with _schema_cache_lock:
+        _schema_cache.pop((db.name, name), None)
 
 
 def _delete_schema(name: str) -> bool:
     """Delete a schema from MongoDB."""
     result = db.schema.delete_one({"_id": name})
+    with _schema_cache_lock:
+        _schema_cache.pop((db.name, name), None)
     return result.deleted_count > 0
 
 
@@ -49,22 +139,22 @@ def list_schemas():
 @bp.route("/<name>", methods=["GET"])
 def get_schema(name: str):
     """Get a schema definition by name."""
-    schema = _get_schema(name)
-    if not schema:
+    cached = _get_cached_schema(name)
+    if not cached:
         return jsonify({"error": f"Schema '{name}' not found"}), 404
 
-    return jsonify(schema_to_dict(schema))
+    return jsonify(schema_to_dict(cached.schema))
 
 
 @bp.route("/<name>/roots", methods=["GET"])
 def get_root_mixins(name: str):
     """Get the root mixins for a schema (available at form start)."""
-    schema = _get_schema(name)
-    if not schema:
+    cached = _get_cached_schema(name)
+    if not cached:
         return jsonify({"error": f"Schema '{name}' not found"}), 404
 
-    engine = TriggerEngine(schema)
-    roots = engine.get_root_mixins()
+    schema = cached.schema
+    roots = cached.engine.get_root_mixins()
 
     # Return basic info about each root mixin
     result = []
@@ -96,8 +186,8 @@ def evaluate_schema(name: str):
         "available_fields": [...]
     }
     """
-    schema = _get_schema(name)
-    if not schema:
+    cached = _get_cached_schema(name)
+    if not cached:
         return jsonify({"error": f"Schema '{name}' not found"}), 404
 
     data = request.get_json()
@@ -107,28 +197,131 @@ def evaluate_schema(name: str):
     active_mixins = data.get("active_mixins", [])
     field_values = data.get("field_values", {})
 
-    engine = TriggerEngine(schema)
-    state = engine.evaluate(active_mixins, field_values)
+    state = cached.engine.evaluate(active_mixins, field_values)
+    return jsonify(_form_state_response(state, {}))
+
+
+def _form_state_response(state, field_dicts: dict) -> dict:
+    """Response body for an evaluated FormState.
 
-    # Build response with full field info
+    `field_dicts` memoizes field serialization by id() across a batch; the
+    fields belong to the engine's schema, which outlives the batch.
+    """
     fields = []
     for f in state.available_fields:
-        field_info = {
-            "name": f.name,
-            "type": f.field_type,
-        }
-        if f.options:
-            field_info["options"] = f.options
-        if f.unit:
-            field_info["unit"] = f.unit
-        if f.required:
-            field_info["required"] = f.required
-        fields.append(field_info)
-
-    return jsonify({
+        field_dict = field_dicts.get(id(f))
+        if field_dict is None:
+            field_dict = field_dicts[id(f)] = schema_field_to_dict(f)
+        fields.append(field_dict)
+    return {
         "active_mixins": state.active_mixins,
         "available_fields": fields,
-    })
+    }
+
+
+def _evaluate_input(engine: TriggerEngine, data, field_dicts: dict) -> dict:
+    """Evaluate one batch input, reporting bad inputs in its result."""
+    if not isinstance(data, dict):
+        return {"error": "input must be an object"}
+    try:
+        state = engine.evaluate(data.get("active_mixins", []), data.get("field_values", {}))
+    except (TypeError, AttributeError) as e:
+        return {"error": f"Cannot evaluate input: {e}"}
+    return _form_state_response(state, field_dicts)
+
+
+_evaluate_pool: ProcessPoolExecutor | None = None
+_evaluate_pool_lock = threading.Lock()
+
+
+def _get_evaluate_pool() -> ProcessPoolExecutor:
+    """The process' evaluation worker pool, started on first use.
+
+    Workers are spawned rather than forked, since forking a server process
+    that already runs threads (request threads, the image pool) can deadlock.
+    """
+    global _evaluate_pool
+    with _evaluate_pool_lock:
+        if _evaluate_pool is None:
+            _evaluate_pool = ProcessPoolExecutor(
+                EVALUATE_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+        return _evaluate_pool
+
+
+# In evaluation worker processes: (database name, schema name) -> (version,
+# TriggerEngine) of the schemas evaluated last
+_worker_engines: dict[tuple[str, str], tuple] = {}
+
+
+def _evaluate_chunk(key: tuple[str, str], version, schema_json: str, inputs: list) -> list[dict]:
+    cached = _worker_engines.get(key)
+    if cached is None or version is None or cached[0] != version:
+        cached = _worker_engines[key] = (version, TriggerEngine(schema_from_dict(json.loads(schema_json))))
+    field_dicts = {}
+    return [_evaluate_input(cached[1], data, field_dicts) for data in inputs]
+
+
+def _evaluate_all(name: str, cached: CachedSchema, inputs: list) -> list[dict]:
+    """Evaluate a list of inputs, across worker processes if it is large."""
+    global _evaluate_pool
+    if EVALUATE_PROCESSES > 0 and len(inputs) >= EVALUATE_POOL_THRESHOLD:
+        chunks = [inputs[start:start + EVALUATE_CHUNK_SIZE]
+                  for start in range(0, len(inputs), EVALUATE_CHUNK_SIZE)]
+        evaluate_chunk = partial(_evaluate_chunk, (db.name, name), cached.version, cached.schema_json)
+        pool = _get_evaluate_pool()
+        try:
+            return [result for results in pool.map(evaluate_chunk, chunks)
+                    for result in results]
+        except BrokenProcessPool:
+            # a worker died; start a new pool next time, evaluate this batch here
+            with _evaluate_pool_lock:
+                if _evaluate_pool is pool:
+                    _evaluate_pool = None
+    field_dicts = {}
+    return [_evaluate_input(cached.engine, data, field_dicts) for data in inputs]
+
+
+def _ndjson_inputs(lines):
+    for line in lines:
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield None
+
+
+@bp.route("/<name>/evaluate/batch", methods=["POST"])
+def evaluate_schema_batch(name: str):
+    """
+    Evaluate many inputs against one schema in a single request.
+
+    Request body: a JSON array of evaluate request bodies, or with
+    Content-Type application/x-ndjson, one evaluate request body per line.
+
+    Response: {"results": [...]} in input order, or one result per line for
+    NDJSON requests. Each result is an evaluate response, or {"error": ...}
+    for an input that could not be evaluated.
+    """
+    cached = _get_cached_schema(name)
+    if not cached:
+        return jsonify({"error": f"Schema '{name}' not found"}), 404
+
+    if request.mimetype in ("application/x-ndjson", "application/jsonl"):
+        # request.stream reads lines a byte at a time without a buffer
+        lines = io.BufferedReader(request.stream, 1 << 16)
+        if EVALUATE_PROCESSES > 0:
+            results = _evaluate_all(name, cached, list(_ndjson_inputs(lines)))
+        else:
+            field_dicts = {}
+            results = (_evaluate_input(cached.engine, data, field_dicts)
+                       for data in _ndjson_inputs(lines))
+        return Response(stream_with_context(json.dumps(result) + "\n" for result in results),
+                        mimetype="application/x-ndjson")
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, list):
+        return jsonify({"error": "Request body must be a JSON array"}), 400
+    return jsonify({"results": _evaluate_all(name, cached, data)})
 
 
 @bp.route("/<name>", methods=["PUT"])
@@ -275,10 +468,8 @@ def search_bundles(name: str):
         "intersection_fields": [...]
     }
     """
-    from .trigger_engine import schema_field_to_dict
-
-    schema = _get_schema(name)
-    if not schema:
+    cached = _get_cached_schema(name)
+    if not cached:
         return jsonify({"error": f"Schema '{name}' not found"}), 404
 
     field_name = request.args.get("field", "")
@@ -290,57 +481,12 @@ def search_bundles(name: str):
     if not field_name:
         return jsonify({"error": "field parameter required"}), 400
 
-    # Find all mixins that have children triggered by this field
-    matching_bundles = []
-
-    for mixin_name, mixin in schema.mixins.items():
-        for child in mixin.children:
-            # Check if this child is triggered by the target field
-            if child.trigger.field_name == field_name:
-                child_mixin = schema.mixins.get(child.mixin_name)
-                if child_mixin:
-                    # Apply filters based on search mode
-                    matches = False
-
-                    if exact_value:
-                        # Exact trigger value match mode
-                        trigger_val = child.trigger.value
-                        if child.trigger.operator == "eq":
-                            matches = trigger_val == exact_value
-                        elif child.trigger.operator == "in":
-                            matches = exact_value in (trigger_val if isinstance(trigger_val, list) else [trigger_val])
-                        # Other operators could be added as needed
-                    elif query:
-                        # Prefix match on mixin name
-                        matches = child_mixin.name.lower().startswith(query)
-                    else:
-                        # No filter - return all
-                        matches = True
-
-                    if matches:
-                        # Convert to bundle format
-                        bundle = {
-                            "id": child_mixin.name,
-                            "name": child_mixin.name,
-                            "fields": [schema_field_to_dict(f) for f in child_mixin.fields],
-                        }
-                        # Avoid duplicates (same mixin can be referenced by multiple parents)
-                        if not any(b["id"] == bundle["id"] for b in matching_bundles):
-                            matching_bundles.append(bundle)
+    matching_bundles = cached.bundles.search(field_name, query, exact_value)
 
     # Compute intersection fields if active mixins provided
     intersection_fields = []
     if active_mixins and matching_bundles:
-        active_set = set(active_mixins)
-        for rule in schema.intersections:
-            # Check if adding any of the matching bundles would trigger this intersection
-            for bundle in matching_bundles:
-                test_set = active_set | {bundle["id"]}
-                if all(m in test_set for m in rule.when):
-                    for f in rule.adds:
-                        field_dict = schema_field_to_dict(f)
-                        if field_dict not in intersection_fields:
-                            intersection_fields.append(field_dict)
+        intersection_fields = cached.bundles.intersection_fields(active_mixins, matching_bundles)
 
     return jsonify({
         "bundles": matching_bundles,
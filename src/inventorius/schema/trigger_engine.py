@@ -6,8 +6,9 @@ Mixins are scoped - a child mixin can only trigger if its parent is active.
 """
 
 from dataclasses import dataclass, field
-from typing import Any
+from typing import Any, Callable
 import json
+import operator
 
 
 @dataclass
@@ -28,7 +29,11 @@ class TriggerCondition:
     value: Any  # Single value, list for "in", or list of TriggerConditions for "and"
 
     def evaluate(self, field_values: dict) -> bool:
-        """Check if this condition is met by the given field values."""
+        """Check if this condition is met by the given field values.
+
+        Reference interpreter. TriggerEngine evaluates compile_trigger(self)
+        instead, which gives the same result without re-dispatching per call.
+        """
         # Special case: "and" combines multiple conditions
         if self.operator == "and":
             # value is a list of TriggerCondition objects
@@ -95,12 +100,106 @@ class Schema:
     intersections: list[IntersectionRule] = field(default_factory=list)
 
 
+def trigger_fields(trigger: TriggerCondition) -> set[str]:
+    """Names of the fields a trigger condition reads."""
+    if trigger.operator == "and":
+        return set().union(*(trigger_fields(cond) for cond in trigger.value))
+    return {trigger.field_name}
+
+
+_UNSET = object()
+
+Predicate = Callable[[dict], bool]
+
+_COMPARISONS = {
+    "eq": operator.eq,
+    "neq": operator.ne,
+    "lt": operator.lt,
+    "gt": operator.gt,
+    "lte": operator.le,
+    "gte": operator.ge,
+}
+OPERATORS = frozenset(_COMPARISONS) | {"in", "set", "and"}
+
+
+def _and_leaves(trigger: TriggerCondition):
+    """Conditions of an "and" trigger, with nested "and"s flattened."""
+    for cond in trigger.value:
+        if cond.operator == "and":
+            yield from _and_leaves(cond)
+        else:
+            yield cond
+
+
+def compile_trigger(trigger: TriggerCondition) -> Predicate:
+    """Compile a trigger condition into a predicate over field values.
+
+    The predicate agrees with trigger.evaluate. Unknown operators raise
+    ValueError here, when the schema is loaded, rather than on evaluation.
+    """
+    op = trigger.operator
+    if op not in OPERATORS:
+        raise ValueError(f"Unknown operator: {op}")
+
+    if op == "and":
+        predicates = tuple(compile_trigger(cond) for cond in _and_leaves(trigger))
+        if len(predicates) == 1:
+            return predicates[0]
+
+        def all_of(field_values):
+            for predicate in predicates:
+                if not predicate(field_values):
+                    return False
+            return True
+        return all_of
+
+    name = trigger.field_name
+    value = trigger.value
+
+    if op == "set":
+        def is_set(field_values):
+            actual = field_values.get(name, _UNSET)
+            return (actual is not _UNSET and actual is not None
+                    and actual != "" and actual != [])
+        return is_set
+
+    if op == "in":
+        options = value
+        if isinstance(value, list):
+            try:
+                options = frozenset(value)
+            except TypeError:
+                pass  # unhashable options, keep the linear scan
+
+        def is_in(field_values):
+            actual = field_values.get(name, _UNSET)
+            if actual is _UNSET:
+                return False
+            try:
+                return actual in options
+            except TypeError:
+                # unhashable value checked against a frozenset
+                return actual in value
+        return is_in
+
+    compare = _COMPARISONS[op]
+
+    def compare_field(field_values):
+        actual = field_values.get(name, _UNSET)
+        return actual is not _UNSET and compare(actual, value)
+    return compare_field
+
+
 @dataclass
 class FormState:
     """Current state of a form being filled out."""
     active_mixins: list[str]
     field_values: dict[str, Any]
     available_fields: list[SchemaField]
+    # The mixins evaluation started from, and the outcome of each trigger checked
+    # keyed by (parent mixin, child index). Used by TriggerEngine.update.
+    requested_mixins: list[str] = field(default_factory=list)
+    trigger_results: dict[tuple[str, int], bool] = field(default_factory=dict)
 
     def to_dict(self) -> dict:
         return {
@@ -111,64 +210,130 @@ class FormState:
 
 
 class TriggerEngine:
-    """Evaluates triggers and computes form state."""
+    """Evaluates triggers and computes form state.
+
+    The schema is compiled and indexed once per engine: a predicate for each
+    trigger, which triggers read each field and which intersection rules
+    mention each mixin. Evaluation is then a single pass over a worklist of
+    activated mixins.
+    """
 
     def __init__(self, schema: Schema):
         self.schema = schema
 
+        # mixin name -> compiled trigger of each child, by child index
+        self.child_predicates: dict[str, list[Predicate]] = {
+            parent_name: [compile_trigger(child.trigger) for child in mixin.children]
+            for parent_name, mixin in schema.mixins.items()
+        }
+
+        # field name -> {(parent mixin, child index)} of the triggers reading it
+        self.trigger_dependencies: dict[str, set[tuple[str, int]]] = {}
+        for parent_name, mixin in schema.mixins.items():
+            for index, child in enumerate(mixin.children):
+                for field_name in trigger_fields(child.trigger):
+                    self.trigger_dependencies.setdefault(field_name, set()).add(
+                        (parent_name, index))
+
+        # mixin name -> indices of the intersection rules requiring it
+        self.intersection_index: dict[str, list[int]] = {}
+        self.rule_sizes = []
+        self.unconditional_rules = []
+        for rule_index, rule in enumerate(schema.intersections):
+            members = set(rule.when)
+            self.rule_sizes.append(len(members))
+            if not members:
+                self.unconditional_rules.append(rule_index)
+            for mixin_name in members:
+                self.intersection_index.setdefault(mixin_name, []).append(rule_index)
+
     def evaluate(self, active_mixins: list[str], field_values: dict) -> FormState:
         """
         Compute the complete form state given active mixins and field values.
 
-        Iterates until no new mixins trigger.
-        Maintains activation order for consistent field ordering.
+        Activates children until no new mixins trigger, evaluating each trigger
+        at most once. Maintains activation order for consistent field ordering.
         """
-        # Use list for order, set for fast lookup
-        active_list = list(active_mixins)
-        active_set = set(active_mixins)
-        fields = []
+        return self._evaluate(active_mixins, field_values, {})
 
-        changed = True
-        iterations = 0
-        max_iterations = 100  # Safety limit
-
-        while changed and iterations < max_iterations:
-            changed = False
-            iterations += 1
-
-            # Collect fields from all active mixins (in activation order)
-            fields = []
-            for mixin_name in active_list:
-                mixin = self.schema.mixins.get(mixin_name)
-                if mixin:
-                    fields.extend(mixin.fields)
-
-            # Check each active mixin's children (in activation order)
-            for mixin_name in active_list:
-                mixin = self.schema.mixins.get(mixin_name)
-                if not mixin:
-                    continue
+    def update(self, previous: FormState, field_delta: dict) -> FormState:
+        """
+        Compute the form state after `field_delta` is applied to `previous`.
 
-                for child in mixin.children:
-                    if child.mixin_name not in active_set:
-                        if child.trigger.evaluate(field_values):
-                            active_list.append(child.mixin_name)
-                            active_set.add(child.mixin_name)
-                            changed = True
-
-            # Check intersection rules
-            for rule in self.schema.intersections:
-                if all(m in active_set for m in rule.when):
-                    # Add intersection fields (avoid duplicates by name)
-                    existing_names = {f.name for f in fields}
-                    for f in rule.adds:
-                        if f.name not in existing_names:
-                            fields.append(f)
+        Only triggers reading a changed field are evaluated again, the others
+        reuse their outcome from `previous`, which must come from this engine.
+        The result equals evaluate(previous.requested_mixins, new field values).
+        """
+        field_values = {**previous.field_values, **field_delta}
+        known = dict(previous.trigger_results)
+        for field_name, value in field_delta.items():
+            if previous.field_values.get(field_name, _UNSET) != value:
+                for key in self.trigger_dependencies.get(field_name, ()):
+                    known.pop(key, None)
+        return self._evaluate(previous.requested_mixins, field_values, known)
+
+    def _evaluate(self, requested_mixins: list[str], field_values: dict,
+                  known_results: dict[tuple[str, int], bool]) -> FormState:
+        mixins = self.schema.mixins
+
+        # Use list for order (and as the worklist), set for fast lookup
+        active_list = list(requested_mixins)
+        active_set = set(requested_mixins)
+        trigger_results = {}
+
+        position = 0
+        while position < len(active_list):
+            mixin_name = active_list[position]
+            position += 1
+            mixin = mixins.get(mixin_name)
+            if not mixin:
+                continue
+
+            predicates = self.child_predicates[mixin_name]
+            for index, child in enumerate(mixin.children):
+                if child.mixin_name in active_set:
+                    continue
+                key = (mixin_name, index)
+                fired = trigger_results.get(key)
+                if fired is None:
+                    fired = known_results.get(key)
+                    if fired is None:
+                        fired = predicates[index](field_values)
+                    trigger_results[key] = fired
+                if fired:
+                    active_list.append(child.mixin_name)
+                    active_set.add(child.mixin_name)
+
+        # Collect fields from all active mixins (in activation order)
+        fields = []
+        for mixin_name in active_list:
+            mixin = mixins.get(mixin_name)
+            if mixin:
+                fields.extend(mixin.fields)
+
+        # Intersection rules whose mixins are all active, in schema order
+        active_counts = {}
+        for mixin_name in active_set:
+            for rule_index in self.intersection_index.get(mixin_name, ()):
+                active_counts[rule_index] = active_counts.get(rule_index, 0) + 1
+        satisfied = sorted([rule_index for rule_index, count in active_counts.items()
+                            if count == self.rule_sizes[rule_index]]
+                           + self.unconditional_rules)
+        if satisfied:
+            # Add intersection fields (avoid duplicates by name)
+            existing_names = {f.name for f in fields}
+            for rule_index in satisfied:
+                added = [f for f in self.schema.intersections[rule_index].adds
+                         if f.name not in existing_names]
+                fields.extend(added)
+                existing_names.update(f.name for f in added)
 
         return FormState(
             active_mixins=active_list,  # Preserve activation order
             field_values=field_values,
             available_fields=fields,
+            requested_mixins=list(requested_mixins),
+            trigger_results=trigger_results,
         )
 
     def get_root_mixins(self) -> list[str]:
@@ -207,6 +372,8 @@ def trigger_to_dict(t: TriggerCondition) -> dict:
 
 
 def trigger_from_dict(d: dict) -> TriggerCondition:
+    if d["op"] not in OPERATORS:
+        raise ValueError(f"Unknown operator: {d['op']}")
     if d["op"] == "and":
         # Recursively deserialize nested conditions
         return TriggerCondition(
@@ -3,12 +3,11 @@ from voluptuous.error import MultipleInvalid
 from voluptuous.schema_builder import Required
 from inventorius.data_models import Sku, Bin, Batch, DataModelJSONEncoder as Encoder
 from inventorius.db import db
-from inventorius.util import admin_increment_code, check_code_list, no_cache
+from inventorius.util import admin_increment_code, check_code_list, item_locations, item_totals, no_cache
 from inventorius.validation import new_sku_schema, prefixed_id, sku_patch_schema, validate_url_id
 import inventorius.util_error_responses as problem
 from inventorius.resource_models import SkuEndpoint
 
-from pymongo import TEXT
 
 import json
 
@@ -30,12 +29,6 @@ def skus_post():
     admin_increment_code("SKU", sku.id)
     db.sku.insert_one(sku.to_mongodb_doc())
     # dbSku = Sku.from_mongodb_doc(db.sku.find_one({'id': sku.id}))
-
-    # Add text index if not yet created
-    # TODO: This should probably be turned into a global flag
-    if "name_text" not in db.sku.index_information().keys():
-        # print("Creating text index for sku#name") # was too noisy
-        db.sku.create_index([("name", TEXT)])
     return SkuEndpoint.from_sku(sku).created_success_response()
 
 
@@ -48,7 +41,7 @@ def sku_get(id):
     sku = Sku.from_mongodb_doc(db.sku.find_one({"_id": id}))
     if sku is None:
         return problem.missing_bin_response(id)
-    return SkuEndpoint.from_sku(sku).get_response()
+    return SkuEndpoint.from_sku(sku, totals=item_totals(id)).get_response()
 
 
 @ sku.route('/api/sku/<id>', methods=['PATCH'])
@@ -101,8 +94,7 @@ def sku_delete(id):
         })
         return resp
 
-    num_contained_by_bins = db.bin.count_documents(
-        {f"contents.{id}": {"$exists": True}})
+    num_contained_by_bins = db.bin.count_documents({"contents_keys": id}, limit=1)
     if num_contained_by_bins > 0:
         resp.status_code = 403
         resp.mimetype = "application/problem+json"
@@ -140,9 +132,7 @@ def sku_bins_get(id):
         })
         return resp
 
-    contained_by_bins = [Bin.from_mongodb_doc(bson) for bson in db.bin.find(
-        {f"contents.{id}": {"$exists": True}})]
-    locations = {bin.id: {id: bin.contents[id]} for bin in contained_by_bins}
+    locations = item_locations(id)
 
     resp.status_code = 200
     resp.mimetype = "application/json"
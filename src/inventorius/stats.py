@@ -0,0 +1,68 @@
+"""Inventory statistics for /api/stats, cached in-process.
+
+Wall displays poll the stats every few seconds, so they are computed at most
+once per `STATS_TTL` seconds per process and shared by every request in
+between.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+STATS_TTL = float(os.getenv("INVENTORIUS_STATS_TTL", "5"))
+N_RECENT = 5
+
+# database name -> (expires, stats, etag)
+_cache = {}
+_refresh_lock = threading.Lock()
+
+
+def compute_stats(database):
+    """Counts come from collection metadata or indexes, so no query scans a
+    whole collection except the sum over the per-item totals."""
+    units = list(database.totals.aggregate([
+        {"$group": {"_id": None, "n": {"$sum": "$quantity"}}}]))
+
+    return {
+        "counts": {
+            "bins": database.bin.estimated_document_count(),
+            "skus": database.sku.estimated_document_count(),
+            "batches": database.batch.estimated_document_count(),
+            # contents_keys is indexed, and empty exactly when contents is
+            "empty_bins": database.bin.count_documents({"contents_keys": []}),
+            "units_on_hand": units[0]["n"] if units else 0,
+        },
+        "recent_bins": [{"id": doc["_id"], "props": doc.get("props", {})}
+                        for doc in database.bin.find({}, {"props": 1})
+                        .sort("_id", -1).limit(N_RECENT)],
+        "recent_skus": [{"id": doc["_id"], "name": doc.get("name", "")}
+                        for doc in database.sku.find({}, {"name": 1})
+                        .sort("_id", -1).limit(N_RECENT)],
+    }
+
+
+def get_stats(database):
+    """Returns (stats, etag), recomputing them at most once per STATS_TTL.
+
+    Only one thread refreshes expired stats. The others keep serving the
+    previous stats meanwhile, or wait for the refresh if there are none yet.
+    """
+    cached = _cache.get(database.name)
+    if cached and cached[0] > time.monotonic():
+        return cached[1], cached[2]
+
+    if not _refresh_lock.acquire(blocking=cached is None):
+        return cached[1], cached[2]
+    try:
+        cached = _cache.get(database.name)
+        if cached and cached[0] > time.monotonic():
+            return cached[1], cached[2]
+        stats = compute_stats(database)
+        etag = hashlib.sha1(json.dumps(stats, sort_keys=True, default=str)
+                            .encode("utf-8")).hexdigest()
+        _cache[database.name] = (time.monotonic() + STATS_TTL, stats, etag)
+        return stats, etag
+    finally:
+        _refresh_lock.release()
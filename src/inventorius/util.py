@@ -6,6 +6,8 @@ from flask_principal import Principal, Permission, RoleNeed
 import re
 from string import ascii_letters
 
+from pymongo import DESCENDING, ReturnDocument
+
 from inventorius.db import db
 
 login_manager = LoginManager()
@@ -37,99 +39,114 @@ def owned_code_get(id):
     return existing
 
 
+def code_number(code):
+    return int(re.sub('[^0-9]', '', code))
+
+
 def admin_increment_code(prefix, code):
-    """Record that a code was used and update next if needed.
+    """Move the high-water mark of a prefix past a used code.
 
-    Maintains an ordered list of all IDs ever used to ensure IDs are never reused,
-    even if items are deleted.
+    The high-water mark only ever grows (through $max), so IDs are never
+    reused, even if items are deleted, and concurrent creators can't lose
+    each other's updates. Cost is constant no matter how many IDs exist.
     """
-    code_number = int(re.sub('[^0-9]', '', code))
+    number = code_number(code)
 
-    # Ensure admin doc exists
-    admin_get_next(prefix)
+    if not db.admin.find_one_and_update(
+            {"_id": prefix, "high_water": {"$exists": True}},
+            {"$max": {"high_water": number}},
+            projection={"_id": 1}):
+        # first use of this prefix, or an admin doc in the old format
+        admin_get_next(prefix)
+        db.admin.update_one({"_id": prefix}, {"$max": {"high_water": number}})
 
-    # Add code to used list and update next if this is a new max
-    doc = db.admin.find_one({"_id": prefix})
-    used = doc.get("used", [])
 
-    if code_number not in used:
-        used.append(code_number)
-        used.sort()
-        max_used = max(used)
-        db.admin.update_one(
-            {"_id": prefix},
-            {"$set": {
-                "used": used,
-                "next": f"{prefix}{max_used + 1:06}"
-            }}
-        )
+# collection holding the documents of each ID prefix
+ID_COLLECTIONS = {"SKU": "sku", "BAT": "batch", "BIN": "bin"}
 
 
 def admin_get_next(prefix):
     """Get the next unused ID for a prefix (SKU, BAT, BIN).
 
-    Returns the next ID that has never been used, tracked via a persistent
-    'used' list that survives item deletions.
+    Returns the ID after the high-water mark of every ID ever used, which
+    survives item deletions. `flask migrate` sets the mark of each prefix from
+    its numerically highest existing ID. A prefix it has not seen starts after
+    its last ID in string order instead, one read of the _id index, since
+    requests must not scan.
     """
-    def collect_existing_ids(collection, prefix_str):
-        """One-time migration: collect all existing IDs from a collection."""
-        cursor = collection.find({}, {"_id": 1})
-        ids = []
-        for doc in cursor:
-            try:
-                code_number = int(re.sub('[^0-9]', '', doc['_id']))
-                ids.append(code_number)
-            except (ValueError, KeyError):
-                continue
-        return sorted(ids)
-
     next_code_doc = db.admin.find_one({"_id": prefix})
 
-    if not next_code_doc:
-        # Initialize: collect existing IDs (one-time migration)
-        if prefix == "SKU":
-            used = collect_existing_ids(db.sku, "SKU")
-        elif prefix == "BAT":
-            used = collect_existing_ids(db.batch, "BAT")
-        elif prefix == "BIN":
-            used = collect_existing_ids(db.bin, "BIN")
-        else:
+    if not next_code_doc or "high_water" not in next_code_doc:
+        if prefix not in ID_COLLECTIONS:
             raise Exception("bad prefix", prefix)
+        last = db[ID_COLLECTIONS[prefix]].find_one(
+            {"_id": {"$regex": f"^{prefix}[0-9]+$"}}, {"_id": 1}, sort=[("_id", DESCENDING)])
+        high_water = code_number(last["_id"]) if last else 0
+        if next_code_doc and "next" in next_code_doc:
+            # admin doc in the old format, until `flask migrate-ids` is run
+            high_water = max(high_water, code_number(next_code_doc["next"]) - 1)
+        next_code_doc = db.admin.find_one_and_update(
+            {"_id": prefix},
+            {"$max": {"high_water": high_water}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER)
 
-        max_used = max(used) if used else 0
-        db.admin.insert_one({
-            "_id": prefix,
-            "next": f"{prefix}{max_used + 1:06}",
-            "used": used
-        })
-        next_code_doc = db.admin.find_one({"_id": prefix})
-
-    # Migrate old docs that don't have 'used' field
-    if "used" not in next_code_doc:
-        if prefix == "SKU":
-            used = collect_existing_ids(db.sku, "SKU")
-        elif prefix == "BAT":
-            used = collect_existing_ids(db.batch, "BAT")
-        elif prefix == "BIN":
-            used = collect_existing_ids(db.bin, "BIN")
-        else:
-            raise Exception("bad prefix", prefix)
+    return f"{prefix}{next_code_doc['high_water'] + 1:06}"
 
-        max_used = max(used) if used else 0
-        current_next = int(re.sub('[^0-9]', '', next_code_doc['next']))
-        # Keep the higher of current next or max_used + 1
-        new_next = max(current_next, max_used + 1)
 
-        db.admin.update_one(
-            {"_id": prefix},
-            {"$set": {
-                "used": used,
-                "next": f"{prefix}{new_next:06}"
-            }}
-        )
-        next_code_doc = db.admin.find_one({"_id": prefix})
-
-    return next_code_doc['next']
+def admin_reserve_codes(prefix, count):
+    """Atomically reserve `count` sequential IDs for a prefix.
+
+    The reserved block lies below the new high-water mark, so it is never
+    reissued by admin_get_next or another reservation.
+    """
+    admin_get_next(prefix)
+    doc = db.admin.find_one_and_update(
+        {"_id": prefix},
+        {"$inc": {"high_water": count}},
+        projection={"high_water": 1},
+        return_document=ReturnDocument.AFTER)
+    first = doc["high_water"] - count + 1
+    return [f"{prefix}{number:06}" for number in range(first, doc["high_water"] + 1)]
+
+
+# Bins keep the keys of `contents` in an indexed `contents_keys` array, since
+# the keys of a subdocument can't be indexed. Every contents update goes
+# through these helpers so both change in the same atomic update.
+
+def contents_inc(item_id, quantity):
+    """Bin update adding `quantity` (may be negative) of an item to its contents."""
+    update = {"$inc": {f"contents.{item_id}": quantity}}
+    if quantity > 0:
+        update["$addToSet"] = {"contents_keys": item_id}
+    return update
+
+
+def contents_unset(item_id):
+    """Bin update removing an item from its contents."""
+    return {"$unset": {f"contents.{item_id}": ""},
+            "$pull": {"contents_keys": item_id}}
+
+
+def item_locations(item_id):
+    """{bin id: {item_id: quantity}} of every bin holding an item."""
+    return {doc["_id"]: {item_id: doc["contents"][item_id]}
+            for doc in db.bin.find({"contents_keys": item_id, f"contents.{item_id}": {"$exists": True}},
+                                   {f"contents.{item_id}": 1})}
+
+
+# The `totals` collection holds {_id: item id, quantity, bins}: the units of
+# each sku or batch held and the number of bins holding it. It is updated
+# alongside contents and rebuilt by `flask rebuild-totals`.
+
+def totals_inc(quantity, bins):
+    """Totals update (upsert) for a change in units held and bins holding an item."""
+    return {"$inc": {"quantity": quantity, "bins": bins}}
+
+
+def item_totals(item_id):
+    doc = db.totals.find_one({"_id": item_id}) or {}
+    return {"quantity": doc.get("quantity", 0), "bins": doc.get("bins", 0)}
 
 
 def check_code_list(codes):
@@ -12,7 +12,8 @@ problem_titles = {
     "insufficient-quantity": "Requested greater quantity than is available.",
     "invalid-credentials": "Identity not authorized.",
     "account-deactivated": "Account is deactivated.",
-    "dangerous-operation": "This operation requires force=true."
+    "dangerous-operation": "This operation requires force=true.",
+    "concurrent-modification": "Resource changed while the request was applied. Nothing was changed, try again."
 }
 
 
@@ -214,3 +215,13 @@ def release_insufficient_quantity():
             "title": problem_titles["insufficient-quantity"],
         }
     )
+
+
+def concurrent_modification_response():
+    return problem_response(
+        status_code=409,
+        json={
+            "type": "concurrent-modification",
+            "title": problem_titles["concurrent-modification"],
+        }
+    )
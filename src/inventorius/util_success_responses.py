@@ -26,13 +26,21 @@ def moved_response():
         state={"status": "items moved"}
     ).get_response(200)
 
-def bin_contents_post_response(quantity):
+def contents_change_status(quantity):
     if quantity > 0:
-        status = "items received"
+        return "items received"
     if quantity < 0:
-        status = "items released"
-    if quantity == 0:
-        status = "no change"
+        return "items released"
+    return "no change"
+
+
+def bin_contents_post_response(quantity):
+    return HypermediaEndpoint(
+        state={"status": contents_change_status(quantity)}
+    ).get_response(201)
+
+
+def bins_contents_post_response(results):
     return HypermediaEndpoint(
-        state={"status": status}
-    ).get_response(201)
\ No newline at end of file
+        state={"results": results}
+    ).get_response(200)
\ No newline at end of file
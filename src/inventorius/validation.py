@@ -249,3 +249,11 @@ item_release_receive_schema = Schema(
         Required("quantity"): int,  # can be positive or negative
     }
 )
+
+bulk_release_receive_schema = Schema(
+    {
+        Required("deltas"): All(
+            [item_release_receive_schema.extend({Required("bin_id"): prefixed_id("BIN")})],
+            Length(min=1, max=1000)),
+    }
+)
@@ -0,0 +1,55 @@
+"""Benchmark bundle search on a schema with tens of thousands of mixins.
+
+Not collected by pytest. Run with:
+
+    python -m tests.benchmark_bundles [n_mixins]
+"""
+
+import random
+import sys
+import time
+
+from inventorius.schema import ChildMixin, IntersectionRule, Mixin, Schema, SchemaField, TriggerCondition
+from inventorius.schema.bundles import BundleIndex
+
+N_MIXINS = 50000
+N_QUERIES = 1000
+
+
+def make_schema(n_mixins):
+    rng = random.Random(0)
+    names = [f"Part{i:05}" for i in range(n_mixins)]
+    mixins = {name: Mixin(name, [SchemaField(f"{name.lower()}_note", "text")]) for name in names}
+    mixins["Root"] = Mixin("Root", children=[
+        ChildMixin(name, TriggerCondition("part", "eq", name)) for name in names])
+    intersections = [IntersectionRule(rng.sample(names, 2), [SchemaField(f"extra{i}", "text")])
+                     for i in range(n_mixins // 10)]
+    return Schema(["Root"], mixins, intersections)
+
+
+def per_query(f, queries):
+    start = time.perf_counter()
+    for query in queries:
+        f(query)
+    return (time.perf_counter() - start) / len(queries) * 1e6
+
+
+def main(n_mixins=N_MIXINS):
+    schema = make_schema(n_mixins)
+    start = time.perf_counter()
+    index = BundleIndex(schema)
+    build = time.perf_counter() - start
+
+    rng = random.Random(1)
+    prefixes = [f"part{rng.randrange(n_mixins):05}"[:8] for _ in range(N_QUERIES)]
+    values = [f"Part{rng.randrange(n_mixins):05}" for _ in range(N_QUERIES)]
+
+    print(f"{n_mixins} mixins, index built in {build * 1000:.1f} ms")
+    print(f"  prefix search:       {per_query(lambda q: index.search('part', query=q), prefixes):.2f} us/query")
+    print(f"  value search:        {per_query(lambda v: index.search('part', exact_value=v), values):.2f} us/query")
+    print("  value, intersections: {:.2f} us/query".format(per_query(
+        lambda v: index.intersection_fields(["Root", v], index.search("part", exact_value=v)), values)))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else N_MIXINS)
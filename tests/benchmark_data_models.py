@@ -0,0 +1,96 @@
+"""Benchmarks for bulk DataModel conversion.
+
+Not collected by pytest. Run with:
+
+    python -m tests.benchmark_data_models
+"""
+
+import time
+import tracemalloc
+
+from bson.decimal128 import Decimal128
+
+import inventorius.data_models as data_models
+from inventorius.data_models import Batch, Bin, Sku
+
+N_DOCS = 10000
+N_MEMORY_DOCS = 200000
+
+
+def make_docs(n=N_DOCS):
+    bins = [{"_id": f"BIN{i:06}", "props": {"note": str(i)},
+             "contents": {f"SKU{i:06}": i % 7 + 1}} for i in range(n)]
+    skus = [{"_id": f"SKU{i:06}", "owned_codes": [str(i)], "associated_codes": [],
+             "name": f"sku {i}", "props": {}} for i in range(n)]
+    batches = [{"_id": f"BAT{i:06}", "sku_id": f"SKU{i:06}", "name": f"batch {i}",
+                "owned_codes": [], "associated_codes": [],
+                "props": {"cost_per_case": {"unit": "USD", "value": Decimal128("1.25")},
+                          "extra": i}} for i in range(n)]
+    return [(Bin, bins), (Sku, skus), (Batch, batches)]
+
+
+def convert_all(model_docs):
+    for model, docs in model_docs:
+        for doc in docs:
+            obj = model.from_mongodb_doc(doc)
+            obj.to_mongodb_doc()
+            obj.to_dict(mask_default=True)
+
+
+def timed(f, *args, **kwargs):
+    start = time.perf_counter()
+    f(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def convert_all_reflective(model_docs):
+    """Recompiles the field plan on every lookup, which is what the conversion
+    methods did before plans were cached."""
+    cached_get_field_plan = data_models.get_field_plan
+    data_models.get_field_plan = data_models.FieldPlan
+    try:
+        convert_all(model_docs)
+    finally:
+        data_models.get_field_plan = cached_get_field_plan
+
+
+def bin_docs(n):
+    for i in range(n):
+        yield {"_id": f"BIN{i:06}", "props": None, "contents": {f"SKU{i:06}": 1}}
+
+
+def retained_bytes(build):
+    """Bytes still allocated after building a result from freshly generated docs."""
+    tracemalloc.start()
+    result = build()
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return retained
+
+
+def main_memory():
+    """Memory a search page of every bin holds, as /api/search built it before
+    (a list of Bin) and now (DataModelColumns)."""
+    as_list = retained_bytes(
+        lambda: [Bin.from_mongodb_doc(doc) for doc in bin_docs(N_MEMORY_DOCS)])
+    as_columns = retained_bytes(
+        lambda: Bin.from_mongodb_docs(bin_docs(N_MEMORY_DOCS)))
+    print(f"{N_MEMORY_DOCS} bins retained")
+    print(f"  list of Bin:      {as_list / 2**20:.1f} MiB")
+    print(f"  DataModelColumns: {as_columns / 2**20:.1f} MiB")
+
+
+def main():
+    model_docs = make_docs()
+    reflective = timed(convert_all_reflective, model_docs)
+    planned = timed(convert_all, model_docs)
+    print(f"{N_DOCS} docs x {len(model_docs)} models")
+    print(f"  per-call reflection: {reflective:.3f}s")
+    print(f"  cached field plan:   {planned:.3f}s")
+    print(f"  speedup:             {reflective / planned:.1f}x")
+    main_memory()
+
+
+if __name__ == "__main__":
+    main()
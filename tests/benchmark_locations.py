@@ -0,0 +1,76 @@
+"""Benchmark "which bins hold this item" lookups on a large bin collection.
+
+Needs a running mongodb (INVENTORIUS_MONGO_HOST/PORT). Not collected by pytest.
+Run with:
+
+    python -m tests.benchmark_locations [n_bins]
+"""
+
+import random
+import sys
+import time
+
+from inventorius.db import ensure_indexes, get_mongo_client
+
+N_BINS = 1000000
+N_SKUS = 50000
+INSERT_BATCH = 10000
+N_LOOKUPS = 1000
+N_SCANS = 5
+
+
+def make_bins(n_bins):
+    rng = random.Random(0)
+    for i in range(n_bins):
+        contents = {f"SKU{rng.randrange(N_SKUS):06}": rng.randint(1, 9)
+                    for _ in range(rng.randint(0, 3))}
+        yield {"_id": f"BIN{i:06}", "contents": contents,
+               "contents_keys": list(contents)}
+
+
+def populate(database, n_bins):
+    database.bin.drop()
+    batch = []
+    for doc in make_bins(n_bins):
+        batch.append(doc)
+        if len(batch) == INSERT_BATCH:
+            database.bin.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        database.bin.insert_many(batch, ordered=False)
+    ensure_indexes(database)
+
+
+def per_lookup(find, sku_ids):
+    start = time.perf_counter()
+    for sku_id in sku_ids:
+        list(find(sku_id))
+    return (time.perf_counter() - start) / len(sku_ids)
+
+
+def main(n_bins=N_BINS):
+    client = get_mongo_client()
+    database = client.benchmark_locations
+    try:
+        populate(database, n_bins)
+        rng = random.Random(1)
+        sku_ids = [f"SKU{rng.randrange(N_SKUS):06}" for _ in range(N_LOOKUPS)]
+
+        indexed = per_lookup(
+            lambda sku_id: database.bin.find({"contents_keys": sku_id},
+                                             {f"contents.{sku_id}": 1}),
+            sku_ids)
+        scan = per_lookup(
+            lambda sku_id: database.bin.find({f"contents.{sku_id}": {"$exists": True}},
+                                             {f"contents.{sku_id}": 1}),
+            sku_ids[:N_SCANS])
+
+        print(f"{n_bins} bins, {N_SKUS} skus")
+        print(f"  contents.<id> $exists scan: {scan * 1000:.3f} ms/lookup")
+        print(f"  contents_keys index:        {indexed * 1000:.3f} ms/lookup")
+    finally:
+        client.drop_database("benchmark_locations")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else N_BINS)
@@ -0,0 +1,84 @@
+"""Benchmark trigger evaluation on the sample electronics schema.
+
+Not collected by pytest. Run with:
+
+    python -m tests.benchmark_triggers
+"""
+
+import random
+import time
+
+from inventorius.schema import TriggerEngine
+from inventorius.schema.sample_schemas import get_electronics_schema
+from inventorius.schema.trigger_engine import compile_trigger
+
+N_FORMS = 20000
+N_PACKAGE_OPTIONS = 500
+
+
+def make_forms(schema, n=N_FORMS):
+    packages = [f"PKG{i}" for i in range(N_PACKAGE_OPTIONS)] + ["0402", "0603", "DIP", "TO-220"]
+    rng = random.Random(0)
+    roots = [name for name in schema.mixins if name != "ElectronicPackage"]
+    return [([rng.choice(roots)],
+             {"resistance": rng.choice([None, -1, 100, 10000]),
+              "capacitance": rng.choice([None, 1, 100]),
+              "package": rng.choice(packages),
+              "wire_gauge": rng.randint(8, 30)}) for _ in range(n)]
+
+
+def widen_in_triggers(schema):
+    """Pad "in" triggers to the size of a real package list."""
+    for mixin in schema.mixins.values():
+        for child in mixin.children:
+            if child.trigger.operator == "in":
+                child.trigger.value = child.trigger.value + [
+                    f"PKG{i}" for i in range(N_PACKAGE_OPTIONS)]
+
+
+def timed(f, forms):
+    start = time.perf_counter()
+    f(forms)
+    return (time.perf_counter() - start) / len(forms) * 1e6
+
+
+def main():
+    schema = get_electronics_schema()
+    widen_in_triggers(schema)
+    forms = make_forms(schema)
+    triggers = [child.trigger for mixin in schema.mixins.values() for child in mixin.children]
+    compiled = [compile_trigger(trigger) for trigger in triggers]
+
+    def interpreted_triggers(forms):
+        for _, values in forms:
+            for trigger in triggers:
+                try:
+                    trigger.evaluate(values)
+                except TypeError:
+                    pass
+
+    def compiled_triggers(forms):
+        for _, values in forms:
+            for predicate in compiled:
+                try:
+                    predicate(values)
+                except TypeError:
+                    pass
+
+    engine = TriggerEngine(schema)
+
+    def engine_evaluate(forms):
+        for roots, values in forms:
+            try:
+                engine.evaluate(roots, values)
+            except TypeError:
+                pass
+
+    print(f"{len(triggers)} triggers, 'in' lists of {N_PACKAGE_OPTIONS}+ options")
+    print(f"  TriggerCondition.evaluate: {timed(interpreted_triggers, forms):.2f} us/form")
+    print(f"  compiled predicates:       {timed(compiled_triggers, forms):.2f} us/form")
+    print(f"  TriggerEngine.evaluate:    {timed(engine_evaluate, forms):.2f} us/form")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""Benchmark CPU time spent processing an image upload and its renditions.
+
+Needs Wand (ImageMagick). Not collected by pytest. Run with:
+
+    python -m tests.benchmark_uploads [image ...]
+
+Without arguments a 4000x3000 test photo is generated.
+"""
+
+import importlib
+import os
+import sys
+import tempfile
+import time
+
+from wand.image import Image
+
+files = importlib.import_module("inventorius.files")
+
+N_RUNS = 5
+
+
+def cpu_per_run(f):
+    start = time.process_time()
+    for _ in range(N_RUNS):
+        f()
+    return (time.process_time() - start) / N_RUNS
+
+
+def main(paths):
+    with tempfile.TemporaryDirectory() as tmp:
+        if not paths:
+            paths = [os.path.join(tmp, "photo.jpg")]
+            with Image(width=4000, height=3000, pseudo="plasma:") as img:
+                img.save(filename=paths[0])
+
+        output = os.path.join(tmp, "out")
+        rendition_path = os.path.join(tmp, "rendition")
+
+        for path in paths:
+            print(path)
+            print("  resize on upload:                {:.0f} ms CPU".format(1000 * cpu_per_run(
+                lambda: files.render_image(path, output, files.MAX_IMAGE_DIMENSION))))
+            total = 0
+            for name, (size, image_format) in sorted(files.RENDITION_SPECS.items()):
+                cpu = cpu_per_run(lambda: files.render_image(output, rendition_path, size, image_format))
+                total += cpu
+                print("  {:<16} on first request: {:.0f} ms CPU".format(name, 1000 * cpu))
+            print("  all {} renditions, if all viewed: {:.0f} ms CPU".format(
+                len(files.RENDITION_SPECS), 1000 * total))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,74 @@
+"""Stress tests that fire parallel requests at the same documents."""
+
+from concurrent.futures import ThreadPoolExecutor
+
+from conftest import clientContext
+from inventorius import app as inventorius_flask_app
+
+N_THREADS = 8
+MOVES_PER_THREAD = 20
+STOCK = 100
+
+
+def test_parallel_moves_from_same_bin():
+    with clientContext() as client:
+        assert client.post("/api/bins", json={"id": "BIN000000"}).status_code == 201
+        assert client.post("/api/bins", json={"id": "BIN000001"}).status_code == 201
+        assert client.post("/api/skus", json={"id": "SKU000000"}).status_code == 201
+        rp = client.post("/api/bin/BIN000000/contents",
+                         json={"id": "SKU000000", "quantity": STOCK})
+        assert rp.status_code == 201
+
+        def move_one_at_a_time(_):
+            thread_client = inventorius_flask_app.test_client()
+            return [thread_client.put(
+                "/api/bin/BIN000000/contents/move",
+                json={"id": "SKU000000", "quantity": 1, "destination": "BIN000001"},
+            ).status_code for _ in range(MOVES_PER_THREAD)]
+
+        with ThreadPoolExecutor(N_THREADS) as pool:
+            status_codes = [code for codes in pool.map(move_one_at_a_time, range(N_THREADS))
+                            for code in codes]
+
+        # exactly STOCK moves succeed, the rest see an empty bin
+        assert status_codes.count(200) == STOCK
+        assert status_codes.count(405) == N_THREADS * MOVES_PER_THREAD - STOCK
+
+        source = client.get("/api/bin/BIN000000").json["state"]
+        destination = client.get("/api/bin/BIN000001").json["state"]
+        assert source.get("contents", {}) == {}
+        assert destination["contents"] == {"SKU000000": STOCK}
+        totals = client.get("/api/sku/SKU000000").json["state"]["totals"]
+        assert totals == {"quantity": STOCK, "bins": 1}
+
+
+def test_parallel_creates_advance_next_id():
+    with clientContext() as client:
+        def create_bins(thread):
+            thread_client = inventorius_flask_app.test_client()
+            return [thread_client.post(
+                "/api/bins", json={"id": f"BIN{thread * 100 + i:06}"}).status_code
+                for i in range(10)]
+
+        with ThreadPoolExecutor(N_THREADS) as pool:
+            status_codes = [code for codes in pool.map(create_bins, range(N_THREADS))
+                            for code in codes]
+
+        assert status_codes == [201] * N_THREADS * 10
+        # the high-water mark never loses a concurrent update
+        next_bin = client.get("/api/next/bin").json["state"]
+        assert next_bin == f"BIN{(N_THREADS - 1) * 100 + 10:06}"
+
+
+def test_parallel_reservations_are_disjoint():
+    with clientContext() as client:
+        def reserve(_):
+            thread_client = inventorius_flask_app.test_client()
+            return [bin_id for _ in range(10) for bin_id in thread_client.get(
+                "/api/next/bin", query_string={"count": 50}).json["state"]]
+
+        with ThreadPoolExecutor(N_THREADS) as pool:
+            reserved = [bin_id for ids in pool.map(reserve, range(N_THREADS))
+                        for bin_id in ids]
+
+        assert len(set(reserved)) == len(reserved) == N_THREADS * 10 * 50
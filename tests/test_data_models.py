@@ -1,9 +1,10 @@
-from inventorius.data_models import Bin, Sku, Batch, Props, DataModelJSONEncoder as Encoder
+from inventorius.data_models import Bin, Sku, Batch, Props, DataModelJSONEncoder as Encoder, get_field_plan, get_fields
 
 import pytest
 import json
 from hypothesis import given, example
 from hypothesis.strategies import composite, integers
+import hypothesis.strategies as st
 
 import tests.data_models_strategies as dst
 
@@ -68,6 +69,57 @@ def test_batch_no_props():
     batch = Batch(id="BAT0123456")
     print(batch.props)
 
+def test_field_plan_cached():
+    plan = get_field_plan(Batch)
+    assert get_field_plan(Batch) is plan
+    assert plan.from_bson["_id"][0] == "id"
+    assert [key for key, _ in plan.fields] == get_fields(Batch)
+
+
+def test_from_mongodb_doc_unknown_key():
+    with pytest.raises(Exception):
+        Bin.from_mongodb_doc({"_id": "BIN000000", "not_a_field": 1})
+
+
+def test_props_additional_fields_roundtrip():
+    batch = Batch.from_mongodb_doc({
+        "_id": "BAT000000",
+        "props": {"count_per_case": 12, "color": "red"},
+    })
+    assert batch.props.color == "red"
+    props_doc = batch.to_mongodb_doc()["props"]
+    assert props_doc["count_per_case"] == 12
+    assert props_doc["color"] == "red"
+    assert Batch.from_mongodb_doc(batch.to_mongodb_doc()) == batch
+    assert batch != Batch.from_mongodb_doc({"_id": "BAT000000", "props": {"count_per_case": 12}})
+
+def test_columns_match_from_mongodb_doc():
+    docs = [
+        {"_id": "BAT000000", "props": {"count_per_case": 12, "color": "red"}},
+        {"_id": "BAT000001", "name": "b", "owned_codes": ["1"], "sku_id": "SKU000000"},
+    ]
+    columns = Batch.from_mongodb_docs(iter(docs))
+    assert len(columns) == 2
+    models = [Batch.from_mongodb_doc(doc) for doc in docs]
+    assert list(columns) == models
+    assert columns[-1] == models[-1]
+    assert columns.to_mongodb_docs() == [m.to_mongodb_doc() for m in models]
+    assert columns.to_dicts(mask_default=True) == [m.to_dict(mask_default=True) for m in models]
+    assert json.loads(json.dumps(columns, cls=Encoder)) == json.loads(json.dumps(models, cls=Encoder))
+
+    columns.reverse()
+    assert list(columns) == models[::-1]
+    assert columns.pop() == models[0]
+    assert list(columns) == models[1:]
+
+
+@given(st.lists(dst.bins_()))
+def test_bin_columns(bins):
+    docs = [{**bin.to_mongodb_doc(), "contents_keys": list(bin.contents)} for bin in bins]
+    columns = Bin.from_mongodb_docs(docs)
+    assert list(columns) == bins
+    assert columns[:1] == bins[:1]
+
 # def test_bin_extended():
 #     pass
 
@@ -82,3 +134,11 @@ def test_batch_no_props():
 # def test_batch():
 #     batchJson = {"id": "BATCH0008", }
 #     #batch = Batch(json.loads(batchJson))
+
+
+def test_derived_field_not_loaded():
+    bin = Bin.from_mongodb_doc({"_id": "BIN000000", "contents": {"SKU000000": 1},
+                                "contents_keys": ["SKU000000"]})
+    assert bin == Bin(id="BIN000000", contents={"SKU000000": 1})
+    assert "contents_keys" not in bin.to_mongodb_doc()
+    assert "contents_keys" not in bin.to_dict()
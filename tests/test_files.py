@@ -0,0 +1,452 @@
+import hashlib
+import importlib
+import io
+import os
+import threading
+import time
+
+import pytest
+
+from conftest import clientContext
+from inventorius.db import get_mongo_client
+
+# the package re-exports the blueprint under the module's name
+files = importlib.import_module("inventorius.files")
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 64
+PDF = b"%PDF-1.4\n" + b"\x00" * 64
+PNG_BLOB = hashlib.sha256(PNG).hexdigest()
+PDF_BLOB = hashlib.sha256(PDF).hexdigest()
+
+
+@pytest.fixture
+def uploads(tmp_path, monkeypatch):
+    """Upload storage in tmp_path, with Wand replaced by a gated fake."""
+    monkeypatch.setattr(files, "UPLOADS_PATH", str(tmp_path))
+    monkeypatch.setattr(files, "WAND_AVAILABLE", True)
+    monkeypatch.setattr(files, "IMAGE_WORKERS", 1)
+    monkeypatch.setattr(files, "_image_pool", None)
+    gate = threading.Event()
+    gate.renders = []
+    gate.unsupported = set()
+
+    def render_image(input_path, output_path, max_dim, image_format=None):
+        gate.renders.append((max_dim, image_format))
+        gate.wait(5)
+        if image_format in gate.unsupported:
+            raise RuntimeError(f"no {image_format} delegate")
+        with open(output_path, "wb") as f:
+            f.write(f"{image_format}:{max_dim}".encode() if image_format else b"resized")
+        return files.fit_within(1600, 800, max_dim)
+
+    monkeypatch.setattr(files, "render_image", render_image)
+    for collection in ("files", "blobs", "renditions"):
+        get_mongo_client().testing[collection].delete_many({})
+    yield gate
+    gate.set()
+    if files._image_pool is not None:
+        files._image_pool.shutdown(wait=True)
+
+
+def finish_processing(gate):
+    gate.set()
+    files.get_image_pool().submit(lambda: None).result(5)
+
+
+def upload(client, data, filename):
+    rp = client.post("/api/files", data={"file": (io.BytesIO(data), filename)},
+                     content_type="multipart/form-data")
+    assert rp.status_code == 201
+    return rp.json["state"]
+
+
+def test_image_processed_after_upload(uploads):
+    with clientContext() as client:
+        state = upload(client, PNG, "photo.png")
+        assert state["processing"] is True
+        assert state["size"] == len(PNG)
+        file_id = state["id"]
+
+        rp = client.get(f"/api/files/{file_id}/meta")
+        assert rp.json["processing"] is True
+        assert rp.headers["Cache-Control"] == "no-cache"
+        rp = client.get(state["thumbnail_url"])
+        assert rp.status_code == 302
+        assert rp.headers["Location"].endswith(f"/api/files/{file_id}")
+
+        finish_processing(uploads)
+        meta = client.get(f"/api/files/{file_id}/meta").json
+        assert meta["processing"] is False
+        assert (meta["width"], meta["height"], meta["has_thumbnail"]) == (1600, 800, True)
+        assert meta["size"] == len(b"resized")
+        assert client.get(f"/api/files/{file_id}").data == b"resized"
+        assert uploads.renders == [(files.MAX_IMAGE_DIMENSION, None)]
+
+        # renditions are only generated when requested
+        rp = client.get(state["thumbnail_url"])
+        assert (rp.data, rp.mimetype) == (b"png:256", "image/png")
+        assert client.get(state["thumbnail_url"] + "?size=128").data == b"png:128"
+        for size in ("100", "big", "-64"):
+            assert client.get(state["thumbnail_url"] + "?size=" + size).status_code == 400
+
+        preview = meta["renditions"]["preview"]
+        assert preview["content_type"] == "image/webp"
+        assert (preview["width"], preview["height"]) == (800, 400)
+        rp = client.get(preview["url"])
+        assert (rp.data, rp.mimetype) == (b"webp:800", "image/webp")
+        assert client.get(f"/api/files/{file_id}/renditions/poster").status_code == 404
+
+
+def test_non_image_not_processed(uploads):
+    with clientContext() as client:
+        state = upload(client, PDF, "datasheet.pdf")
+        assert state["processing"] is False
+        assert "thumbnail_url" not in state
+        assert client.get(f"/api/files/{state['id']}").data == PDF
+
+
+def test_deleted_while_processing(uploads):
+    with clientContext() as client:
+        state = upload(client, PNG, "photo.png")
+        assert client.delete(f"/api/files/{state['id']}").status_code == 200
+        finish_processing(uploads)
+        assert not os.path.exists(files.get_file_path(PNG_BLOB))
+        for name in files.RENDITION_SPECS:
+            assert not os.path.exists(files.get_rendition_path(PNG_BLOB, name))
+        assert get_mongo_client().testing.blobs.count_documents({}) == 0
+
+
+def test_fit_within():
+    assert files.fit_within(4000, 3000, 2000) == (2000, 1500)
+    assert files.fit_within(300, 4000, 800) == (60, 800)
+    assert files.fit_within(200, 100, 256) == (200, 100)
+
+
+def test_process_pending_uploads(uploads, monkeypatch):
+    monkeypatch.setattr(files, "IMAGE_WORKERS", 0)
+    uploads.set()
+    with clientContext() as client:
+        state = upload(client, PNG, "photo.png")
+        test_db = get_mongo_client().testing
+        assert test_db.blobs.find_one({"_id": PNG_BLOB})["processing"] is False
+
+        test_db.blobs.update_one({"_id": PNG_BLOB}, {"$set": {"processing": True}})
+        files.process_pending_uploads(test_db, echo=lambda line: None)
+        assert test_db.blobs.find_one({"_id": PNG_BLOB})["processing"] is False
+
+
+def test_stale_uploads_requeued(uploads, monkeypatch):
+    monkeypatch.setattr(files, "IMAGE_WORKERS", 0)
+    monkeypatch.setattr(files, "_stale_uploads_checked", {})
+    uploads.set()
+    with clientContext() as client:
+        upload(client, PNG, "photo.png")
+        test_db = get_mongo_client().testing
+
+        # still within the timeout, maybe being processed by another worker
+        test_db.blobs.update_one({"_id": PNG_BLOB},
+                                 {"$set": {"processing": True, "processing_since": time.time()}})
+        client.get("/api/status")
+        assert test_db.blobs.find_one({"_id": PNG_BLOB})["processing"] is True
+
+        # left by a worker that exited, only looked at again after half a timeout
+        lost_since = time.time() - files.UPLOAD_PROCESSING_TIMEOUT - 1
+        test_db.blobs.update_one({"_id": PNG_BLOB}, {"$set": {"processing_since": lost_since}})
+        client.get("/api/status")
+        assert test_db.blobs.find_one({"_id": PNG_BLOB})["processing"] is True
+        files._stale_uploads_checked.clear()
+        client.get("/api/status")
+        blob = test_db.blobs.find_one({"_id": PNG_BLOB})
+        assert blob["processing"] is False
+        assert "processing_since" not in blob
+
+
+def test_upload_processed_once(uploads, monkeypatch):
+    monkeypatch.setattr(files, "_stale_uploads_checked", {})
+    other_png = PNG + b"\x01"
+    with clientContext() as client:
+        upload(client, PNG, "photo.png")
+        # queued behind the first one in the single image worker
+        upload(client, other_png, "other.png")
+        test_db = get_mongo_client().testing
+
+        # stale, but still waiting in this process' pool
+        other_blob = hashlib.sha256(other_png).hexdigest()
+        lost_since = time.time() - files.UPLOAD_PROCESSING_TIMEOUT - 1
+        test_db.blobs.update_one({"_id": other_blob}, {"$set": {"processing_since": lost_since}})
+        files.requeue_stale_uploads(test_db)
+        assert test_db.blobs.find_one({"_id": other_blob})["processing_since"] == lost_since
+
+        # another job for a blob being processed gives up right away
+        files.process_upload(test_db, PNG_BLOB)
+        assert uploads.renders == [(files.MAX_IMAGE_DIMENSION, None)]
+
+        finish_processing(uploads)
+        blob = test_db.blobs.find_one({"_id": PNG_BLOB})
+        assert blob["processing"] is False and "processing_claim" not in blob
+        # ... and for a finished one, which is never resized again
+        files.process_upload(test_db, PNG_BLOB)
+        assert uploads.renders == [(files.MAX_IMAGE_DIMENSION, None)] * 2
+        assert test_db.blobs.find_one({"_id": PNG_BLOB})["sha256"] == blob["sha256"]
+        assert not [name for name in os.listdir(os.path.dirname(files.get_file_path(PNG_BLOB)))
+                    if name.endswith(".tmp")]
+
+
+def test_conditional_and_range_requests(uploads):
+    with clientContext() as client:
+        state = upload(client, PDF, "datasheet.pdf")
+        url = f"/api/files/{state['id']}"
+
+        rp = client.get(url)
+        etag = rp.headers["ETag"]
+        last_modified = rp.headers["Last-Modified"]
+        assert etag == f'"{client.get(url + "/meta").json["sha256"]}"'
+        assert "immutable" in rp.headers["Cache-Control"]
+
+        rp = client.get(url, headers={"If-None-Match": etag})
+        assert rp.status_code == 304
+        assert rp.data == b""
+        assert client.get(url, headers={"If-Modified-Since": last_modified}).status_code == 304
+
+        rp = client.get(url, headers={"Range": "bytes=0-3"})
+        assert rp.status_code == 206
+        assert rp.data == PDF[:4]
+        assert rp.headers["Content-Range"] == f"bytes 0-3/{len(PDF)}"
+
+
+def test_accel_redirect(uploads, monkeypatch):
+    with clientContext() as client:
+        state = upload(client, PDF, "datasheet.pdf")
+        monkeypatch.setattr(files, "ACCEL_REDIRECT_PREFIX", "/internal-uploads/")
+        rp = client.get(f"/api/files/{state['id']}")
+        assert rp.status_code == 200
+        assert rp.data == b""
+        assert rp.headers["X-Accel-Redirect"] == \
+            f"/internal-uploads/files/{PDF_BLOB[:2]}/{PDF_BLOB}"
+        assert rp.mimetype == "application/pdf"
+
+        os.remove(files.get_file_path(PDF_BLOB))
+        assert client.get(f"/api/files/{state['id']}").status_code == 404
+
+
+def test_duplicate_uploads_share_blob(uploads):
+    with clientContext() as client:
+        test_db = get_mongo_client().testing
+        first = upload(client, PNG, "photo.png")
+        second = upload(client, PNG, "again.png")
+        assert first["id"] != second["id"]
+        assert test_db.blobs.find_one({"_id": PNG_BLOB})["refcount"] == 2
+        assert second["processing"] is True
+
+        finish_processing(uploads)
+        assert len(uploads.renders) == 1
+        third = upload(client, PNG, "third.png")
+        assert third["processing"] is False
+        assert third["size"] == len(b"resized")
+        assert len(uploads.renders) == 1
+        assert os.listdir(os.path.join(files.UPLOADS_PATH, "tmp")) == []
+
+        for state in (first, second):
+            assert client.delete(f"/api/files/{state['id']}").status_code == 200
+            assert client.get(f"/api/files/{state['id']}").status_code == 404
+            assert client.get(f"/api/files/{third['id']}").data == b"resized"
+        assert test_db.blobs.find_one({"_id": PNG_BLOB})["refcount"] == 1
+
+        assert client.delete(f"/api/files/{third['id']}").status_code == 200
+        assert test_db.blobs.count_documents({}) == 0
+        assert not os.path.exists(files.get_file_path(PNG_BLOB))
+        assert not os.path.exists(files.get_thumb_path(PNG_BLOB))
+
+
+def test_reupload_while_deleting(uploads):
+    uploads.set()
+    with clientContext() as client:
+        test_db = get_mongo_client().testing
+        state = upload(client, PDF, "datasheet.pdf")
+        test_db.blobs.update_one({"_id": PDF_BLOB}, {"$set": {"deleting": True, "refcount": 0}})
+
+        def finish_delete():
+            files.remove_file_data(PDF_BLOB)
+            test_db.blobs.delete_one({"_id": PDF_BLOB})
+        timer = threading.Timer(0.1, finish_delete)
+        timer.start()
+        again = upload(client, PDF, "datasheet.pdf")
+        timer.join()
+        assert test_db.blobs.find_one({"_id": PDF_BLOB})["refcount"] == 1
+        assert client.get(f"/api/files/{again['id']}").data == PDF
+
+
+def test_streamed_upload_checks(uploads, monkeypatch):
+    monkeypatch.setattr(files, "MAX_UPLOAD_SIZE", 256 * 1024)
+    tmp_dir = os.path.join(files.UPLOADS_PATH, "tmp")
+    with clientContext() as client:
+        # larger than a chunk, with another form field first
+        big = PDF + bytes(range(256)) * 800
+        rp = client.post("/api/files", data={"note": "x", "file": (io.BytesIO(big), "big.pdf")},
+                         content_type="multipart/form-data")
+        assert rp.status_code == 201
+        assert rp.json["state"]["size"] == len(big)
+        assert client.get(rp.json["Id"]).data == big
+        blob_id = hashlib.sha256(big).hexdigest()
+        assert get_mongo_client().testing.blobs.find_one({"_id": blob_id})["refcount"] == 1
+
+        rejected = [
+            ({"file": (io.BytesIO(PDF + b"\0" * 300 * 1024), "huge.pdf")}, "File too large"),
+            ({"file": (io.BytesIO(b"MZ\x90\x00" * 8), "tool.exe")}, "File type not allowed"),
+            ({"file": (io.BytesIO(PDF), "")}, "No file selected"),
+            ({"note": "no file"}, "No file provided"),
+        ]
+        for data, message in rejected:
+            rp = client.post("/api/files", data=data, content_type="multipart/form-data")
+            assert rp.status_code == 400
+            assert message in str(rp.json)
+        rp = client.post("/api/files", data=PDF, content_type="application/pdf")
+        assert rp.status_code == 400
+        assert os.listdir(tmp_dir) == []
+
+
+def test_files_meta_batch(uploads):
+    with clientContext() as client:
+        image = upload(client, PNG, "photo.png")
+        pdf = upload(client, PDF, "datasheet.pdf")
+        unknown = "00000000-0000-4000-8000-000000000000"
+
+        rp = client.post("/api/files/meta", json={"ids": [image["id"], pdf["id"], unknown, "bad"]})
+        assert rp.status_code == 200
+        found = rp.json["files"]
+        assert found[unknown] is None and found["bad"] is None
+        assert found[image["id"]] == client.get(f"/api/files/{image['id']}/meta").json
+        assert found[image["id"]]["thumbnail_url"] == image["thumbnail_url"]
+        assert found[pdf["id"]]["size"] == len(PDF)
+        assert "thumbnail_url" not in found[pdf["id"]]
+
+        finish_processing(uploads)
+        found = client.post("/api/files/meta", json={"ids": [image["id"]]}).json["files"]
+        assert found[image["id"]]["renditions"]["thumb"]["width"] == files.THUMBNAIL_SIZE
+
+        assert client.post("/api/files/meta", json={"ids": "x"}).status_code == 400
+        assert client.post("/api/files/meta", json={"ids": [1]}).status_code == 400
+        too_many = [unknown] * (files.MAX_META_BATCH + 1)
+        assert client.post("/api/files/meta", json={"ids": too_many}).status_code == 400
+
+
+def test_renditions_generated_once(uploads, monkeypatch):
+    monkeypatch.setattr(files, "WAND_AVAILABLE", False)
+    with clientContext() as client:
+        test_db = get_mongo_client().testing
+        state = upload(client, PNG, "photo.png")
+        assert state["processing"] is False
+        assert client.get(f"/api/files/{state['id']}/thumb").status_code == 404
+
+        # uploaded while image processing was unavailable, still thumbnailed
+        monkeypatch.setattr(files, "WAND_AVAILABLE", True)
+        results = []
+        requests = [threading.Thread(target=lambda: results.append(
+            files.find_rendition(test_db, PNG_BLOB, "thumb_128"))) for _ in range(3)]
+        for thread in requests:
+            thread.start()
+        threading.Timer(0.2, uploads.set).start()
+        for thread in requests:
+            thread.join()
+        assert uploads.renders == [(128, "png")]
+        assert [entry["sha256"] for entry in results] == [hashlib.sha256(b"png:128").hexdigest()] * 3
+
+        rp = client.get(f"/api/files/{state['id']}/thumb?size=128")
+        assert rp.data == b"png:128"
+        assert client.get(f"/api/files/{state['id']}/thumb?size=128",
+                          headers={"If-None-Match": rp.headers["ETag"]}).status_code == 304
+        assert uploads.renders == [(128, "png")]
+
+
+def test_rendition_cache_evicts_least_recently_used(uploads, monkeypatch):
+    uploads.set()
+    monkeypatch.setattr(files, "RENDITION_CACHE_SIZE", 2 * len(b"png:128"))
+    monkeypatch.setattr(files, "RENDITION_TOUCH_INTERVAL", 0)
+    with clientContext() as client:
+        test_db = get_mongo_client().testing
+        state = upload(client, PNG, "photo.png")
+        finish_processing(uploads)
+        thumb_url = f"/api/files/{state['id']}/thumb?size="
+        for size in (64, 128, 64):
+            assert client.get(thumb_url + str(size)).status_code == 200
+
+        assert client.get(thumb_url + "512").data == b"png:512"
+        assert {entry["name"] for entry in test_db.renditions.find()} == {"thumb_64", "thumb_512"}
+        assert not os.path.exists(files.get_rendition_path(PNG_BLOB, "thumb_128"))
+        client.get(thumb_url + "128")
+        assert {entry["name"] for entry in test_db.renditions.find()} == {"thumb_128", "thumb_512"}
+        assert not os.path.exists(files.get_rendition_path(PNG_BLOB, "thumb_64"))
+
+        # a cached file removed behind the cache's back is generated again
+        os.remove(files.get_rendition_path(PNG_BLOB, "thumb_512"))
+        assert client.get(thumb_url + "512").data == b"png:512"
+
+        total = test_db.admin.find_one({"_id": files.RENDITION_CACHE_TOTAL})["size"]
+        assert total == sum(entry["size"] for entry in test_db.renditions.find())
+
+        assert client.delete(f"/api/files/{state['id']}").status_code == 200
+        assert test_db.renditions.count_documents({}) == 0
+        assert test_db.admin.find_one({"_id": files.RENDITION_CACHE_TOTAL})["size"] == 0
+        assert not os.path.exists(files.get_rendition_path(PNG_BLOB, "thumb_512"))
+
+
+def test_legacy_file_served_before_migration(uploads):
+    uploads.set()
+    file_id = "0a7e4a0c-6d0b-4e0e-9b0a-1f2d3c4b5a60"
+    test_db = get_mongo_client().testing
+    path = files.get_file_path(file_id)
+    files.ensure_dir(path)
+    with open(path, "wb") as f:
+        f.write(PNG)
+    test_db.files.insert_one({
+        "_id": file_id, "original_filename": "photo.png", "content_type": "image/png",
+        "is_image": True, "size": len(PNG), "width": 1600, "height": 800})
+    with clientContext() as client:
+        assert client.get(f"/api/files/{file_id}").data == PNG
+        meta = client.get(f"/api/files/{file_id}/meta").json
+        assert (meta["size"], meta["width"], meta["has_thumbnail"]) == (len(PNG), 1600, True)
+        batch = client.post("/api/files/meta", json={"ids": [file_id]}).json["files"]
+        assert batch[file_id] == meta
+        assert client.get(meta["thumbnail_url"]).data == b"png:256"
+
+        assert client.delete(f"/api/files/{file_id}").status_code == 200
+        assert not os.path.exists(path)
+        assert not os.path.exists(files.get_thumb_path(file_id))
+        assert test_db.renditions.count_documents({}) == 0
+
+
+def test_failed_renditions_not_retried(uploads, monkeypatch):
+    uploads.set()
+    uploads.unsupported.add("webp")
+    with clientContext() as client:
+        state = upload(client, PNG, "photo.png")
+        finish_processing(uploads)
+        preview_url = f"/api/files/{state['id']}/renditions/preview"
+        for _ in range(2):
+            assert client.get(preview_url).status_code == 404
+        assert uploads.renders.count((800, "webp")) == 1
+        renditions = client.get(f"/api/files/{state['id']}/meta").json["renditions"]
+        assert "preview" not in renditions and "thumb" in renditions
+
+        # tried again once RENDITION_RETRY_FAILED has passed
+        uploads.unsupported.clear()
+        monkeypatch.setattr(files, "RENDITION_RETRY_FAILED", 0)
+        assert client.get(preview_url).data == b"webp:800"
+        assert "preview" in client.get(f"/api/files/{state['id']}/meta").json["renditions"]
+
+
+def test_rendition_wait_bounded(uploads, monkeypatch):
+    uploads.set()
+    monkeypatch.setattr(files, "RENDITION_WAIT", 0.2)
+    with clientContext() as client:
+        state = upload(client, PNG, "photo.png")
+        finish_processing(uploads)
+        # claimed by a request in another worker that is still rendering
+        get_mongo_client().testing.renditions.insert_one({
+            "_id": f"{PNG_BLOB}/thumb", "blob": PNG_BLOB, "name": "thumb",
+            "generating": True, "size": 0, "last_used": time.time()})
+        rp = client.get(state["thumbnail_url"])
+        assert rp.status_code == 302
+        assert rp.headers["Location"].endswith(f"/api/files/{state['id']}")
+        assert rp.headers["Cache-Control"] == "no-cache"
+        assert uploads.renders == [(files.MAX_IMAGE_DIMENSION, None)]
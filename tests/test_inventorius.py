@@ -277,6 +277,12 @@ class InventoriusStateMachine(RuleBasedStateMachine):
         assert rp.is_json
         found_sku = Sku(**rp.json["state"])
         assert found_sku == self.model_skus[sku_id]
+        assert rp.json["state"]["totals"] == self.model_totals(sku_id)
+
+    def model_totals(self, item_id):
+        held = [bin.contents[item_id] for bin in self.model_bins.values()
+                if item_id in bin.contents]
+        return {"quantity": sum(held), "bins": len(held)}
 
     @rule(sku_id=dst.label_("SKU"))
     def get_missing_sku(self, sku_id):
@@ -428,6 +434,7 @@ class InventoriusStateMachine(RuleBasedStateMachine):
         assert rp.is_json
         found_batch = Batch.from_json(rp.json["state"])
         assert found_batch == self.model_batches[batch_id]
+        assert rp.json["state"]["totals"] == self.model_totals(batch_id)
 
     @rule(batch_id=dst.label_("BAT"))
     def get_missing_batch(self, batch_id):
@@ -634,6 +641,27 @@ class InventoriusStateMachine(RuleBasedStateMachine):
             if self.model_bins[bin_id].contents[batch_id] == 0:
                 del self.model_bins[bin_id].contents[batch_id]
 
+    @rule(bin_id=a_bin_id, sku_id=a_sku_id, batch_id=a_batch_id, quantities=st.lists(st.integers(-100, 100), min_size=2, max_size=2))
+    def bulk_receive_release(self, bin_id, sku_id, batch_id, quantities):
+        deltas = [
+            {"bin_id": bin_id, "id": item_id, "quantity": quantity}
+            for item_id, quantity in zip([sku_id, batch_id], quantities)
+        ]
+        rp = self.client.post("/api/bins/contents", json={"deltas": deltas})
+        assert rp.status_code == 200
+        assert rp.cache_control.no_cache
+
+        contents = self.model_bins[bin_id].contents
+        for delta, result in zip(deltas, rp.json["state"]["results"]):
+            new_quantity = contents.get(delta["id"], 0) + delta["quantity"]
+            if new_quantity < 0:
+                assert result["type"] == "insufficient-quantity"
+            else:
+                assert "type" not in result
+                contents[delta["id"]] = new_quantity
+                if new_quantity == 0:
+                    del contents[delta["id"]]
+
     @rule(source_binId=a_bin_id, destination_binId=a_bin_id, data=st.data())
     def move(self, source_binId, destination_binId, data):
         assume(source_binId != destination_binId)
@@ -682,6 +710,24 @@ class InventoriusStateMachine(RuleBasedStateMachine):
         assert next_batch.startswith("BAT")
         assert len(next_batch) == 9
 
+    @rule(count=st.integers(1, 20))
+    def api_next_reserve(self, count):
+        rp = self.client.get("/api/next/bin", query_string={"count": count})
+        assert rp.status_code == 200
+        assert rp.cache_control.no_cache
+        reserved = rp.json["state"]
+        assert len(reserved) == count
+        assert not set(reserved) & self.model_bins.keys()
+        numbers = [int(bin_id[3:]) for bin_id in reserved]
+        assert numbers == list(range(numbers[0], numbers[0] + count))
+
+        # reserved IDs are never handed out again
+        next_bin = self.client.get("/api/next/bin").json["state"]
+        assert int(next_bin[3:]) > numbers[-1]
+
+        rp = self.client.get("/api/next/bin", query_string={"count": 0})
+        assert rp.status_code == 400
+
     def search_results_generator(self, query):
         def json_to_data_model(in_json_dict):
             if in_json_dict["id"].startswith("BIN"):
@@ -710,6 +756,28 @@ class InventoriusStateMachine(RuleBasedStateMachine):
             else:
                 starting_from += search_state["limit"]
 
+    def search_cursor_results_generator(self, query, limit=3):
+        rp = self.client.get("/api/search", query_string={"query": query, "limit": limit})
+        total_num_results = rp.json["state"]["total_num_results"]
+        while True:
+            assert rp.status_code == 200
+            assert rp.is_json
+            for result_json in rp.json["state"]["results"]:
+                yield result_json
+            next_page = [op for op in rp.json["operations"] if op["rel"] == "next"]
+            if not next_page:
+                break
+            rp = self.client.get(next_page[0]["href"])
+            # only counted again on request
+            assert rp.json["state"]["total_num_results"] is None
+            counted = self.client.get(next_page[0]["href"] + "&count=true")
+            assert counted.json["state"]["total_num_results"] == total_num_results
+
+    @rule()
+    def search_all_bins_by_cursor(self):
+        bin_ids = [result["id"] for result in self.search_cursor_results_generator("!BINS")]
+        assert bin_ids == sorted(self.model_bins.keys())
+
     def search_query_matches(self, query, unit):
         STOP_WORDS = "a and the".split()
         terms = query.split()
@@ -769,3 +837,30 @@ else:
         stateful_step_count=10,
         deadline=timedelta(milliseconds=100),
     )
+
+
+def test_search_pages_across_collections():
+    with clientContext() as client:
+        for i in range(3):
+            assert client.post("/api/skus", json={"id": f"SKU00000{i}"}).status_code == 201
+            assert client.post("/api/bins", json={"id": f"BIN00000{i}"}).status_code == 201
+        everything = ["SKU000000", "SKU000001", "SKU000002", "BIN000000", "BIN000001", "BIN000002"]
+
+        def ids(rp):
+            assert rp.status_code == 200
+            return [result["id"] for result in rp.json["state"]["results"]]
+
+        def follow(rp, rel):
+            return client.get([op for op in rp.json["operations"] if op["rel"] == rel][0]["href"])
+
+        rp = client.get("/api/search", query_string={"query": "!ALL", "startingFrom": 2, "limit": 2})
+        assert ids(rp) == everything[2:4]
+        assert rp.json["state"]["returned_num_results"] == 2
+        rp = follow(rp, "next")
+        assert ids(rp) == everything[4:6]
+        assert not [op for op in rp.json["operations"] if op["rel"] == "next"]
+        rp = follow(rp, "prev")
+        assert ids(rp) == everything[2:4]
+        rp = follow(rp, "prev")
+        assert ids(rp) == everything[0:2]
+        assert not [op for op in rp.json["operations"] if op["rel"] == "prev"]
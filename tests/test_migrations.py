@@ -0,0 +1,227 @@
+import hashlib
+import importlib
+import os
+import time
+
+import pytest
+
+from conftest import clientContext
+from inventorius.db import get_mongo_client
+import inventorius.migrations as migrations
+from inventorius.migrations import (migrate_contents_keys, migrate_file_blobs, migrate_ids, rebuild_totals,
+                                    run_startup_migrations)
+
+
+def test_migrate_ids():
+    with clientContext() as client:
+        test_db = get_mongo_client().testing
+        test_db.bin.insert_many([{"_id": "BIN000003"}, {"_id": "BIN1000000"}])
+        test_db.sku.insert_one({"_id": "SKU000010"})
+        # admin doc in the old format, SKU000020 was used and deleted
+        test_db.admin.insert_one({"_id": "SKU", "next": "SKU000021", "used": [10, 20]})
+        # used-ID bitmap of an earlier version
+        test_db.admin.insert_one({"_id": "BIN.used.0", "bits": 1 << 3})
+
+        lines = []
+        migrate_ids(test_db, echo=lines.append)
+
+        assert "BIN: next id BIN1000001" in lines
+        assert "SKU: next id SKU000021" in lines
+        assert "BAT: next id BAT000001" in lines
+        assert client.get("/api/next/bin").json["state"] == "BIN1000001"
+        assert client.get("/api/next/sku").json["state"] == "SKU000021"
+
+        sku_admin = test_db.admin.find_one({"_id": "SKU"})
+        assert "used" not in sku_admin and "next" not in sku_admin
+        assert test_db.admin.find_one({"_id": "BIN.used.0"}) is None
+
+
+def test_next_without_migration():
+    with clientContext() as client:
+        test_db = get_mongo_client().testing
+        test_db.bin.insert_many([{"_id": "BIN000003"}, {"_id": "BIN000007"}])
+        test_db.batch.insert_many([{"_id": "BAT999999"}, {"_id": "BAT1000000"}])
+        test_db.admin.insert_one({"_id": "SKU", "next": "SKU000021", "used": [10, 20]})
+
+        assert client.get("/api/next/bin").json["state"] == "BIN000008"
+        assert client.get("/api/next/sku").json["state"] == "SKU000021"
+        # the last in string order, found without a scan
+        assert client.get("/api/next/batch").json["state"] == "BAT1000000"
+
+
+def test_next_after_startup_migrations():
+    with clientContext() as client:
+        test_db = get_mongo_client().testing
+        test_db.batch.insert_many([{"_id": "BAT999999"}, {"_id": "BAT1000000"}])
+
+        run_startup_migrations(test_db, echo=lambda line: None)
+        # numerically largest, not the last in string order
+        assert client.get("/api/next/batch").json["state"] == "BAT1000001"
+
+
+def test_migrate_contents_keys():
+    with clientContext() as client:
+        test_db = get_mongo_client().testing
+        assert client.post("/api/skus", json={"id": "SKU000000"}).status_code == 201
+        # bins stored before contents_keys was maintained, or with a stale array
+        test_db.bin.insert_many([
+            {"_id": "BIN000000", "contents": {"SKU000000": 2}},
+            {"_id": "BIN000001", "contents": {}, "contents_keys": ["SKU000000"]},
+            {"_id": "BIN000002"},
+            {"_id": "BIN000003", "contents": {"SKU000000": 1}, "contents_keys": []},
+        ])
+        assert client.get("/api/sku/SKU000000/bins").json["state"] == {}
+
+        migrate_contents_keys(test_db, echo=lambda line: None)
+
+        assert client.get("/api/sku/SKU000000/bins").json["state"] == {
+            "BIN000000": {"SKU000000": 2}, "BIN000003": {"SKU000000": 1}}
+        assert test_db.bin.find_one({"_id": "BIN000001"})["contents_keys"] == []
+        assert test_db.bin.find_one({"_id": "BIN000002"})["contents_keys"] == []
+        assert client.delete("/api/sku/SKU000000").status_code == 403
+
+
+def test_startup_migrations_run_once():
+    with clientContext() as client:
+        test_db = get_mongo_client().testing
+        assert client.post("/api/skus", json={"id": "SKU000000"}).status_code == 201
+        test_db.bin.insert_one({"_id": "BIN000000", "contents": {"SKU000000": 2}})
+
+        # requests don't migrate
+        client.get("/api/sku/SKU000000")
+        assert "contents_keys" not in test_db.bin.find_one({"_id": "BIN000000"})
+
+        run_startup_migrations(test_db, echo=lambda line: None)
+        assert test_db.bin.find_one({"_id": "BIN000000"})["contents_keys"] == ["SKU000000"]
+        assert client.delete("/api/sku/SKU000000").status_code == 403
+        # stock held before totals were maintained
+        assert client.get("/api/sku/SKU000000").json["state"]["totals"] == {
+            "quantity": 2, "bins": 1}
+
+        # done once per database
+        test_db.bin.insert_one({"_id": "BIN000001", "contents": {"SKU000000": 1}})
+        run_startup_migrations(test_db, echo=lambda line: None)
+        assert "contents_keys" not in test_db.bin.find_one({"_id": "BIN000001"})
+        assert client.get("/api/sku/SKU000000").json["state"]["totals"]["quantity"] == 2
+
+
+def test_startup_migration_claimed(monkeypatch):
+    monkeypatch.setattr(migrations, "MIGRATION_POLL_INTERVAL", 0)
+    with clientContext():
+        test_db = get_mongo_client().testing
+        test_db.bin.insert_one({"_id": "BIN000000", "contents": {"SKU000000": 2}})
+        migrate = migrations.migrate_contents_keys
+
+        # another process is migrating, wait for it
+        test_db.admin.insert_one({"_id": migrations.CONTENTS_KEYS_DONE, "claimed_at": time.time()})
+        waited = []
+
+        def other_process_done(line):
+            waited.append(line)
+            test_db.admin.update_one({"_id": migrations.CONTENTS_KEYS_DONE}, {"$set": {"done": True}})
+
+        migrations.run_once(test_db, migrations.CONTENTS_KEYS_DONE, migrate, echo=other_process_done)
+        assert waited == ["contents_keys: waiting for another process to migrate"]
+        assert "contents_keys" not in test_db.bin.find_one({"_id": "BIN000000"})
+
+        # the process holding it exited long ago, take over
+        test_db.admin.replace_one(
+            {"_id": migrations.CONTENTS_KEYS_DONE},
+            {"claimed_at": time.time() - migrations.MIGRATION_CLAIM_TIMEOUT - 1})
+        migrations.run_once(test_db, migrations.CONTENTS_KEYS_DONE, migrate, echo=lambda line: None)
+        assert test_db.bin.find_one({"_id": "BIN000000"})["contents_keys"] == ["SKU000000"]
+        assert test_db.admin.find_one({"_id": migrations.CONTENTS_KEYS_DONE})["done"] is True
+
+
+def test_rebuild_totals():
+    with clientContext() as client:
+        test_db = get_mongo_client().testing
+        assert client.post("/api/skus", json={"id": "SKU000000"}).status_code == 201
+        test_db.bin.insert_many([
+            {"_id": "BIN000000", "contents": {"SKU000000": 2, "BAT000000": 1}},
+            {"_id": "BIN000001", "contents": {"SKU000000": 3}},
+            {"_id": "BIN000002"},
+        ])
+        # drifted totals, including an item no bin holds any more
+        test_db.totals.insert_many([{"_id": "SKU000000", "quantity": 1, "bins": 1},
+                                    {"_id": "SKU000001", "quantity": 4, "bins": 1}])
+
+        rebuild_totals(test_db, echo=lambda line: None)
+
+        assert client.get("/api/sku/SKU000000").json["state"]["totals"] == {
+            "quantity": 5, "bins": 2}
+        assert test_db.totals.find_one({"_id": "BAT000000"})["quantity"] == 1
+        assert test_db.totals.find_one({"_id": "SKU000001"}) is None
+
+
+def test_migrate_file_blobs(tmp_path, monkeypatch):
+    files = importlib.import_module("inventorius.files")
+    monkeypatch.setattr(files, "UPLOADS_PATH", str(tmp_path))
+    monkeypatch.setattr(files, "WAND_AVAILABLE", True)
+    ids = ["0a7e4a0c-6d0b-4e0e-9b0a-1f2d3c4b5a60", "1b8f5b1d-7e1c-4f1f-8c1b-2a3e4d5c6b71"]
+    content = b"\x89PNG same photo"
+    blob_id = hashlib.sha256(content).hexdigest()
+    with clientContext() as client:
+        test_db = get_mongo_client().testing
+        test_db.files.delete_many({})
+        test_db.blobs.delete_many({})
+        test_db.renditions.delete_many({})
+        for file_id in ids:
+            for path in (files.get_file_path(file_id), files.get_thumb_path(file_id)):
+                files.ensure_dir(path)
+                with open(path, "wb") as f:
+                    f.write(content)
+            test_db.files.insert_one({
+                "_id": file_id, "original_filename": "photo.png", "content_type": "image/png",
+                "is_image": True, "size": len(content), "has_thumbnail": True,
+                "width": 4, "height": 3})
+
+        lines = []
+        migrate_file_blobs(test_db, echo=lines.append)
+        assert lines == ["files: 2 moved to blobs, 1 of them duplicates"]
+
+        blob = test_db.blobs.find_one({"_id": blob_id})
+        assert (blob["refcount"], blob["width"], blob["has_thumbnail"]) == (2, 4, True)
+        assert "width" not in test_db.files.find_one({"_id": ids[0]})
+        assert sorted(os.listdir(tmp_path / "files" / blob_id[:2])) == [blob_id]
+        for file_id in ids:
+            assert not os.path.exists(files.get_file_path(file_id))
+            assert not os.path.exists(files.get_thumb_path(file_id))
+            assert client.get(f"/api/files/{file_id}").data == content
+            # thumbnails generated on upload are taken over by the rendition cache
+            assert client.get(f"/api/files/{file_id}/thumb").data == content
+
+
+def test_migrate_file_blobs_resumes(tmp_path, monkeypatch):
+    files = importlib.import_module("inventorius.files")
+    monkeypatch.setattr(files, "UPLOADS_PATH", str(tmp_path))
+    ids = ["0a7e4a0c-6d0b-4e0e-9b0a-1f2d3c4b5a60", "1b8f5b1d-7e1c-4f1f-8c1b-2a3e4d5c6b71"]
+    content = b"%PDF same datasheet"
+    blob_id = hashlib.sha256(content).hexdigest()
+    with clientContext() as client:
+        test_db = get_mongo_client().testing
+        test_db.files.delete_many({})
+        test_db.blobs.delete_many({})
+        for file_id in ids:
+            path = files.get_file_path(file_id)
+            files.ensure_dir(path)
+            with open(path, "wb") as f:
+                f.write(content)
+            test_db.files.insert_one({"_id": file_id, "content_type": "application/pdf",
+                                      "size": len(content)})
+
+        def crash(path):
+            raise OSError("disk gone")
+        monkeypatch.setattr(migrations, "ensure_dir", crash)
+        with pytest.raises(OSError):
+            migrate_file_blobs(test_db, echo=lambda line: None)
+        monkeypatch.undo()
+        monkeypatch.setattr(files, "UPLOADS_PATH", str(tmp_path))
+
+        migrate_file_blobs(test_db, echo=lambda line: None)
+        assert test_db.blobs.find_one({"_id": blob_id})["refcount"] == 2
+        assert test_db.files.count_documents({"migrating": {"$exists": True}}) == 0
+        for file_id in ids:
+            assert test_db.files.find_one({"_id": file_id})["blob"] == blob_id
+            assert not os.path.exists(files.get_file_path(file_id))
+            assert client.get(f"/api/files/{file_id}").data == content
@@ -1,6 +1,8 @@
 """Tests for the unified trigger model schema system."""
 
 import pytest
+from hypothesis import given
+import hypothesis.strategies as st
 from inventorius.schema import (
     SchemaField,
     TriggerCondition,
@@ -12,6 +14,8 @@ from inventorius.schema import (
     schema_to_json,
     schema_from_json,
 )
+from inventorius.schema.bundles import BundleIndex
+from inventorius.schema.trigger_engine import compile_trigger, trigger_from_dict
 
 
 @pytest.fixture
@@ -159,3 +163,168 @@ class TestJsonSerialization:
         state2 = engine2.evaluate(["Resistor"], values)
 
         assert state1.active_mixins == state2.active_mixins
+
+
+def count_trigger_evaluations(engine):
+    calls = []
+
+    def counting(field_name, predicate):
+        def counting_predicate(field_values):
+            calls.append(field_name)
+            return predicate(field_values)
+        return counting_predicate
+
+    for parent_name, predicates in engine.child_predicates.items():
+        children = engine.schema.mixins[parent_name].children
+        predicates[:] = [counting(child.trigger.field_name, predicate)
+                         for child, predicate in zip(children, predicates)]
+    return calls
+
+
+class TestIncrementalEvaluation:
+    def test_update_matches_evaluate(self):
+        from inventorius.schema.sample_schemas import get_electronics_schema
+        engine = TriggerEngine(get_electronics_schema())
+        state = engine.evaluate(["Resistor"], {})
+        for delta in [{"resistance": 100}, {"package": "0402"}, {"package": "DIP"},
+                      {"wire_gauge": 14}, {"resistance": -1}, {"package": "0402"}]:
+            state = engine.update(state, delta)
+            full = engine.evaluate(["Resistor"], state.field_values)
+            assert state.active_mixins == full.active_mixins
+            assert state.available_fields == full.available_fields
+
+    def test_update_only_reevaluates_changed_fields(self, electronics_schema):
+        engine = TriggerEngine(electronics_schema)
+        state = engine.evaluate(["Resistor"], {"resistance": 100, "package": "DIP"})
+
+        calls = count_trigger_evaluations(engine)
+        state = engine.update(state, {"wire_gauge": 14, "resistance": 100})
+        assert calls == ["wire_gauge"]
+        assert "HighCurrentWire" in state.active_mixins
+
+    def test_activation_order_kept(self):
+        schema = Schema(
+            root_mixins=["A"],
+            mixins={
+                "A": Mixin("A", children=[ChildMixin("B", TriggerCondition("x", "set", None)),
+                                          ChildMixin("D", TriggerCondition("y", "eq", 1))]),
+                "B": Mixin("B", children=[ChildMixin("C", TriggerCondition("x", "set", None))]),
+                "C": Mixin("C"),
+                "D": Mixin("D"),
+            },
+        )
+        engine = TriggerEngine(schema)
+        state = engine.evaluate(["A"], {"x": "on", "y": 0})
+        assert state.active_mixins == ["A", "B", "C"]
+        state = engine.update(state, {"y": 1})
+        assert state.active_mixins == ["A", "B", "D", "C"]
+
+    def test_deep_chain_evaluates_each_trigger_once(self):
+        depth = 2000
+        mixins = {f"M{i}": Mixin(f"M{i}", [SchemaField(f"f{i}", "bool")],
+                                 [ChildMixin(f"M{i + 1}", TriggerCondition("go", "eq", True))])
+                  for i in range(depth)}
+        mixins[f"M{depth}"] = Mixin(f"M{depth}")
+        engine = TriggerEngine(Schema(root_mixins=["M0"], mixins=mixins,
+                                      intersections=[IntersectionRule(["M0", f"M{depth}"])]))
+
+        calls = count_trigger_evaluations(engine)
+        state = engine.evaluate(["M0"], {"go": True})
+        assert len(state.active_mixins) == depth + 1
+        assert len(calls) == depth
+
+
+trigger_values = st.one_of(st.none(), st.booleans(), st.integers(-3, 3),
+                           st.sampled_from(["", "a", "b", "0402"]),
+                           st.lists(st.integers(-3, 3), max_size=2))
+leaf_triggers = st.one_of(
+    st.builds(TriggerCondition, st.sampled_from(["x", "y"]),
+              st.sampled_from(["eq", "neq", "set"]), trigger_values),
+    st.builds(TriggerCondition, st.sampled_from(["x", "y"]), st.just("in"),
+              st.lists(trigger_values, max_size=4)),
+    st.builds(TriggerCondition, st.sampled_from(["x", "y"]),
+              st.sampled_from(["lt", "gt", "lte", "gte"]), st.integers(-3, 3)),
+)
+triggers = st.recursive(leaf_triggers, lambda children: st.builds(
+    TriggerCondition, st.just(""), st.just("and"), st.lists(children, max_size=3)))
+
+
+class TestCompiledTriggers:
+    @given(triggers, st.dictionaries(st.sampled_from(["x", "y"]), trigger_values))
+    def test_matches_evaluate(self, trigger, field_values):
+        try:
+            expected = trigger.evaluate(field_values)
+        except TypeError:
+            return  # e.g. "a" < 1, raised by both
+        assert compile_trigger(trigger)(field_values) == expected
+
+    def test_nested_and_short_circuits(self):
+        trigger = TriggerCondition("", "and", [
+            TriggerCondition("x", "eq", 1),
+            TriggerCondition("", "and", [TriggerCondition("y", "lt", 5)]),
+        ])
+        predicate = compile_trigger(trigger)
+        assert predicate({"x": 1, "y": 2})
+        assert not predicate({"x": 1, "y": 7})
+        assert not predicate({"x": 2, "y": "not comparable"})
+
+    def test_unhashable_value_in(self):
+        predicate = compile_trigger(TriggerCondition("x", "in", [[1], "a"]))
+        assert predicate({"x": [1]})
+        assert not compile_trigger(TriggerCondition("x", "in", ["a"]))({"x": [1]})
+
+    def test_unknown_operator_rejected_on_load(self):
+        with pytest.raises(ValueError):
+            trigger_from_dict({"field": "x", "op": "matches", "value": "a.*"})
+        with pytest.raises(ValueError):
+            TriggerEngine(Schema(root_mixins=["A"], mixins={"A": Mixin("A", children=[
+                ChildMixin("B", TriggerCondition("", "and", [TriggerCondition("x", "like", 1)]))])}))
+
+
+class TestBundleIndex:
+    @pytest.fixture
+    def index(self):
+        field = SchemaField("package", "text")
+        schema = Schema(
+            root_mixins=["Part", "Kit"],
+            mixins={
+                "Part": Mixin("Part", children=[
+                    ChildMixin("SMD", TriggerCondition("package", "in", ["0402", "0603"])),
+                    ChildMixin("Socket", TriggerCondition("package", "eq", "DIP")),
+                    ChildMixin("Missing", TriggerCondition("package", "eq", "DIP")),
+                    ChildMixin("Screw", TriggerCondition("kind", "eq", "screw")),
+                ]),
+                "Kit": Mixin("Kit", children=[
+                    ChildMixin("Solder", TriggerCondition("package", "eq", "0402")),
+                    ChildMixin("SMD", TriggerCondition("package", "eq", "DIP")),
+                ]),
+                "SMD": Mixin("SMD", [field]),
+                "Socket": Mixin("Socket"),
+                "Solder": Mixin("Solder"),
+                "Screw": Mixin("Screw"),
+            },
+            intersections=[
+                IntersectionRule(["Part", "SMD"], [SchemaField("reel", "bool")]),
+                IntersectionRule(["Kit", "Socket"], [SchemaField("pins", "number")]),
+                IntersectionRule(["Part", "Solder"], [SchemaField("reel", "bool")]),
+            ],
+        )
+        return BundleIndex(schema)
+
+    def test_search_in_schema_order(self, index):
+        ids = lambda bundles: [b["id"] for b in bundles]
+        assert ids(index.search("package")) == ["SMD", "Socket", "Solder"]
+        assert ids(index.search("package", exact_value="0402")) == ["SMD", "Solder"]
+        assert ids(index.search("package", exact_value="DIP")) == ["Socket", "SMD"]
+        assert ids(index.search("package", query="s")) == ["SMD", "Socket", "Solder"]
+        assert ids(index.search("package", query="so")) == ["Socket", "Solder"]
+        assert index.search("package", query="x") == []
+        assert index.search("color") == []
+        assert index.search("package")[0]["fields"] == [{"name": "package", "type": "text"}]
+
+    def test_intersection_fields(self, index):
+        bundles = index.search("package", exact_value="0402")
+        assert index.intersection_fields(["Part"], bundles) == [{"name": "reel", "type": "bool"}]
+        assert index.intersection_fields(["Kit"], bundles) == []
+        assert index.intersection_fields(["Kit", "Socket"], bundles) == [
+            {"name": "pins", "type": "number"}]
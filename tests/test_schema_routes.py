@@ -0,0 +1,171 @@
+"""Tests for the /api/schema routes and their in-process schema cache."""
+
+import json
+
+from bson import ObjectId
+from conftest import clientContext
+from inventorius.db import get_mongo_client
+import inventorius.schema.routes as schema_routes
+
+SCHEMA = {
+    "root_mixins": ["Part"],
+    "mixins": {
+        "Part": {"name": "Part", "fields": [{"name": "kind", "type": "text"}],
+                 "children": [{"mixin": "Screw",
+                               "trigger": {"field": "kind", "op": "eq", "value": "screw"}}]},
+        "Screw": {"name": "Screw", "fields": [{"name": "thread", "type": "text"}]},
+    },
+}
+
+
+def evaluate(client, name):
+    rp = client.post(f"/api/schema/{name}/evaluate",
+                     json={"active_mixins": ["Part"], "field_values": {"kind": "screw"}})
+    assert rp.status_code == 200
+    return [f["name"] for f in rp.json["available_fields"]]
+
+
+def test_schema_cache_invalidated_by_save():
+    with clientContext() as client:
+        get_mongo_client().testing.schema.delete_many({})
+        assert client.put("/api/schema/parts", json=SCHEMA).status_code == 200
+        assert evaluate(client, "parts") == ["kind", "thread"]
+
+        rp = client.put("/api/schema/parts/mixin/Screw",
+                        json={"fields": [{"name": "thread", "type": "text"},
+                                         {"name": "length", "type": "number"}]})
+        assert rp.status_code == 200
+        assert evaluate(client, "parts") == ["kind", "thread", "length"]
+
+        assert client.delete("/api/schema/parts").status_code == 200
+        assert client.post("/api/schema/parts/evaluate", json={"active_mixins": []}).status_code == 404
+
+
+def test_schema_cache_sees_other_workers(monkeypatch):
+    with clientContext() as client:
+        test_db = get_mongo_client().testing
+        test_db.schema.delete_many({})
+        assert client.put("/api/schema/parts", json=SCHEMA).status_code == 200
+        assert evaluate(client, "parts") == ["kind", "thread"]
+
+        # another worker saves a new version behind this process' back
+        test_db.schema.update_one(
+            {"_id": "parts"},
+            {"$set": {"mixins.Screw.fields": [{"name": "head", "type": "text"}],
+                      "version": ObjectId()}})
+        assert evaluate(client, "parts") == ["kind", "thread"]
+
+        monkeypatch.setattr(schema_routes, "SCHEMA_CHECK_INTERVAL", 0)
+        assert evaluate(client, "parts") == ["kind", "head"]
+
+
+def test_schema_cache_sees_recreated_schema(monkeypatch):
+    monkeypatch.setattr(schema_routes, "SCHEMA_CHECK_INTERVAL", 0)
+    with clientContext() as client:
+        get_mongo_client().testing.schema.delete_many({})
+        assert client.put("/api/schema/parts", json=SCHEMA).status_code == 200
+        assert client.get("/api/schema/parts").json["root_mixins"] == ["Part"]
+        # what another worker keeps cached while the schema is deleted and
+        # created again
+        stale = schema_routes._schema_cache[("testing", "parts")]
+
+        assert client.delete("/api/schema/parts").status_code == 200
+        rp = client.put("/api/schema/parts", json={**SCHEMA, "root_mixins": ["Screw"]})
+        assert rp.status_code == 200
+        schema_routes._schema_cache[("testing", "parts")] = stale
+        assert client.get("/api/schema/parts").json["root_mixins"] == ["Screw"]
+
+
+def test_unknown_trigger_operator_rejected():
+    with clientContext() as client:
+        get_mongo_client().testing.schema.delete_many({})
+        rp = client.put("/api/schema/parts/mixin/Part",
+                        json={"children": [{"mixin": "Screw",
+                                            "trigger": {"field": "kind", "op": "like", "value": "s%"}}]})
+        assert rp.status_code == 404
+        assert client.put("/api/schema/parts", json=SCHEMA).status_code == 200
+        rp = client.put("/api/schema/parts/mixin/Part",
+                        json={"children": [{"mixin": "Screw",
+                                            "trigger": {"field": "kind", "op": "like", "value": "s%"}}]})
+        assert rp.status_code == 400
+        assert evaluate(client, "parts") == ["kind", "thread"]
+
+
+def test_search_bundles():
+    with clientContext() as client:
+        get_mongo_client().testing.schema.delete_many({})
+        assert client.put("/api/schema/parts", json=SCHEMA).status_code == 200
+        rp = client.get("/api/schema/parts/search?field=kind&q=SC")
+        assert rp.status_code == 200
+        assert rp.json == {"bundles": [{"id": "Screw", "name": "Screw",
+                                        "fields": [{"name": "thread", "type": "text"}]}],
+                           "intersection_fields": []}
+        rp = client.get("/api/schema/parts/search?field=kind&value=bolt")
+        assert rp.json["bundles"] == []
+        assert client.get("/api/schema/parts/search").status_code == 400
+
+
+BATCH = [
+    {"active_mixins": ["Part"], "field_values": {"kind": "screw"}},
+    {"active_mixins": ["Part"], "field_values": {"kind": "nut"}},
+    "not an object",
+    {"active_mixins": ["Part"], "field_values": ["kind"]},
+]
+BATCH_RESULTS = [
+    {"active_mixins": ["Part", "Screw"],
+     "available_fields": [{"name": "kind", "type": "text"}, {"name": "thread", "type": "text"}]},
+    {"active_mixins": ["Part"], "available_fields": [{"name": "kind", "type": "text"}]},
+]
+
+
+def check_batch_results(results):
+    assert results[:2] == BATCH_RESULTS
+    assert len(results) == 4
+    assert "error" in results[2] and "error" in results[3]
+
+
+def test_evaluate_batch():
+    with clientContext() as client:
+        get_mongo_client().testing.schema.delete_many({})
+        assert client.put("/api/schema/parts", json=SCHEMA).status_code == 200
+
+        rp = client.post("/api/schema/parts/evaluate/batch", json=BATCH)
+        assert rp.status_code == 200
+        check_batch_results(rp.json["results"])
+
+        rp = client.post("/api/schema/parts/evaluate/batch",
+                         data="\n".join(json.dumps(row) for row in BATCH) + "\n\n",
+                         content_type="application/x-ndjson")
+        assert rp.status_code == 200
+        assert rp.mimetype == "application/x-ndjson"
+        check_batch_results([json.loads(line) for line in rp.get_data(as_text=True).splitlines()])
+
+        rp = client.post("/api/schema/parts/evaluate/batch", data="{", content_type="application/x-ndjson")
+        assert "error" in json.loads(rp.get_data(as_text=True))
+
+        assert client.post("/api/schema/parts/evaluate/batch", json={"rows": []}).status_code == 400
+        assert client.post("/api/schema/nope/evaluate/batch", json=BATCH).status_code == 404
+
+
+def test_evaluate_batch_process_pool(monkeypatch):
+    monkeypatch.setattr(schema_routes, "EVALUATE_PROCESSES", 2)
+    monkeypatch.setattr(schema_routes, "EVALUATE_POOL_THRESHOLD", 1)
+    monkeypatch.setattr(schema_routes, "EVALUATE_CHUNK_SIZE", 3)
+    monkeypatch.setattr(schema_routes, "_evaluate_pool", None)
+    try:
+        with clientContext() as client:
+            get_mongo_client().testing.schema.delete_many({})
+            assert client.put("/api/schema/parts", json=SCHEMA).status_code == 200
+            rp = client.post("/api/schema/parts/evaluate/batch", json=BATCH)
+            check_batch_results(rp.json["results"])
+            pool = schema_routes._evaluate_pool
+            assert pool is not None
+
+            # the pool outlives requests, and its workers see saved schemas
+            assert client.put("/api/schema/parts", json=SCHEMA).status_code == 200
+            rp = client.post("/api/schema/parts/evaluate/batch", json=BATCH)
+            check_batch_results(rp.json["results"])
+            assert schema_routes._evaluate_pool is pool
+    finally:
+        if schema_routes._evaluate_pool is not None:
+            schema_routes._evaluate_pool.shutdown()
@@ -0,0 +1,34 @@
+import inventorius.stats as stats
+from conftest import clientContext
+
+
+def test_stats():
+    stats._cache.clear()
+    with clientContext() as client:
+        assert client.post("/api/bins", json={"id": "BIN000000"}).status_code == 201
+        assert client.post("/api/bins", json={"id": "BIN000001"}).status_code == 201
+        assert client.post("/api/skus", json={"id": "SKU000000", "name": "bolt"}).status_code == 201
+        assert client.post("/api/bin/BIN000000/contents",
+                           json={"id": "SKU000000", "quantity": 3}).status_code == 201
+
+        rp = client.get("/api/stats")
+        assert rp.status_code == 200
+        assert rp.json["counts"] == {"bins": 2, "skus": 1, "batches": 0,
+                                     "empty_bins": 1, "units_on_hand": 3}
+        assert [bin["id"] for bin in rp.json["recent_bins"]] == ["BIN000001", "BIN000000"]
+        assert rp.json["recent_skus"] == [{"id": "SKU000000", "name": "bolt"}]
+        assert rp.cache_control.max_age == int(stats.STATS_TTL)
+
+        rp = client.get("/api/stats", headers={"If-None-Match": rp.headers["ETag"]})
+        assert rp.status_code == 304
+
+
+def test_stats_cached_until_expired():
+    stats._cache.clear()
+    with clientContext() as client:
+        assert client.get("/api/stats").json["counts"]["bins"] == 0
+        assert client.post("/api/bins", json={"id": "BIN000000"}).status_code == 201
+        assert client.get("/api/stats").json["counts"]["bins"] == 0
+
+        stats._cache.clear()
+        assert client.get("/api/stats").json["counts"]["bins"] == 1